@@ -13,20 +13,786 @@ import sys
 import os
 import re
 import shutil
+import tempfile
 import time
 import subprocess
 import logging
+import threading
+import atexit
 import math
+import datetime
+import importlib
+import json
+import hashlib
+import argparse
+import bisect
+import csv
+import glob
+from collections import OrderedDict
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen, Request, HTTPError
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import numpy as np
 
-## Import Astronomy Specific Tools
-import ephem
-import astropy.units as u
-from astropy.io import fits
-import astropy.coordinates as coords
-from astropy import table
-from astropy import wcs
-from astropy.io import ascii
+
+
+##-----------------------------------------------------------------------------
+## Define LazyModule object to defer imports until they are needed
+##-----------------------------------------------------------------------------
+class LazyModule(object):
+    '''
+    Stands in for a module which is only imported the first time one of its
+    attributes is used.  The astronomy specific modules below are slow to
+    import, and many runs (i.e. reading a header or measuring the FWHM) never
+    use some of them, so deferring the imports keeps start up time short for
+    processes which analyze a single image.
+    '''
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def Load(self):
+        if self.__dict__['_module'] is None:
+            self.__dict__['_module'] = importlib.import_module(self.__dict__['_name'])
+        return self.__dict__['_module']
+
+    def __getattr__(self, attribute):
+        return getattr(self.Load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self.Load(), attribute, value)
+
+    def __repr__(self):
+        return "<LazyModule {0}>".format(self.__dict__['_name'])
+
+
+## Import Astronomy Specific Tools (deferred until first use)
+ephem = LazyModule('ephem')
+u = LazyModule('astropy.units')
+fits = LazyModule('astropy.io.fits')
+coords = LazyModule('astropy.coordinates')
+table = LazyModule('astropy.table')
+wcs = LazyModule('astropy.wcs')
+ascii = LazyModule('astropy.io.ascii')
+
+
+##-----------------------------------------------------------------------------
+## Median of Values in Each Bin
+##-----------------------------------------------------------------------------
+def BinnedMedian(values, binIndex, nBins):
+    '''
+    Return the median of values in each of nBins bins and the number of values
+    in each bin.  binIndex gives the bin (0 to nBins-1) of each value.  The
+    medians are found with a single sort of all values rather than a loop over
+    bins.  Empty bins have a median of nan.
+    '''
+    values = np.asarray(values, dtype=float)
+    binIndex = np.asarray(binIndex, dtype=int)
+    counts = np.bincount(binIndex, minlength=nBins)
+    medians = np.empty(nBins)
+    medians.fill(np.nan)
+    if len(values) == 0:
+        return medians, counts
+    ## Sort by bin, then by value within each bin
+    sortedValues = values[np.lexsort((values, binIndex))]
+    starts = np.cumsum(counts) - counts
+    filled = counts > 0
+    low = starts[filled] + (counts[filled]-1)//2
+    high = starts[filled] + counts[filled]//2
+    medians[filled] = 0.5*(sortedValues[low] + sortedValues[high])
+    return medians, counts
+
+
+##-----------------------------------------------------------------------------
+## Update Header Keywords for a Cropped Image
+##-----------------------------------------------------------------------------
+def CropHeader(header, x1, y1):
+    '''
+    Update the WCS reference pixel and the IRAF LTV keywords in a fits header
+    for an image which has been cropped so that (x1, y1) is the new origin.
+    '''
+    if 'CRPIX1' in header: header['CRPIX1'] = header['CRPIX1'] - x1
+    if 'CRPIX2' in header: header['CRPIX2'] = header['CRPIX2'] - y1
+    header['LTV1'] = header.get('LTV1', 0) - x1
+    header['LTV2'] = header.get('LTV2', 0) - y1
+    return header
+
+
+##-----------------------------------------------------------------------------
+## Find the Image HDU in a Fits File
+##-----------------------------------------------------------------------------
+def FindImageHDU(hdulist):
+    '''
+    Return the index of the first HDU in hdulist which contains a two
+    dimensional image and whether that HDU is tile compressed.  Only headers
+    are read, so compressed data is not decompressed.
+    '''
+    for i, hdu in enumerate(hdulist):
+        if isinstance(hdu, fits.CompImageHDU):
+            return i, True
+        if isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and hdu.header.get('NAXIS', 0) >= 2:
+            return i, False
+    raise IOError("No image HDU found in {0}".format(hdulist.filename()))
+
+
+##-----------------------------------------------------------------------------
+## Find All Image HDUs in a File
+##-----------------------------------------------------------------------------
+def ImageExtensions(hdulist):
+    '''
+    Return the indices of all HDUs in hdulist which contain a two dimensional
+    image (i.e. the chips of a mosaic camera).  Only headers are read.
+    '''
+    Extensions = []
+    for i, hdu in enumerate(hdulist):
+        if isinstance(hdu, fits.CompImageHDU) or\
+           (isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU)) and hdu.header.get('NAXIS', 0) >= 2):
+            Extensions.append(i)
+    return Extensions
+
+
+##-----------------------------------------------------------------------------
+## Determine Whether a File is gzip Compressed
+##-----------------------------------------------------------------------------
+def IsGzipped(file):
+    '''
+    Check the first two bytes of a file for the gzip magic number.
+    '''
+    with open(file, 'rb') as FileObject:
+        return FileObject.read(2) == b'\x1f\x8b'
+
+
+##-----------------------------------------------------------------------------
+## Read a Section of an Image HDU
+##-----------------------------------------------------------------------------
+def ReadSection(hdu, y1, y2, x1, x2):
+    '''
+    Read the [y1:y2,x1:x2] section of an image HDU without reading the whole
+    image.  For tile compressed HDUs only the tiles which overlap the section
+    are decompressed.  Falls back to reading the whole image if the HDU does
+    not support section access.
+    '''
+    try:
+        Section = hdu.section
+    except AttributeError:
+        return hdu.data[y1:y2,x1:x2]
+    return Section[y1:y2,x1:x2]
+
+
+##-----------------------------------------------------------------------------
+## Block Bin an Image
+##-----------------------------------------------------------------------------
+def BlockBin(data, binning):
+    '''
+    Sum data in binning x binning blocks.  Rows and columns which do not fill
+    a whole block are trimmed.  Returns a float32 array.
+    '''
+    nY = data.shape[0] // binning
+    nX = data.shape[1] // binning
+    Trimmed = np.asarray(data[0:nY*binning,0:nX*binning], dtype=np.float32)
+    return Trimmed.reshape(nY, binning, nX, binning).sum(axis=(1,3))
+
+
+def BlockMax(data, binning):
+    '''
+    Maximum of data in binning x binning blocks.  Rows and columns which do
+    not fill a whole block are trimmed.  Returns a float32 array.
+    '''
+    nY = data.shape[0] // binning
+    nX = data.shape[1] // binning
+    Trimmed = np.asarray(data[0:nY*binning,0:nX*binning], dtype=np.float32)
+    return Trimmed.reshape(nY, binning, nX, binning).max(axis=(1,3))
+
+
+def PairMinimum(data):
+    '''
+    For each pixel, the smaller of its value and the value of its brightest
+    (4-connected) neighbor, i.e. the highest level at which the pixel is one
+    of at least two adjacent pixels.  Single pixel spikes (hot pixels, most
+    cosmic rays) are reduced to the level of their neighbors, while stars
+    are barely changed.  Returns a float32 array.
+    '''
+    Data = np.asarray(data, dtype=np.float32)
+    Neighbors = np.full(Data.shape, -np.inf, dtype=np.float32)
+    np.maximum(Neighbors[1:], Data[:-1], out=Neighbors[1:])
+    np.maximum(Neighbors[:-1], Data[1:], out=Neighbors[:-1])
+    np.maximum(Neighbors[:,1:], Data[:,:-1], out=Neighbors[:,1:])
+    np.maximum(Neighbors[:,:-1], Data[:,1:], out=Neighbors[:,:-1])
+    return np.minimum(Data, Neighbors)
+
+
+##-----------------------------------------------------------------------------
+## Parse a Region String
+##-----------------------------------------------------------------------------
+def ParseRegion(region):
+    '''
+    Parse a region string of the form '[x1:x2,y1:y2]' or 'x1:x2,y1:y2'.
+    Returns a tuple of (x1, x2, y1, y2) or None if it can not be parsed.
+    '''
+    MatchRegion = re.match("\[?(\d{1,5}):(\d{1,5}),(\d{1,5}):(\d{1,5})\]?", region)
+    if MatchRegion:
+        return tuple([int(MatchRegion.group(i)) for i in range(1,5)])
+    return None
+
+
+##-----------------------------------------------------------------------------
+## Read Image Data as float32
+##-----------------------------------------------------------------------------
+def ReadFloat32(file, out=None):
+    '''
+    Read the image data in file as float32.  The raw (integer) data are read
+    unscaled and BSCALE and BZERO are applied in float32, so that 16 bit
+    unsigned data (BZERO = 32768) are never promoted to float64.  If out is
+    a float32 array of the right shape it is filled and returned instead of
+    allocating a new array.  Returns the data and a copy of the header
+    without the BZERO and BSCALE keywords.
+    '''
+    hdulist = fits.open(file, memmap=False, do_not_scale_image_data=True, ignore_missing_end=True)
+    ImageHDU, Compressed = FindImageHDU(hdulist)
+    Header = hdulist[ImageHDU].header.copy()
+    BScale = float(Header.get('BSCALE', 1.))
+    BZero = float(Header.get('BZERO', 0.))
+    if Compressed:
+        ## Tile compressed data are scaled when they are decompressed
+        hdulist.close()
+        hdulist = fits.open(file, memmap=False, ignore_missing_end=True)
+        BScale, BZero = 1., 0.
+    Raw = hdulist[ImageHDU].data
+    if out is None or out.shape != Raw.shape:
+        out = np.empty(Raw.shape, dtype=np.float32)
+    np.copyto(out, Raw, casting='unsafe')
+    hdulist.close()
+    if BScale != 1.:
+        out *= BScale
+    if BZero != 0.:
+        out += BZero
+    for keyword in ['BZERO', 'BSCALE', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME',
+                    'ZIMAGE', 'ZBITPIX', 'ZNAXIS', 'ZNAXIS1', 'ZNAXIS2', 'ZCMPTYPE']:
+        if keyword in Header: del Header[keyword]
+    return out, Header
+
+
+##-----------------------------------------------------------------------------
+## Measure Stars at Given Positions
+##-----------------------------------------------------------------------------
+def ForcedMeasure(data, X, Y, halfSize, apertureRadius, nSigma=2.):
+    '''
+    Measure stars at the given (FITS convention, 1 indexed) positions in data
+    without detecting them.  A (2*halfSize+1) pixel square cutout is taken
+    around each position and all stars are measured at once.
+
+    The local background and noise are the median and scaled median absolute
+    deviation of the pixels in the outer part of each cutout.  The centroid
+    starts from that of the background subtracted pixels more than nSigma
+    times the noise above the background and is refined with the weights
+    below.  The aperture flux is the sum of the background subtracted pixels
+    within apertureRadius of the given position.
+
+    The FWHM (pixels), ellipticity, and orientation (degrees) are derived
+    assuming a gaussian profile from second moments weighted by a circular
+    gaussian (adaptive moments): the weight is iterated to the size of the
+    star and its broadening of the moments is removed.  Unlike moments of
+    the pixels above a threshold, which leave out the wings of faint stars
+    and pick up noise spikes far from the star, these are not biased by the
+    brightness of the star (to within a few percent at a peak of 6 times
+    the noise).
+
+    Returns a dictionary of arrays.  Stars too close to the edge of data
+    have inBounds set to False and nan for all measurements.
+    '''
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    nY, nX = data.shape
+    Offsets = np.arange(-halfSize, halfSize+1)
+    X0 = np.round(X).astype(int) - 1
+    Y0 = np.round(Y).astype(int) - 1
+    InBounds = (X0 - halfSize >= 0) & (X0 + halfSize < nX) &\
+               (Y0 - halfSize >= 0) & (Y0 + halfSize < nY)
+    Measured = {'inBounds': InBounds}
+    for key in ['X', 'Y', 'flux', 'background', 'noise', 'FWHM', 'ellipticity', 'theta']:
+        Measured[key] = np.nan * np.ones(len(X))
+    if not InBounds.any():
+        return Measured
+    X0 = X0[InBounds]
+    Y0 = Y0[InBounds]
+    Cutouts = np.asarray(data[(Y0[:,None,None] + Offsets[None,:,None]),
+                              (X0[:,None,None] + Offsets[None,None,:])], dtype=np.float32)
+    ## Pixel coordinates relative to the requested position
+    dX = (X0 + 1 - X[InBounds])[:,None,None] + Offsets[None,None,:]
+    dY = (Y0 + 1 - Y[InBounds])[:,None,None] + Offsets[None,:,None]
+    R2 = dX**2 + dY**2
+    Border = (np.abs(Offsets)[:,None] > 0.7*halfSize) | (np.abs(Offsets)[None,:] > 0.7*halfSize)
+    BorderPixels = Cutouts[:,Border]
+    Background = np.median(BorderPixels, axis=1)
+    Noise = 1.4826 * np.median(np.abs(BorderPixels - Background[:,None]), axis=1)
+    Subtracted = Cutouts - Background[:,None,None]
+    Weights = np.where((Subtracted > nSigma*Noise[:,None,None]) & (R2 <= halfSize**2), Subtracted, 0.)
+    Sum = Weights.sum(axis=(1,2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        Xc = (Weights*dX).sum(axis=(1,2)) / Sum
+        Yc = (Weights*dY).sum(axis=(1,2)) / Sum
+        ## Adaptive moments, with the centroid refined at each iteration.
+        ## For a gaussian star of covariance C and a circular gaussian weight
+        ## of variance W, the weighted moments are M = (C^-1 + 1/W)^-1, so
+        ## C = (M^-1 - 1/W)^-1.
+        Xc = np.nan_to_num(Xc)
+        Yc = np.nan_to_num(Yc)
+        MinW, MaxW = 0.25, (halfSize/2.)**2
+        W = np.ones(len(Xc))
+        for iteration in range(8):
+            dXc = dX - Xc[:,None,None]
+            dYc = dY - Yc[:,None,None]
+            Weighted = Subtracted * np.exp(-(dXc**2 + dYc**2) / (2.*W[:,None,None]))
+            WeightedSum = Weighted.sum(axis=(1,2))
+            Xc = np.clip(Xc + (Weighted*dXc).sum(axis=(1,2)) / WeightedSum, -halfSize/2., halfSize/2.)
+            Yc = np.clip(Yc + (Weighted*dYc).sum(axis=(1,2)) / WeightedSum, -halfSize/2., halfSize/2.)
+            dXc = dX - Xc[:,None,None]
+            dYc = dY - Yc[:,None,None]
+            Mxx = (Weighted*dXc**2).sum(axis=(1,2)) / WeightedSum
+            Myy = (Weighted*dYc**2).sum(axis=(1,2)) / WeightedSum
+            Mxy = (Weighted*dXc*dYc).sum(axis=(1,2)) / WeightedSum
+            Determinant = Mxx*Myy - Mxy**2
+            Ixx = Myy/Determinant - 1./W
+            Iyy = Mxx/Determinant - 1./W
+            Ixy = -Mxy/Determinant
+            Determinant = Ixx*Iyy - Ixy**2
+            Cxx = Iyy/Determinant
+            Cyy = Ixx/Determinant
+            Cxy = -Ixy/Determinant
+            Good = (Ixx > 0) & (Iyy > 0) & (Determinant > 0)
+            W = np.where(Good, np.clip((Cxx + Cyy)/2., MinW, MaxW), W)
+        ## Eigenvalues of the covariance of the star
+        Root = np.sqrt(((Cxx - Cyy)/2.)**2 + Cxy**2)
+        A2 = (Cxx + Cyy)/2. + Root
+        B2 = np.clip((Cxx + Cyy)/2. - Root, 0., None)
+        Measured['FWHM'][InBounds] = np.where(Good, 2.3548 * np.sqrt((A2 + B2)/2.), np.nan)
+        Measured['ellipticity'][InBounds] = np.where(Good, 1. - np.sqrt(B2/A2), np.nan)
+        Measured['theta'][InBounds] = np.where(Good, np.degrees(0.5*np.arctan2(2.*Cxy, Cxx - Cyy)), np.nan)
+    Measured['X'][InBounds] = X[InBounds] + Xc
+    Measured['Y'][InBounds] = Y[InBounds] + Yc
+    Measured['flux'][InBounds] = np.where(R2 <= apertureRadius**2, Subtracted, 0.).sum(axis=(1,2))
+    Measured['background'][InBounds] = Background
+    Measured['noise'][InBounds] = Noise
+    return Measured
+
+
+
+##-----------------------------------------------------------------------------
+## Measure the Shift Between Two Images by Phase Correlation
+##-----------------------------------------------------------------------------
+def PhaseCorrelate(referenceFFT, data, peakWidth=1.5):
+    '''
+    Measure the shift of data relative to the image whose 2D FFT is
+    referenceFFT (the two must be the same shape) by phase correlation.  The
+    normalized cross power spectrum is tapered by a gaussian so that the
+    correlation peak has a gaussian shape about peakWidth pixels wide and
+    its position is refined to sub-pixel accuracy by fitting a gaussian
+    through the peak and its neighbors along each axis.
+
+    Returns the (dX, dY) shift in pixels (positive if the stars in data are
+    at larger X, Y than in the reference) and the height of the correlation
+    peak relative to that for identical images, which is close to 1 for a
+    good match and close to 0 if the images do not match.
+    '''
+    CrossPower = np.fft.fft2(data) * np.conj(referenceFFT)
+    CrossPower /= np.abs(CrossPower) + 1e-12
+    nY, nX = CrossPower.shape
+    FrequencyY = np.fft.fftfreq(nY)[:,None]
+    FrequencyX = np.fft.fftfreq(nX)[None,:]
+    Taper = np.exp(-2.*(math.pi*peakWidth)**2 * (FrequencyX**2 + FrequencyY**2))
+    CrossPower *= Taper
+    Correlation = np.fft.ifft2(CrossPower).real
+    PeakY, PeakX = np.unravel_index(np.argmax(Correlation), Correlation.shape)
+    def Refine(minus, center, plus):
+        if min(minus, center, plus) <= 0:
+            return 0.
+        minus, center, plus = math.log(minus), math.log(center), math.log(plus)
+        Denominator = minus - 2.*center + plus
+        if Denominator == 0:
+            return 0.
+        return 0.5 * (minus - plus) / Denominator
+    dX = PeakX + Refine(Correlation[PeakY,(PeakX-1) % nX], Correlation[PeakY,PeakX], Correlation[PeakY,(PeakX+1) % nX])
+    dY = PeakY + Refine(Correlation[(PeakY-1) % nY,PeakX], Correlation[PeakY,PeakX], Correlation[(PeakY+1) % nY,PeakX])
+    ## Shifts of more than half the image wrap around
+    if dX > nX/2: dX -= nX
+    if dY > nY/2: dY -= nY
+    return dX, dY, float(Correlation[PeakY,PeakX] / Taper.mean())
+
+
+##-----------------------------------------------------------------------------
+## Lock a File Against Other Threads and Processes
+##-----------------------------------------------------------------------------
+class FileLock(object):
+    '''
+    Exclusive lock on path for use in a with statement.  Threads in this
+    process are serialized by a lock shared by all FileLock objects for the
+    same path and other processes by an flock on path + ".lock" (where fcntl
+    is not available, only threads are serialized).
+    '''
+    threadLocks = {}
+    registryLock = threading.Lock()
+
+    def __init__(self, path):
+        self.lockFile = os.path.abspath(path) + ".lock"
+        with FileLock.registryLock:
+            self.threadLock = FileLock.threadLocks.setdefault(self.lockFile, threading.Lock())
+        self.handle = None
+
+    def __enter__(self):
+        self.threadLock.acquire()
+        if fcntl:
+            try:
+                self.handle = open(self.lockFile, 'a')
+                fcntl.flock(self.handle.fileno(), fcntl.LOCK_EX)
+            except:
+                if self.handle:
+                    self.handle.close()
+                    self.handle = None
+                self.threadLock.release()
+                raise
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if self.handle:
+            fcntl.flock(self.handle.fileno(), fcntl.LOCK_UN)
+            self.handle.close()
+            self.handle = None
+        self.threadLock.release()
+
+
+##-----------------------------------------------------------------------------
+## Split an Image in to Strips or Tiles Which Fit in a Memory Budget
+##-----------------------------------------------------------------------------
+def StripRows(nX, memoryBudget, copies=4, multiple=1):
+    '''
+    Return the number of rows of an nX pixel wide float32 image which fit in
+    memoryBudget bytes if copies copies of the strip are needed.  The result
+    is a multiple of multiple (i.e. the binning) and at least multiple.
+    '''
+    Rows = int(memoryBudget // (4 * copies * nX))
+    return max(Rows // multiple, 1) * multiple
+
+
+def Strips(nY, stripRows):
+    '''
+    Generate the (y1, y2) row ranges of strips of stripRows rows.
+    '''
+    for y1 in range(0, nY, stripRows):
+        yield y1, min(y1 + stripRows, nY)
+
+
+def Tiles(nY, nX, tileSize, overlap):
+    '''
+    Generate tiles covering an nY x nX image.  Each tile is a tuple of the
+    region to read (y1, y2, x1, x2), which is the core of the tile grown by
+    overlap pixels on each side, and the core (cy1, cy2, cx1, cx2).  The
+    cores do not overlap and cover the image, so an object belongs to the
+    tile whose core contains its center.
+    '''
+    for cy1 in range(0, nY, tileSize):
+        cy2 = min(cy1 + tileSize, nY)
+        for cx1 in range(0, nX, tileSize):
+            cx2 = min(cx1 + tileSize, nX)
+            yield ((max(cy1 - overlap, 0), min(cy2 + overlap, nY),
+                    max(cx1 - overlap, 0), min(cx2 + overlap, nX)),
+                   (cy1, cy2, cx1, cx2))
+
+
+def BinFile(file, binning, memoryBudget=64*1024**2):
+    '''
+    Block bin the image in file (see BlockBin) reading one strip of rows at
+    a time, so that the whole image is never in memory.
+    '''
+    hdulist = fits.open(file, memmap=False, ignore_missing_end=True)
+    hdu = hdulist[FindImageHDU(hdulist)[0]]
+    nY = hdu.header['NAXIS2']
+    nX = hdu.header['NAXIS1']
+    Binned = np.zeros((nY // binning, nX // binning), dtype=np.float32)
+    for y1, y2 in Strips(Binned.shape[0] * binning, StripRows(nX, memoryBudget, multiple=binning)):
+        Binned[y1//binning:y2//binning] = BlockBin(ReadSection(hdu, y1, y2, 0, nX), binning)
+    hdulist.close()
+    return Binned
+
+
+##-----------------------------------------------------------------------------
+## Estimate and Interpolate a Low Resolution Background Grid
+##-----------------------------------------------------------------------------
+def BackgroundGrid(data, meshSize, nSigma=3., iterations=3):
+    '''
+    Estimate the background of data on a grid of meshSize x meshSize pixel
+    meshes (the last row and column of meshes may be smaller), as SExtractor
+    does: the values in each mesh are clipped at nSigma about the median and
+    the background is 2.5*median - 1.5*mean (or the median if the mean and
+    median differ by more than 0.3 sigma, i.e. in crowded meshes).  Returns
+    the grid (float32) and the RMS in each mesh.
+    '''
+    nY, nX = data.shape
+    gY = int(math.ceil(nY / meshSize))
+    gX = int(math.ceil(nX / meshSize))
+    Padded = np.zeros((gY*meshSize, gX*meshSize), dtype=np.float32)
+    Padded[:nY,:nX] = data
+    Mask = np.ones(Padded.shape, dtype=bool)
+    Mask[:nY,:nX] = ~np.isfinite(data)
+    Padded[Mask] = 0.
+    def ToMeshes(array):
+        return array.reshape(gY, meshSize, gX, meshSize).swapaxes(1, 2).reshape(gY, gX, meshSize*meshSize)
+    Meshes = np.ma.array(ToMeshes(Padded), mask=ToMeshes(Mask))
+    for iteration in range(iterations):
+        Median = np.ma.median(Meshes, axis=2)
+        Sigma = Meshes.std(axis=2)
+        Meshes = np.ma.masked_where(np.abs(Meshes - Median[:,:,None]) > nSigma*Sigma[:,:,None], Meshes)
+    Median = np.ma.median(Meshes, axis=2).filled(np.nan)
+    Mean = Meshes.mean(axis=2).filled(np.nan)
+    Sigma = Meshes.std(axis=2).filled(np.nan)
+    Grid = np.where(np.abs(Mean - Median) > 0.3*Sigma, Median, 2.5*Median - 1.5*Mean)
+    return Grid.astype(np.float32), Sigma.astype(np.float32)
+
+
+def InterpolateGrid(grid, meshSize, shape, binning=1):
+    '''
+    Bilinearly interpolate a background grid (see BackgroundGrid) of
+    meshSize pixel meshes to an image of the given (nY, nX) shape, or to the
+    pixel centers of that image block binned by binning.  Outside the mesh
+    centers the nearest mesh value is used.
+    '''
+    def Weights(n, g):
+        ## Mesh centers (the last mesh may be partial) and pixel centers
+        Centers = (np.arange(g) + 0.5)*meshSize - 0.5
+        Centers[-1] = ((g-1)*meshSize + n)/2. - 0.5
+        Pixels = (np.arange(n // binning) + 0.5)*binning - 0.5
+        i = np.clip(np.searchsorted(Centers, Pixels) - 1, 0, max(g-2, 0))
+        j = np.minimum(i + 1, g - 1)
+        Step = np.where(j > i, Centers[j] - Centers[i], 1.)
+        w = np.clip((Pixels - Centers[i]) / Step, 0., 1.)
+        return i, j, w.astype(np.float32)
+    gY, gX = grid.shape
+    iY, jY, wY = Weights(shape[0], gY)
+    iX, jX, wX = Weights(shape[1], gX)
+    Rows = grid[:,iX]*(1.-wX) + grid[:,jX]*wX
+    return Rows[iY]*(1.-wY)[:,None] + Rows[jY]*wY[:,None]
+
+
+##-----------------------------------------------------------------------------
+## Read Columns of a SExtractor FITS_LDAC Catalog
+##-----------------------------------------------------------------------------
+def ReadLDAC(catalogFile, columns=None):
+    '''
+    Read a SExtractor FITS_LDAC catalog in to an astropy table.  The catalog
+    is memory mapped and only the given columns (default: all) are copied
+    out of it (in native byte order), so columns which are not used are
+    never materialized.  Columns which are not in the catalog are skipped.
+    '''
+    hdulist = fits.open(catalogFile, memmap=True)
+    try:
+        Data = hdulist[2].data
+        if columns is None:
+            columns = Data.names
+        Results = table.Table()
+        for name in columns:
+            if not name in Data.names:
+                continue
+            Column = Data.field(name)
+            Results.add_column(table.Column(data=Column.astype(Column.dtype.newbyteorder('=')), name=name))
+    finally:
+        hdulist.close()
+    return Results
+
+
+##-----------------------------------------------------------------------------
+## Define LogWriter object to write log records from a background thread
+##-----------------------------------------------------------------------------
+class LogWriter(object):
+    '''
+    Writes IQMon log records to the console and to log files from a single
+    background thread, so that logging does not do file I/O in the thread
+    doing the image analysis.
+
+    Records are passed in through a bounded queue (see LogQueueHandler).  Log
+    files are opened once and reference counted, so many images which log to
+    the same file share one file handler and the file is closed when the last
+    image using it is finished (see Image.MakeLogger and Image.CloseLogger).
+
+    Each line is tagged with the file name of the image which logged it, as
+    one log file may hold the records of several images.  Records from
+    loggers not tied to an image are tagged with "-".
+
+    Once the writer is stopped (at exit, see GetLogWriter), records are
+    written synchronously in the calling thread and Flush does not wait, so
+    threads still logging during shut down do not block.  The stopped flag
+    is checked and records are queued under stateLock, so no record can be
+    queued after the writer thread has taken its last record.
+
+    Use GetLogWriter to get the LogWriter for the process.
+    '''
+    def __init__(self, maxQueueSize=10000):
+        self.queue = queue.Queue(maxQueueSize)
+        self.lock = threading.Lock()
+        self.stateLock = threading.Lock()
+        self.format = logging.Formatter('%(asctime)23s %(levelname)8s %(image)s: %(message)s')
+        self.consoleHandler = logging.StreamHandler()
+        self.consoleHandler.setLevel(logging.INFO)
+        self.consoleHandler.setFormatter(self.format)
+        self.fileHandlers = {}
+        self.nDropped = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self.Run, name="IQMonLogWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Run(self):
+        '''
+        Write records from the queue until a None is received.  Stop queues
+        the None under stateLock after setting stopped, so it is the last
+        record in the queue.
+        '''
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                self.Write(record)
+            finally:
+                self.queue.task_done()
+
+    def Write(self, record):
+        '''
+        Write a record to the console and to its log file.  Errors are
+        reported on stderr by the handler's handleError.
+        '''
+        if not hasattr(record, 'image'):
+            record.image = '-'
+        try:
+            with self.lock:
+                if record.levelno >= self.consoleHandler.level:
+                    self.consoleHandler.handle(record)
+                FileHandler = self.fileHandlers.get(getattr(record, 'logFile', None))
+                if FileHandler:
+                    FileHandler[0].handle(record)
+        except Exception:
+            self.consoleHandler.handleError(record)
+
+    def OpenFile(self, logFile):
+        '''
+        Open a file handler for logFile or add a reference to an existing one.
+        '''
+        with self.lock:
+            if logFile in self.fileHandlers:
+                self.fileHandlers[logFile][1] += 1
+            else:
+                FileHandler = logging.FileHandler(logFile)
+                FileHandler.setLevel(logging.DEBUG)
+                FileHandler.setFormatter(self.format)
+                self.fileHandlers[logFile] = [FileHandler, 1]
+
+    def CloseFile(self, logFile):
+        '''
+        Remove a reference to the file handler for logFile and close it once
+        no references remain.  Records already queued are written first.
+        '''
+        self.Flush()
+        with self.lock:
+            if logFile in self.fileHandlers:
+                self.fileHandlers[logFile][1] -= 1
+                if self.fileHandlers[logFile][1] <= 0:
+                    self.fileHandlers.pop(logFile)[0].close()
+
+    def Flush(self):
+        '''
+        Block until all queued records have been written (unless the writer
+        has stopped).
+        '''
+        if not self.stopped:
+            self.queue.join()
+        with self.lock:
+            for FileHandler, nReferences in self.fileHandlers.values():
+                FileHandler.flush()
+            self.consoleHandler.flush()
+
+    def Stop(self):
+        '''
+        Write all queued records, stop the thread, and close all log files.
+        '''
+        with self.stateLock:
+            self.stopped = True
+            if self.thread.is_alive():
+                self.queue.put(None)
+        self.thread.join()
+        with self.lock:
+            for FileHandler, nReferences in self.fileHandlers.values():
+                FileHandler.close()
+            self.fileHandlers = {}
+
+
+##-----------------------------------------------------------------------------
+## Define LogQueueHandler to pass log records to the LogWriter
+##-----------------------------------------------------------------------------
+class LogQueueHandler(logging.Handler):
+    '''
+    Logging handler which puts records on the LogWriter queue.  The message
+    is formatted in the calling thread.  If the queue is full, DEBUG records
+    are dropped (and counted) rather than blocking the analysis, while higher
+    level records wait for space in the queue.  Once the writer has stopped,
+    records are written in the calling thread.
+    '''
+    def __init__(self, writer):
+        logging.Handler.__init__(self)
+        self.writer = writer
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.writer.format.formatException(record.exc_info)
+                record.msg = record.msg + "\n" + record.exc_text
+                record.exc_info = None
+                record.exc_text = None
+            with self.writer.stateLock:
+                if not self.writer.stopped:
+                    try:
+                        self.writer.queue.put_nowait(record)
+                    except queue.Full:
+                        if record.levelno <= logging.DEBUG:
+                            self.writer.nDropped += 1
+                        else:
+                            self.writer.queue.put(record)
+                    return
+            self.writer.Write(record)
+        except:
+            self.handleError(record)
+
+
+_LogWriter = None
+
+def GetLogWriter():
+    '''
+    Return the LogWriter for this process, starting it if needed.
+    '''
+    global _LogWriter
+    if _LogWriter is None:
+        _LogWriter = LogWriter()
+        atexit.register(_LogWriter.Stop)
+    return _LogWriter
 
 
 ##-----------------------------------------------------------------------------
@@ -47,31 +813,50 @@ class Config(object):
                      (i.e. ~/IQMon/Plots/)
     - pathTemp:      path where temporary files should be written
                      (i.e. ~/IQMon/tmp/)
+    - pathScratch:   path under which each image gets its own scratch
+                     directory for intermediate files.  This can be on a RAM
+                     backed file system (i.e. /dev/shm).  Defaults to pathTemp.
+    - pathCache:     path where the ResultCache stores the results of each
+                     analysis stage.  Defaults to a Cache directory in
+                     pathTemp.
+    - pathArchive:   path of the CatalogArchive used by the ArchiveCatalog
+                     stage (IQMONARCHIVE in the config file).
+    - memoryBudget:  if set (IQMONMEMORY in MB in the config file), large
+                     images are calibrated, extracted, and rendered in tiles
+                     or strips which fit in this many bytes.
     '''
-    _singletons = dict()
-
-    def __new__(cls):
-        if not cls in cls._singletons:
-            cls._singletons[cls] = object.__new__(cls)
-        return cls._singletons[cls]
-
-    def __init__(self):
+    def __init__(self, configFile=None):
         '''
         Read and parse configuration file.
-        - Assumes that file is .IQMonConfig in the user's home directory.
+        - Assumes that file is .IQMonConfig in the user's home directory
+          unless configFile is given (i.e. one file for each telescope).
         - No defaults set, if config file not read, then values default to
           None.
+        - Each Config object is independent and parses its file when created.
         '''
 
         ## Look for configuration file
-        HomePath = os.path.expandvars("$HOME")
-        ConfigFilePath = os.path.join(HomePath, ".IQMonConfig")
+        if configFile:
+            ConfigFilePath = os.path.abspath(os.path.expanduser(configFile))
+        else:
+            HomePath = os.path.expandvars("$HOME")
+            ConfigFilePath = os.path.join(HomePath, ".IQMonConfig")
         if os.path.exists(ConfigFilePath):
             ConfigFile = open(ConfigFilePath, 'r')
             ConfigFileLines = ConfigFile.readlines()
             ConfigFile.close()
         else:
-            ConfigFileLines = None
+            ConfigFileLines = []
+        self.configFile = ConfigFilePath
+
+        self.pathIQMonExec = None
+        self.pathLog = None
+        self.pathPlots = None
+        self.pathTemp = None
+        self.pathScratch = None
+        self.pathCache = None
+        self.pathArchive = None
+        self.memoryBudget = None
 
         ## read configuration file
         for line in ConfigFileLines:
@@ -87,34 +872,26 @@ class Config(object):
             IstmpPath = re.match("IQMONTMP\s=\s([\w/\-\.]+)", line)
             if IstmpPath:
                 self.pathTemp = os.path.abspath(IstmpPath.group(1))
+            IsScratchPath = re.match("IQMONSCRATCH\s=\s([\w/\-\.]+)", line)
+            if IsScratchPath:
+                self.pathScratch = os.path.abspath(IsScratchPath.group(1))
+            IsCachePath = re.match("IQMONCACHE\s=\s([\w/\-\.]+)", line)
+            if IsCachePath:
+                self.pathCache = os.path.abspath(IsCachePath.group(1))
+            IsArchivePath = re.match("IQMONARCHIVE\s=\s([\w/\-\.]+)", line)
+            if IsArchivePath:
+                self.pathArchive = os.path.abspath(IsArchivePath.group(1))
+            IsMemoryBudget = re.match("IQMONMEMORY\s=\s([\d\.]+)", line)
+            if IsMemoryBudget:
+                self.memoryBudget = int(float(IsMemoryBudget.group(1)) * 1024**2)
 #             IsCatalogPath = re.match("CATALOGPATH\s=\s([\w/\-\.]+)", line)
 #             if IsCatalogPath:
 #                 self.pathCatalog = os.path.abspath(IsCatalogPath.group(1))
 
-        ## Create Log Path if it doesn't exist
-        SplitPath = [self.pathLog]
-        CreatePaths = []
-        while not os.path.exists(SplitPath[0]):
-            CreatePaths.append(SplitPath[0])
-            SplitPath = os.path.split(SplitPath[0])
-        while len(CreatePaths) > 0:
-            os.mkdir(CreatePaths.pop())
-        ## Create Plots Path if it doesn't exist
-        SplitPath = [self.pathPlots]
-        CreatePaths = []
-        while not os.path.exists(SplitPath[0]):
-            CreatePaths.append(SplitPath[0])
-            SplitPath = os.path.split(SplitPath[0])
-        while len(CreatePaths) > 0:
-            os.mkdir(CreatePaths.pop())
-        ## Create temp Path if it doesn't exist
-        SplitPath = [self.pathTemp]
-        CreatePaths = []
-        while not os.path.exists(SplitPath[0]):
-            CreatePaths.append(SplitPath[0])
-            SplitPath = os.path.split(SplitPath[0])
-        while len(CreatePaths) > 0:
-            os.mkdir(CreatePaths.pop())
+        ## Create Log, Plots, and temp Paths if they don't exist
+        for Path in [self.pathLog, self.pathPlots, self.pathTemp]:
+            if Path and not os.path.exists(Path):
+                os.makedirs(Path)
 
 
 
@@ -147,21 +924,24 @@ class Telescope(object):
                      should be reducible to either pixels or arcseconds.
       ROI:           The "region of interest" to crop the image to.  Format
                      should be '[x1:x2,y1:y2]' or 'x1:x2,y1:y2'.
+      overscan:      The overscan region of the CCD (same format as ROI).  If
+                     set, Calibrate subtracts the median of the overscan in
+                     each row.
       thresholdFWHM: The FWHM above which the image should be flagged in the
                      HTML output log.
       thresholdPointingErr:   
       thresholdEllipticity:   
       SExtractorPhotAperture: 
       SExtractorSeeing:       The initial seeing estimate for SExtractor.
-    '''
-    _singletons = dict()
-
-    def __new__(cls):
-        if not cls in cls._singletons:
-            cls._singletons[cls] = object.__new__(cls)
-        return cls._singletons[cls]
 
+    Each Telescope object is independent, so one process can analyze images
+    from several telescopes (see TelescopeRegistry).  Once the properties
+    are set, Freeze checks the units and defines the pixel scale
+    equivalency, and the telescope can no longer be changed, so it can be
+    shared by images analyzed on several threads.
+    '''
     def __init__(self):
+        self.frozen = False
         self.name = None
         self.longName = None
         self.focalLength = None
@@ -172,6 +952,7 @@ class Telescope(object):
         self.nYPix = None
         self.unitsForFWHM = None
         self.ROI = None
+        self.overscan = None
         self.thresholdFWHM = None
         self.thresholdPointingErr = None
         self.thresholdEllipticity = None
@@ -181,7 +962,15 @@ class Telescope(object):
         self.SExtractorSeeing = None
         self.SExtractorSaturation = None
         self.site = None
-        
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError("Telescope {0} is frozen, {1} can not be changed".format(self.name, name))
+        object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return "<Telescope {0}{1}>".format(self.name, " (frozen)" if self.frozen else "")
+
     def CheckUnits(self):
         '''
         Checks whether the telescope properties have the right type.  If a unit
@@ -262,45 +1051,831 @@ class Telescope(object):
                        )]
 
 
+    ##-------------------------------------------------------------------------
+    ## Check and Fix the Telescope Properties
+    ##-------------------------------------------------------------------------
+    def Freeze(self):
+        '''
+        Check the units (CheckUnits) and define the pixel scale equivalency
+        (DefinePixelScale) once, then make the telescope read only.  Returns
+        the telescope.
+        '''
+        if not self.frozen:
+            self.CheckUnits()
+            self.DefinePixelScale()
+            self.frozen = True
+        return self
+
+
 ##-----------------------------------------------------------------------------
-## Define Image object which holds information and methods for analysis
+## Define TelescopeRegistry to hold the Telescope and Config of each telescope
 ##-----------------------------------------------------------------------------
-class Image(object):
+class TelescopeRegistry(object):
     '''
-    The IQMon.Image object represents a single input image to the IQMon
-    process.
+    The Telescope and Config objects for each telescope served by one
+    process, keyed by the telescope name.  Telescopes are frozen (see
+    Telescope.Freeze) when they are added.  Images are matched to a
+    telescope by the TELESCOP header keyword (the telescope name or one of
+    its aliases).
 
-    When defined, the image objects requires both a filename to a valid fits
-    file and an IQMon.Config object.
+    A TelescopeRegistry can be given to a Scheduler in place of a single
+    telescope, to process the images from all telescopes on one pool of
+    workers.
+    '''
+    def __init__(self):
+        self.telescopes = OrderedDict()
+        self.configs = {}
+        self.aliases = {}
+        self.lock = threading.Lock()
 
-    Properties:
+    def Add(self, tel, config=None, aliases=None):
+        '''
+        Add a telescope (with its Config, default Config()).  aliases are
+        other TELESCOP header values used by this telescope.
+        '''
+        assert isinstance(tel, Telescope)
+        tel.Freeze()
+        with self.lock:
+            if tel.name in self.telescopes:
+                raise ValueError("Telescope {0} is already registered".format(tel.name))
+            self.telescopes[tel.name] = tel
+            self.configs[tel.name] = config or Config()
+            for alias in [tel.name] + list(aliases or []):
+                self.aliases[alias.strip().lower()] = tel.name
+        return tel
 
-    Methods:
+    def Get(self, name):
+        '''
+        Return the telescope with the given name (or alias).
+        '''
+        with self.lock:
+            return self.telescopes[self.aliases.get(name.strip().lower(), name)]
+
+    def Config(self, tel):
+        '''
+        Return the Config for a telescope.
+        '''
+        return self.configs[tel.name]
+
+    def Match(self, file):
+        '''
+        Return the telescope whose name or alias matches the TELESCOP
+        keyword in the header of file, or the only telescope if there is
+        just one.  Raises KeyError if no telescope matches.
+        '''
+        hdulist = fits.open(file, ignore_missing_end=True)
+        Header = hdulist[FindImageHDU(hdulist)[0]].header
+        hdulist.close()
+        if 'TELESCOP' in Header:
+            try:
+                return self.Get(str(Header['TELESCOP']))
+            except KeyError:
+                pass
+        if len(self.telescopes) == 1:
+            return list(self.telescopes.values())[0]
+        raise KeyError("No telescope registered for {0} (TELESCOP = {1})".format(file, Header.get('TELESCOP')))
+
+    def __iter__(self):
+        return iter(list(self.telescopes.values()))
+
+    def __len__(self):
+        return len(self.telescopes)
+
+
+##-----------------------------------------------------------------------------
+## Define DarkLibrary object to find the right dark for each image
+##-----------------------------------------------------------------------------
+class DarkLibrary(object):
     '''
-    def __init__(self, input, tel=None, config=None):
-        self.startProcessTime = time.time()
-        if os.path.exists(input):
-            FitsFileDirectory, FitsFilename = os.path.split(input)
-            self.rawFile = input
-            self.rawFileName = FitsFilename
-            self.rawFileDirectory = FitsFileDirectory
-            self.rawFileBasename, self.fileExt = os.path.splitext(FitsFilename)
+    An index of the available dark, master dark, and bias frames which picks
+    the best dark for each image, so that the darks do not have to be found
+    by searching directories for every image.
+
+    Frames are indexed (from their headers, once) by telescope (TELESCOP),
+    binning (XBINNING), frame type (IMAGETYP), exposure time, CCD
+    temperature (CCD-TEMP), and date (DATE-OBS).  For each telescope and
+    binning the dark exposure times are kept sorted, so the exposure time
+    match is found by bisection.  Among the darks with a matching exposure
+    time, master darks are preferred, then darks closest in temperature and
+    date.  If there is no dark with a matching exposure time and scale is
+    True, a scaled dark is made from a bias and the dark current rate
+    measured from the nearest longer (or else shorter) exposure dark.
+
+    The prepared master dark data (float32) for the most recently used
+    maxCached dark sets is kept in memory.  The index can be saved to and
+    loaded from a file (Save, Load) so that only new files are read when a
+    directory is scanned again.
+
+    A DarkLibrary can be passed anywhere a list of dark files is accepted
+    (DarkSubtract, CalibrateROI, ProcessImage, Scheduler, AnalysisService).
+    '''
+    def __init__(self, directories=None, pattern="*.fits*", tempTolerance=2.,
+                 maxAge=30., exptimeTolerance=0.01, maxDarks=9, scale=True,
+                 maxCached=4):
+        self.tempTolerance = tempTolerance
+        self.maxAge = maxAge
+        self.exptimeTolerance = exptimeTolerance
+        self.maxDarks = maxDarks
+        self.scale = scale
+        self.maxCached = maxCached
+        self.logger = logging.getLogger('IQMonLogger')
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.groups = {}
+        self.masters = OrderedDict()
+        for directory in (directories or []):
+            self.Scan(directory, pattern)
+
+    def __repr__(self):
+        ## Changes whenever the indexed frames change (used by ResultCache)
+        with self.lock:
+            Frames = sorted([(Frame['file'], Frame['mtime']) for Frame in self.frames.values()])
+        return "DarkLibrary({0} frames, {1})".format(len(Frames), hashlib.sha1(repr(Frames).encode()).hexdigest())
+
+    def Scan(self, directory, pattern="*.fits*"):
+        '''
+        Add the dark and bias frames in directory which match pattern.  Files
+        already in the index which have not been modified are not read.
+        '''
+        nAdded = 0
+        for file in sorted(glob.glob(os.path.join(directory, pattern))):
+            if self.Add(file):
+                nAdded += 1
+        self.logger.info("Dark library: indexed {0} new frames from {1}".format(nAdded, directory))
+
+    def Add(self, file):
+        '''
+        Add a file to the index.  Returns True if the file is a dark or bias
+        frame which was not already indexed.
+        '''
+        file = os.path.abspath(file)
+        MTime = os.path.getmtime(file)
+        with self.lock:
+            if file in self.frames and self.frames[file]['mtime'] == MTime:
+                return False
+        try:
+            hdulist = fits.open(file, ignore_missing_end=True)
+            Header = hdulist[FindImageHDU(hdulist)[0]].header
+            hdulist.close()
+        except:
+            self.logger.warning("Dark library: could not read {0}".format(file))
+            return False
+        Frame = self.Describe(Header)
+        ImageType = str(Header.get('IMAGETYP', '')).lower()
+        if 'bias' in ImageType or 'zero' in ImageType or\
+           ('dark' in ImageType and Frame['exptime'] == 0.):
+            Frame['type'] = 'bias'
+        elif 'dark' in ImageType:
+            Frame['type'] = 'dark'
         else:
-            self.rawFile = None
-            self.rawFileName = None
-            self.rawFileDirectory = None
+            return False
+        Frame['master'] = 'NCOMBINE' in Header or\
+                          os.path.basename(file).lower().startswith('master')
+        Frame['file'] = file
+        Frame['mtime'] = MTime
+        with self.lock:
+            if file in self.frames:
+                self.Discard(self.frames[file])
+            self.frames[file] = Frame
+            self.Insert(Frame)
+        return True
+
+    def Describe(self, header):
+        '''
+        Return a dictionary with the properties used to match frames.
+        '''
+        def Get(keywords, convert):
+            for keyword in keywords:
+                if keyword in header:
+                    try:
+                        return convert(header[keyword])
+                    except ValueError:
+                        pass
+            return None
+        DateObs = Get(['DATE-OBS'], str)
+        return {'telescope': Get(['TELESCOP'], str),
+                'binning': Get(['XBINNING'], int) or 1,
+                'exptime': Get(['EXPTIME', 'EXPOSURE'], float),
+                'temperature': Get(['CCD-TEMP', 'CCDTEMP'], float),
+                'date': DateObs[0:19] if DateObs else None}
+
+    def Insert(self, frame):
+        '''
+        Insert a frame in the sorted exposure time list of its group.  Must
+        be called with the lock held.
+        '''
+        Key = (frame['telescope'], frame['binning'], frame['type'])
+        Exptimes, Frames = self.groups.setdefault(Key, ([], []))
+        i = bisect.bisect_right(Exptimes, frame['exptime'] or 0.)
+        Exptimes.insert(i, frame['exptime'] or 0.)
+        Frames.insert(i, frame)
+
+    def Discard(self, frame):
+        '''
+        Remove a frame from the sorted exposure time list of its group.  Must
+        be called with the lock held.
+        '''
+        Exptimes, Frames = self.groups.get((frame['telescope'], frame['binning'], frame['type']), ([], []))
+        i1 = bisect.bisect_left(Exptimes, frame['exptime'] or 0.)
+        i2 = bisect.bisect_right(Exptimes, frame['exptime'] or 0.)
+        for i in range(i1, i2):
+            if Frames[i] is frame:
+                del Exptimes[i]
+                del Frames[i]
+                return
+
+    def Regroup(self):
+        '''
+        Rebuild the sorted exposure time lists of all frames (see Load).
+        Must be called with the lock held.
+        '''
+        self.groups = {}
+        for Frame in sorted(self.frames.values(), key=lambda frame: frame['file']):
+            self.Insert(Frame)
+
+    def Save(self, indexFile):
+        with self.lock:
+            with open(indexFile, 'w') as FileObject:
+                json.dump(list(self.frames.values()), FileObject)
+
+    def Load(self, indexFile):
+        with open(indexFile, 'r') as FileObject:
+            Frames = json.load(FileObject)
+        with self.lock:
+            for Frame in Frames:
+                if os.path.exists(Frame['file']) and os.path.getmtime(Frame['file']) == Frame['mtime']:
+                    self.frames[Frame['file']] = Frame
+            self.Regroup()
+
+    def Days(self, date1, date2):
+        if not date1 or not date2:
+            return 0.
+        Format = "%Y-%m-%dT%H:%M:%S"
+        try:
+            Difference = datetime.datetime.strptime(date1, Format) - datetime.datetime.strptime(date2, Format)
+        except ValueError:
+            return 0.
+        return abs(Difference.total_seconds()) / 86400.
+
+    def Best(self, frames, target):
+        '''
+        Return the frames within the temperature tolerance and maximum age of
+        the target sorted by how well they match (masters first).
+        '''
+        Scored = []
+        for Frame in frames:
+            if Frame['temperature'] is not None and target['temperature'] is not None:
+                dTemp = abs(Frame['temperature'] - target['temperature'])
+            else:
+                dTemp = 0.
+            Days = self.Days(Frame['date'], target['date'])
+            if dTemp > self.tempTolerance or Days > self.maxAge:
+                continue
+            Scored.append((not Frame['master'], dTemp/self.tempTolerance + Days/self.maxAge, Frame['file'], Frame))
+        Scored.sort(key=lambda item: item[0:3])
+        return [item[3] for item in Scored]
+
+    def Match(self, image):
+        '''
+        Find the darks for an image.  Returns a tuple of the list of dark
+        files, the list of bias files, and the exposure time of the darks
+        (which differs from the image exposure time if the dark is to be
+        scaled), or None if there is no suitable dark.
+        '''
+        if image.header is not None:
+            Header = image.header
+        else:
+            hdulist = fits.open(image.rawFile, ignore_missing_end=True)
+            Header = hdulist[FindImageHDU(hdulist)[0]].header
+            hdulist.close()
+        Target = self.Describe(Header)
+        if Target['exptime'] is None:
+            return None
+        with self.lock:
+            Exptimes, Frames = self.groups.get((Target['telescope'], Target['binning'], 'dark'), ([], []))
+            Biases = self.groups.get((Target['telescope'], Target['binning'], 'bias'), ([], []))[1]
+            ## Darks with matching exposure time
+            Tolerance = self.exptimeTolerance * max(Target['exptime'], 1.)
+            i1 = bisect.bisect_left(Exptimes, Target['exptime'] - Tolerance)
+            i2 = bisect.bisect_right(Exptimes, Target['exptime'] + Tolerance)
+            Matches = self.Best(Frames[i1:i2], Target)
+            if Matches:
+                if Matches[0]['master']:
+                    Matches = Matches[0:1]
+                return [Frame['file'] for Frame in Matches[0:self.maxDarks]], [], Matches[0]['exptime']
+            if not self.scale:
+                return None
+            ## Scale the nearest dark with a longer (or else shorter) exposure
+            Bias = self.Best(Biases, Target)
+            if not Bias:
+                return None
+            for Group in [Frames[i2:], Frames[:i1][::-1]]:
+                Candidates = []
+                for Frame in Group:
+                    if Candidates and Frame['exptime'] != Candidates[0]['exptime']:
+                        break
+                    if self.Best([Frame], Target):
+                        Candidates.append(Frame)
+                if Candidates:
+                    Candidates = self.Best(Candidates, Target)
+                    if Candidates[0]['master']:
+                        Candidates = Candidates[0:1]
+                    if Bias[0]['master']:
+                        Bias = Bias[0:1]
+                    return ([Frame['file'] for Frame in Candidates[0:self.maxDarks]],
+                            [Frame['file'] for Frame in Bias[0:self.maxDarks]],
+                            Candidates[0]['exptime'])
+        return None
+
+    def Combine(self, files, section=None):
+        '''
+        Median combine files (or read a single file) as float32.  If section
+        (y1, y2, x1, x2) is given, only that section of each file is read.
+        '''
+        Data = []
+        for file in files:
+            hdulist = fits.open(file, memmap=False)
+            HDU = hdulist[FindImageHDU(hdulist)[0]]
+            if section:
+                Data.append(np.asarray(ReadSection(HDU, *section), dtype=np.float32))
+            else:
+                Data.append(np.asarray(HDU.data, dtype=np.float32))
+            hdulist.close()
+        if len(Data) == 1:
+            return Data[0]
+        return np.median(np.array(Data), axis=0).astype(np.float32)
+
+    def MasterDark(self, image, section=None):
+        '''
+        Return the master dark data (float32) for an image, scaled to the
+        image exposure time if necessary, or None if there is no suitable
+        dark.
+
+        If section (y1, y2, x1, x2) is given, only that section of the master
+        dark is returned: it is cut from the cached master if there is one,
+        or else made from that section of the dark and bias files (and not
+        cached).
+        '''
+        Match = self.Match(image)
+        if not Match:
+            image.logger.warning("Dark library: no suitable dark found.")
+            return None
+        Darks, Biases, DarkExptime = Match
+        Exptime = self.Describe(image.header if image.header is not None else
+                                fits.getheader(image.rawFile))['exptime']
+        Key = (tuple(Darks), tuple(Biases), Exptime if Biases else None)
+        with self.lock:
+            if Key in self.masters:
+                self.masters[Key] = self.masters.pop(Key)
+                image.logger.debug("Dark library: using cached master dark.")
+                if section:
+                    y1, y2, x1, x2 = section
+                    return self.masters[Key][y1:y2,x1:x2]
+                return self.masters[Key]
+        if Biases:
+            image.logger.info("Dark library: scaling {0} dark(s) of {1:.1f} s to {2:.1f} s using {3} bias frame(s).".format(len(Darks), DarkExptime, Exptime, len(Biases)))
+            Bias = self.Combine(Biases, section)
+            Master = self.Combine(Darks, section)
+            Master -= Bias
+            Master *= Exptime / DarkExptime
+            Master += Bias
+        else:
+            image.logger.info("Dark library: using {0} dark(s) of {1:.1f} s.".format(len(Darks), DarkExptime))
+            Master = self.Combine(Darks, section)
+        if section:
+            return Master
+        with self.lock:
+            self.masters[Key] = Master
+            while len(self.masters) > self.maxCached:
+                self.masters.popitem(last=False)
+        return Master
+
+
+##-----------------------------------------------------------------------------
+## Define CalibrationEngine object to bias, dark, and flat correct images
+##-----------------------------------------------------------------------------
+class CalibrationEngine(object):
+    '''
+    Bias, dark, and flat corrects images in place in float32.
+
+    The master bias, dark, and (median normalized) flat are read once as
+    float32 and kept.  darks may be a list of dark files (median combined)
+    or a DarkLibrary, in which case the master dark is chosen for each
+    image.  If a bias is given, a list of darks is assumed to be bias
+    subtracted, while darks from a DarkLibrary (which include the bias) have
+    the bias subtracted before they are applied.
+    If overscan (or tel.overscan) is set, the median of the overscan region
+    in each row is subtracted first.
+
+    Images are read with ReadFloat32 in to a buffer which is reused for the
+    next image of the same size processed by the same thread.  Frames with
+    more than chunkRows rows are corrected in chunks of rows on nThreads
+    threads.
+    '''
+    def __init__(self, bias=None, darks=None, flat=None, overscan=None,
+                 nThreads=4, chunkRows=512):
+        self.biasFiles = bias
+        self.darks = darks
+        self.flatFiles = flat
+        self.overscan = overscan
+        self.nThreads = nThreads
+        self.chunkRows = chunkRows
+        self.logger = logging.getLogger('IQMonLogger')
+        self.lock = threading.Lock()
+        self.buffers = threading.local()
+        self.pool = None
+        self.bias = None
+        self.dark = None
+        self.flat = None
+
+    def __repr__(self):
+        ## Stable description of the calibration inputs (used by ResultCache)
+        return "CalibrationEngine(bias={0}, darks={1}, flat={2}, overscan={3})".format(
+               self.biasFiles, repr(self.darks), self.flatFiles, self.overscan)
+
+    def Master(self, files):
+        if isinstance(files, str):
+            files = [files]
+        Data = [ReadFloat32(file)[0] for file in files]
+        if len(Data) == 1:
+            return Data[0]
+        return np.median(np.array(Data), axis=0).astype(np.float32)
+
+    def Prepare(self):
+        '''
+        Read the master bias, dark, and flat (once).
+        '''
+        with self.lock:
+            if self.biasFiles and self.bias is None:
+                self.bias = self.Master(self.biasFiles)
+            if self.darks and not isinstance(self.darks, DarkLibrary) and self.dark is None:
+                self.dark = self.Master(self.darks)
+            if self.flatFiles and self.flat is None:
+                Flat = self.Master(self.flatFiles)
+                if self.bias is not None:
+                    Flat -= self.bias
+                Flat /= np.median(Flat)
+                Flat[Flat <= 0] = 1.
+                self.flat = Flat
+            if self.nThreads > 1 and self.pool is None:
+                self.pool = ThreadPool(self.nThreads)
+
+    def Read(self, file):
+        '''
+        Read file in to this thread's buffer.
+        '''
+        Buffer = getattr(self.buffers, 'data', None)
+        Data, Header = ReadFloat32(file, out=Buffer)
+        self.buffers.data = Data
+        return Data, Header
+
+    def Apply(self, data, image=None):
+        '''
+        Calibrate data (a float32 array) in place.  image is used to choose
+        the dark from a DarkLibrary and for the overscan region from the
+        telescope.  Returns a list of the corrections applied.
+        '''
+        self.Prepare()
+        Dark = self.dark
+        if isinstance(self.darks, DarkLibrary) and image is not None:
+            Dark = self.darks.MasterDark(image)
+        Overscan = self.overscan
+        if not Overscan and image is not None:
+            Overscan = getattr(image.tel, 'overscan', None)
+        if Overscan:
+            Overscan = ParseRegion(Overscan)
+        for name, master in [('bias', self.bias), ('dark', Dark), ('flat', self.flat)]:
+            if master is not None and master.shape != data.shape:
+                raise ValueError("Master {0} shape {1} does not match image shape {2}".format(name, master.shape, data.shape))
+        ## Library darks include the bias, so subtracting one subtracts both
+        ## (without making a bias subtracted copy of the dark for each image)
+        DarkIncludesBias = isinstance(self.darks, DarkLibrary) and Dark is not None
+
+        def Correct(rows):
+            y1, y2 = rows
+            Chunk = data[y1:y2]
+            if Overscan:
+                ox1, ox2, oy1, oy2 = Overscan
+                Chunk -= np.median(data[y1:y2,ox1:ox2], axis=1)[:,None]
+            if self.bias is not None and not DarkIncludesBias:
+                Chunk -= self.bias[y1:y2]
+            if Dark is not None:
+                Chunk -= Dark[y1:y2]
+            if self.flat is not None:
+                Chunk /= self.flat[y1:y2]
+
+        nRows = data.shape[0]
+        Chunks = [(y1, min(y1+self.chunkRows, nRows)) for y1 in range(0, nRows, self.chunkRows)]
+        if self.pool and len(Chunks) > 1:
+            self.pool.map(Correct, Chunks)
+        else:
+            for rows in Chunks:
+                Correct(rows)
+        Applied = []
+        if Overscan: Applied.append('overscan')
+        if self.bias is not None: Applied.append('bias')
+        if Dark is not None: Applied.append('dark')
+        if self.flat is not None: Applied.append('flat')
+        return Applied
+
+    def MasterSection(self, files, y1, y2, nX, step=1):
+        '''
+        Read rows y1 to y2 of a master frame (median of files) as float32,
+        taking every step'th row and column.
+        '''
+        if isinstance(files, str):
+            files = [files]
+        Sections = []
+        for file in files:
+            hdulist = fits.open(file, memmap=False, ignore_missing_end=True)
+            hdu = hdulist[FindImageHDU(hdulist)[0]]
+            if step > 1:
+                Section = [ReadSection(hdu, y, y+1, 0, nX)[0,::step] for y in range(y1, y2, step)]
+            else:
+                Section = ReadSection(hdu, y1, y2, 0, nX)
+            Sections.append(np.asarray(Section, dtype=np.float32))
+            hdulist.close()
+        if len(Sections) == 1:
+            return Sections[0]
+        return np.median(np.array(Sections), axis=0).astype(np.float32)
+
+    def Stream(self, sourceFile, outputFile, image=None, memoryBudget=256*1024**2):
+        '''
+        Calibrate sourceFile in to outputFile one strip of rows at a time, so
+        that neither the image nor the master frames are ever in memory in
+        full.  The same corrections are applied as by Apply, with the master
+        dark from a DarkLibrary combined (and scaled) strip by strip.
+        Returns a list of the corrections applied.
+        '''
+        hdulist = fits.open(sourceFile, memmap=False, ignore_missing_end=True)
+        hdu = hdulist[FindImageHDU(hdulist)[0]]
+        nY = hdu.header['NAXIS2']
+        nX = hdu.header['NAXIS1']
+        Header = hdu.header.copy()
+        for keyword in ['BZERO', 'BSCALE', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME',
+                        'ZIMAGE', 'ZBITPIX', 'ZNAXIS', 'ZNAXIS1', 'ZNAXIS2', 'ZCMPTYPE']:
+            if keyword in Header: del Header[keyword]
+        Header['BITPIX'] = -32
+        DarkFiles, BiasFiles, DarkScale = self.darks, self.biasFiles, None
+        Library = isinstance(self.darks, DarkLibrary)
+        if Library:
+            Match = self.darks.Match(image) if image is not None else None
+            DarkFiles = None
+            if Match:
+                DarkFiles, LibraryBiases, DarkExptime = Match
+                if LibraryBiases:
+                    ## Scaled dark: (dark - bias)*scale + bias
+                    BiasFiles = BiasFiles or LibraryBiases
+                    DarkScale = float(Header.get('EXPTIME')) / DarkExptime
+        FlatNorm = None
+        if self.flatFiles:
+            ## Normalize the flat by the median of a decimated copy
+            Decimated = self.MasterSection(self.flatFiles, 0, nY, nX, step=8)
+            if self.biasFiles:
+                Decimated -= self.MasterSection(self.biasFiles, 0, nY, nX, step=8)
+            FlatNorm = float(np.median(Decimated))
+        Overscan = self.overscan
+        if not Overscan and image is not None:
+            Overscan = getattr(image.tel, 'overscan', None)
+        if Overscan:
+            Overscan = ParseRegion(Overscan)
+        ## MasterSection holds a strip of each file to median combine them
+        nFiles = max([len([files] if isinstance(files, str) else files)
+                      for files in [DarkFiles, BiasFiles, self.flatFiles] if files] or [1])
+        Applied = []
+        if os.path.exists(outputFile): os.remove(outputFile)
+        Output = fits.StreamingHDU(outputFile, Header)
+        for y1, y2 in Strips(nY, StripRows(nX, memoryBudget, copies=5 + 2*nFiles)):
+            Strip = np.asarray(ReadSection(hdu, y1, y2, 0, nX), dtype=np.float32)
+            Applied = []
+            if Overscan:
+                Strip -= np.median(Strip[:,Overscan[0]:Overscan[1]], axis=1)[:,None]
+                Applied.append('overscan')
+            Bias = self.MasterSection(BiasFiles, y1, y2, nX) if BiasFiles else None
+            if Bias is not None and self.biasFiles:
+                Strip -= Bias
+                Applied.append('bias')
+            if DarkFiles:
+                Dark = self.MasterSection(DarkFiles, y1, y2, nX)
+                if DarkScale is not None or (Library and Bias is not None and self.biasFiles):
+                    ## Library darks include the bias: (dark - bias)*scale,
+                    ## plus the bias if it was not subtracted already
+                    Dark -= Bias
+                    if DarkScale is not None:
+                        Dark *= DarkScale
+                    if not self.biasFiles:
+                        Dark += Bias
+                Strip -= Dark
+                Applied.append('dark')
+            if FlatNorm:
+                Flat = self.MasterSection(self.flatFiles, y1, y2, nX)
+                if Bias is not None and self.biasFiles:
+                    Flat -= Bias
+                Flat /= FlatNorm
+                Flat[Flat <= 0] = 1.
+                Strip /= Flat
+                Applied.append('flat')
+            Output.write(Strip.astype('>f4'))
+        Output.close()
+        hdulist.close()
+        return Applied
+
+    def Close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+##-----------------------------------------------------------------------------
+## Report Columns and Static Report Page
+##-----------------------------------------------------------------------------
+## Columns of the per night report shards (see Image.AddReportEntry) and their
+## headings on the report page.  The flag columns hold 'ok' or 'bad' for the
+## values compared to the telescope thresholds.
+ReportColumns = [('date', 'Exposure Start (UT)'), ('file', 'Image File Name'),
+                 ('jpegs', None), ('target', 'Target'), ('exptime', 'Exp Time (s)'),
+                 ('alt', 'Alt (deg)'), ('az', 'Az (deg)'), ('airmass', 'Airmass'),
+                 ('moonSep', 'Moon Sep (deg)'), ('moonIllum', 'Moon Illum. (%)'),
+                 ('FWHM', 'FWHM'), ('ellipticity', 'Ellip.'),
+                 ('background', 'Background'), ('backgroundRMS', 'RMS'),
+                 ('pointingError', 'Pointing Error (arcmin)'),
+                 ('positionAngle', 'WCS Pos. Angle'), ('zeroPoint', 'Zero Point (mag)'),
+                 ('nStars', 'N Stars'), ('processTime', 'Process Time (sec)'),
+                 ('flagFWHM', None), ('flagEllipticity', None),
+                 ('flagPointingError', None)]
+
+ReportPage = r"""<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta http-equiv="Content-Type" content="text/html; charset=utf-8">
+    <title>IQMon Results</title>
+    <style>
+        body { font-family: sans-serif; }
+        #nights { margin-bottom: 8px; }
+        #view { height: 80vh; overflow-y: auto; position: relative; border: 1px solid black; }
+        #spacer { position: relative; }
+        table { border-collapse: collapse; position: absolute; top: 0; table-layout: fixed; }
+        th, td { border: 1px solid black; text-align: center; height: 21px; padding: 0 4px; white-space: nowrap; overflow: hidden; }
+        th { position: sticky; top: 0; background: white; }
+        td.left { text-align: left; }
+        td.ok { background-color: #70DB70; }
+        td.bad { background-color: #FF5C33; }
+    </style>
+</head>
+<body>
+    <h2>IQMon Results for TITLE</h2>
+    <div id="nights">Night: <select id="night"></select> <span id="count"></span></div>
+    <div id="view"><div id="spacer"><table id="table"><thead id="head"></thead><tbody id="body"></tbody></table></div></div>
+    <script>
+    var Columns = COLUMNS;
+    var FlagColumns = {FWHM: 'flagFWHM', ellipticity: 'flagEllipticity', pointingError: 'flagPointingError'};
+    var Digits = {exptime: 1, alt: 1, az: 1, airmass: 2, moonSep: 1, moonIllum: 1, FWHM: 2, ellipticity: 2,
+                  background: 0, backgroundRMS: 0, pointingError: 1, positionAngle: 1, zeroPoint: 2, processTime: 1};
+    var RowHeight = 22, Buffer = 20, Rows = [];
+    var View = document.getElementById('view');
+
+    function ParseCSV(text) {
+        // Split in to records and fields, allowing for quoted fields (as
+        // written by python's csv module) with commas, quotes, or newlines
+        var Records = [], Record = [], Field = '', Quoted = false;
+        for (var i = 0; i < text.length; i++) {
+            var Character = text.charAt(i);
+            if (Quoted) {
+                if (Character === '"' && text.charAt(i + 1) === '"') { Field += '"'; i++; }
+                else if (Character === '"') { Quoted = false; }
+                else { Field += Character; }
+            } else if (Character === '"') {
+                Quoted = true;
+            } else if (Character === ',') {
+                Record.push(Field); Field = '';
+            } else if (Character === '\n' || Character === '\r') {
+                if (Character === '\r' && text.charAt(i + 1) === '\n') { i++; }
+                Record.push(Field); Field = '';
+                Records.push(Record); Record = [];
+            } else {
+                Field += Character;
+            }
+        }
+        if (Field.length > 0 || Record.length > 0) { Record.push(Field); Records.push(Record); }
+        Records = Records.filter(function(record) { return record.length > 1 || record[0] !== ''; });
+        var Names = Records[0];
+        return Records.slice(1).map(function(values) {
+            var Row = {};
+            Names.forEach(function(name, i) { Row[name] = values[i] === '' || values[i] === undefined ? null : values[i]; });
+            Row.jpegs = Row.jpegs ? Row.jpegs.split(';') : [];
+            return Row;
+        });
+    }
+
+    function Cell(row, name) {
+        var Value = row[name], Class = '';
+        if (name === 'file') {
+            var Links = (row.jpegs || []).map(function(jpeg, i) {
+                return i === 0 ? '<a href="' + jpeg + '">' + Value + '</a>' : ' (<a href="' + jpeg + '">JPEG' + (i + 1) + '</a>)';
+            });
+            return '<td class="left">' + (Links.length ? Links.join('') : Value) + '</td>';
+        }
+        if (Value !== null && Value !== undefined && name in Digits) {
+            Value = Number(Value).toFixed(Digits[name]);
+        }
+        if (name in FlagColumns) {
+            Class = row[FlagColumns[name]] || 'bad';
+        }
+        if (name === 'date') { Class = 'left'; }
+        return '<td class="' + Class + '">' + (Value === null || Value === undefined ? '' : Value) + '</td>';
+    }
+
+    function Render() {
+        var First = Math.max(0, Math.floor(View.scrollTop / RowHeight) - Buffer);
+        var Last = Math.min(Rows.length, Math.ceil((View.scrollTop + View.clientHeight) / RowHeight) + Buffer);
+        var Html = [];
+        for (var i = First; i < Last; i++) {
+            Html.push('<tr>' + Columns.map(function(column) { return Cell(Rows[i], column[0]); }).join('') + '</tr>');
+        }
+        document.getElementById('table').style.top = (First * RowHeight) + 'px';
+        document.getElementById('body').innerHTML = Html.join('');
+    }
+
+    function Load(shard) {
+        fetch(shard + '?' + Date.now()).then(function(response) { return response.text(); }).then(function(text) {
+            Rows = /\.csv$/.test(shard) ? ParseCSV(text) : JSON.parse(text);
+            Rows.reverse();
+            document.getElementById('spacer').style.height = ((Rows.length + 1) * RowHeight) + 'px';
+            document.getElementById('count').textContent = Rows.length + ' images';
+            View.scrollTop = 0;
+            Render();
+        });
+    }
+
+    document.getElementById('head').innerHTML = '<tr>' + Columns.map(function(column) { return '<th>' + column[1] + '</th>'; }).join('') + '</tr>';
+    View.addEventListener('scroll', function() { window.requestAnimationFrame(Render); });
+    fetch('index.json?' + Date.now()).then(function(response) { return response.json(); }).then(function(index) {
+        var Select = document.getElementById('night');
+        index.nights.slice().reverse().forEach(function(night) {
+            var Option = document.createElement('option');
+            Option.value = night.shard;
+            Option.textContent = night.night + ' (' + night.nImages + ')';
+            Select.appendChild(Option);
+        });
+        Select.addEventListener('change', function() { Load(Select.value); });
+        if (Select.value) { Load(Select.value); }
+    });
+    </script>
+</body>
+</html>
+"""
+
+
+##-----------------------------------------------------------------------------
+## Define Image object which holds information and methods for analysis
+##-----------------------------------------------------------------------------
+class Image(object):
+    '''
+    The IQMon.Image object represents a single input image to the IQMon
+    process.
+
+    When defined, the image objects requires both a filename to a valid fits
+    file and an IQMon.Config object.
+
+    Properties:
+
+    Methods:
+    '''
+    def __init__(self, input, tel=None, config=None):
+        self.startProcessTime = time.time()
+        if os.path.exists(input):
+            FitsFileDirectory, FitsFilename = os.path.split(input)
+            self.rawFile = input
+            self.rawFileName = FitsFilename
+            self.rawFileDirectory = FitsFileDirectory
+            self.rawFileBasename, self.fileExt = os.path.splitext(FitsFilename)
+            ## For compressed files (i.e. image.fits.fz or image.fits.gz), the
+            ## uncompressed working file will have a .fits extension.
+            if self.fileExt in ['.fz', '.gz']:
+                self.rawFileBasename = os.path.splitext(self.rawFileBasename)[0]
+                self.fileExt = ".fits"
+        else:
+            self.rawFile = None
+            self.rawFileName = None
+            self.rawFileDirectory = None
             raise IOError("File {0} does not exist".format(input))
         ## Confirm that input tel is an IQMon.Telescope object
         if tel:
-            assert type(tel) == Telescope
+            assert isinstance(tel, Telescope)
             self.tel = tel
         ## Confirm that input config is an IQMon.Config object
         if config:
-            assert type(config) == Config
+            assert isinstance(config, Config)
             self.config = config
         ## Initialize values to None
         self.logger = None
+        self.logFile = None
         self.workingFile = None
+        self.fullFrameFile = None
+        self.compression = None
+        self.imageExtension = None
+        self.ROI = None
         self.header = None
         self.exptime = None
         self.filter = None
@@ -313,17 +1888,86 @@ class Image(object):
         self.SExBackground = None
         self.SExBRMS = None
         self.tempFiles = []
+        self.workspace = None
         self.SExtractorResults = None
         self.nStarsSEx = None
         self.positionAngle = None
         self.zeroPoint = None
         self.processTime = None
+        self.stageTimes = {}
+        self.stageFinished = {}
+        self.cacheKey = None
+        self.cachedStages = []
+        self.chip = None
+        self.skippedStages = []
+        self.triagedStages = []
+        self.failedStages = []
         self.FWHM = None
         self.ellipticity = None
+        self.PSFMap = None
+        self.quickLook = None
+        self.tracking = None
+        self.drift = None
+        self.triage = None
+        self.triageReason = None
+        self.analyzable = None
         self.pointingError = None
         self.imageFlipped = None
         self.jpegFileNames = []
         self.CheckImageFile = None
+        self.backgroundGrid = None
+        self.SExtractorColumns = None
+
+    ##-------------------------------------------------------------------------
+    ## Use Image as a Context Manager
+    ##-------------------------------------------------------------------------
+    def __enter__(self):
+        self.MakeWorkspace()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        '''
+        Delete the workspace and release the log file even if a step failed.
+        '''
+        if self.logger:
+            if exc_type:
+                self.logger.error("Processing failed: {0} {1}".format(exc_type, exc_value))
+            self.CleanUp()
+            self.CloseLogger()
+        elif self.workspace:
+            shutil.rmtree(self.workspace, ignore_errors=True)
+            self.workspace = None
+        return False
+
+
+    ##-------------------------------------------------------------------------
+    ## Make Scratch Workspace
+    ##-------------------------------------------------------------------------
+    def MakeWorkspace(self):
+        '''
+        Create a scratch directory for this image's intermediate files in
+        config.pathScratch (or config.pathTemp if that is not set).  Each
+        image gets a uniquely named directory, so images with the same file
+        name or images processed in parallel do not overwrite each other's
+        files.  The directory is deleted by CleanUp.  Returns the path.
+        '''
+        if not self.workspace:
+            ScratchPath = getattr(self.config, 'pathScratch', None) or self.config.pathTemp
+            if not os.path.exists(ScratchPath):
+                os.makedirs(ScratchPath)
+            self.workspace = tempfile.mkdtemp(prefix=self.rawFileBasename+"_", dir=ScratchPath)
+        return self.workspace
+
+
+    ##-------------------------------------------------------------------------
+    ## Path to a File in the Scratch Workspace
+    ##-------------------------------------------------------------------------
+    def WorkspaceFile(self, filename):
+        '''
+        Return the path to filename in the image's scratch workspace.
+        '''
+        return os.path.join(self.MakeWorkspace(), filename)
+
 
     ##-------------------------------------------------------------------------
     ## Make Logger Object
@@ -334,21 +1978,38 @@ class Image(object):
         full path to the file to write the log to and verboase, a boolean value
         which will increase the verbosity of the concole log (the file log will
         always be at debug level).
+
+        Log records are written by a background thread (see LogWriter), so
+        the log file is shared by all images in the process which log to the
+        same file.  Call CloseLogger when done with the image.
         '''
-        self.logger = logging.getLogger('IQMonLogger')
-        self.logger.setLevel(logging.DEBUG)
-        LogFileHandler = logging.FileHandler(IQMonLogFileName)
-        LogFileHandler.setLevel(logging.DEBUG)
-        LogConsoleHandler = logging.StreamHandler()
+        Writer = GetLogWriter()
+        Logger = logging.getLogger('IQMonLogger')
+        Logger.setLevel(logging.DEBUG)
+        if not [handler for handler in Logger.handlers if isinstance(handler, LogQueueHandler)]:
+            Logger.addHandler(LogQueueHandler(Writer))
         if verbose:
-            LogConsoleHandler.setLevel(logging.DEBUG)
+            Writer.consoleHandler.setLevel(logging.DEBUG)
         else:
-            LogConsoleHandler.setLevel(logging.INFO)
-        LogFormat = logging.Formatter('%(asctime)23s %(levelname)8s: %(message)s')
-        LogFileHandler.setFormatter(LogFormat)
-        LogConsoleHandler.setFormatter(LogFormat)
-        self.logger.addHandler(LogConsoleHandler)
-        self.logger.addHandler(LogFileHandler)
+            Writer.consoleHandler.setLevel(logging.INFO)
+        self.CloseLogger()
+        self.logFile = os.path.abspath(IQMonLogFileName)
+        Writer.OpenFile(self.logFile)
+        self.logger = logging.LoggerAdapter(Logger, {'logFile': self.logFile,
+                                                     'image': self.rawFileName})
+
+
+    ##-------------------------------------------------------------------------
+    ## Close Logger
+    ##-------------------------------------------------------------------------
+    def CloseLogger(self):
+        '''
+        Write any queued log records and release this image's reference to
+        its log file.
+        '''
+        if self.logFile:
+            GetLogWriter().CloseFile(self.logFile)
+            self.logFile = None
 
 
     ##-------------------------------------------------------------------------
@@ -359,8 +2020,8 @@ class Image(object):
         Get information from the image fits header.
         '''
         hdulist = fits.open(self.workingFile, ignore_missing_end=True)
-        self.header = hdulist[0].header
-        self.image = hdulist[0].data
+        ImageHDU, Compressed = FindImageHDU(hdulist)
+        self.header = hdulist[ImageHDU].header
         hdulist.close()
         self.logger.info("Reading image header.")
         
@@ -439,8 +2100,10 @@ class Image(object):
             self.logger.debug("Header altitude = {0:.0f} meters".format(self.altitude.to(u.meter).value))
 
 
-        ## Determine Image Size in Pixels
-        self.nYPix, self.nXPix = self.image.shape
+        ## Determine Image Size in Pixels (from header so that compressed
+        ## data is not decompressed here)
+        self.nYPix = self.header['NAXIS2']
+        self.nXPix = self.header['NAXIS1']
 
         ## Read Header Coordinates in to astropy coordinates object
         ImageRA  = self.header['RA']
@@ -521,16 +2184,22 @@ class Image(object):
 
         ## Determine Alt, Az, Moon Sep, Moon Illum using ephem module
         if self.dateObs and self.latitude and self.longitude:
-            ## Populate site object properties
+            ## Populate site object properties (on a copy of the telescope
+            ## site, which is shared by all images from the telescope)
             SiteDate = "/".join(self.dateObs[0:10].split("-"))
             SiteTime = self.dateObs[11:]        
-            self.tel.site.date = ephem.Date(SiteDate+" "+SiteTime)
-            self.tel.site.lat = str(self.latitude.to(u.deg).value)
-            self.tel.site.lon = str(self.longitude.to(u.deg).value)
-            if self.altitude: self.tel.site.elevation = self.altitude.to(u.meter).value
+            Site = ephem.Observer()
+            if self.tel.site:
+                Site.elevation = self.tel.site.elevation
+                Site.pressure = self.tel.site.pressure
+                Site.temp = self.tel.site.temp
+            Site.date = ephem.Date(SiteDate+" "+SiteTime)
+            Site.lat = str(self.latitude.to(u.deg).value)
+            Site.lon = str(self.longitude.to(u.deg).value)
+            if self.altitude: Site.elevation = self.altitude.to(u.meter).value
             ## Do calculations using ephem
             TargetObject = ephem.readdb("Target,f|M|F7,"+ImageRA+","+ImageDEC+",2.02,2000")
-            TargetObject.compute(self.tel.site)
+            TargetObject.compute(Site)
             self.targetAlt = TargetObject.alt * 180./ephem.pi * u.deg
             self.targetAz = TargetObject.az * 180./ephem.pi * u.deg
             self.logger.debug("Target Alt, Az = {0:.1f}, {1:.1f}".format(self.targetAlt.to(u.deg).value, self.targetAz.to(u.deg).value))
@@ -539,7 +2208,7 @@ class Image(object):
             self.logger.debug("Target airmass (calculated) = {0:.2f}".format(self.airmass))
             ## Calculate Moon Position and Illumination
             TheMoon = ephem.Moon()
-            TheMoon.compute(self.tel.site)
+            TheMoon.compute(Site)
             self.moonPhase = TheMoon.phase
             self.moonSep = ephem.separation(TargetObject, TheMoon) * 180./ephem.pi * u.deg
             self.moonAlt = TheMoon.alt * 180./ephem.pi * u.deg
@@ -565,12 +2234,188 @@ class Image(object):
         
         - For the moment, this only copies a fits file from the original
           location to the IQMon tmp directory.
+        - Tile compressed (fpack) or gzip compressed files and files where the
+          image is not in the primary HDU are not copied.  They are read in
+          place and an uncompressed working file is only written when a step
+          which needs one (an external tool or an edit of the working file) is
+          run.  See UncompressWorkingFile.
         - Later implement file format conversion from CRW, CR2, DNG, etc to
           fits using dcraw.
         '''
-        self.workingFile = os.path.join(self.config.pathTemp, self.rawFileName)
-        shutil.copy2(self.rawFile, self.workingFile)
-        self.tempFiles.append(self.workingFile)
+        hdulist = fits.open(self.rawFile, ignore_missing_end=True)
+        self.imageExtension, TileCompressed = FindImageHDU(hdulist)
+        hdulist.close()
+        if IsGzipped(self.rawFile):
+            self.compression = "gzip"
+        elif TileCompressed:
+            self.compression = "tile"
+        if self.compression or self.imageExtension != 0:
+            self.logger.debug("Image is in HDU {0} (compression: {1}).  Reading in place.".format(self.imageExtension, self.compression))
+            self.workingFile = self.rawFile
+        else:
+            self.workingFile = self.WorkspaceFile(self.rawFileName)
+            shutil.copy2(self.rawFile, self.workingFile)
+
+
+    ##-------------------------------------------------------------------------
+    ## Write Uncompressed Copy of Image
+    ##-------------------------------------------------------------------------
+    def Uncompressed(self, file):
+        '''
+        Return the path to an uncompressed, single HDU version of file.  If
+        the file is already a plain fits file with the image in the primary
+        HDU, the file itself is returned.  Otherwise the image HDU is
+        decompressed and written to the IQMon temporary directory one strip
+        of rows at a time (within config.memoryBudget, or 64 MB), so the
+        whole image is never in memory.  Integer images keep their type;
+        scaled images are written as float32.
+        '''
+        hdulist = fits.open(file, ignore_missing_end=True)
+        ImageHDU, TileCompressed = FindImageHDU(hdulist)
+        if not TileCompressed and ImageHDU == 0 and not IsGzipped(file):
+            hdulist.close()
+            return file
+        UncompressedFile = self.WorkspaceFile(self.rawFileBasename+".fits")
+        if os.path.abspath(UncompressedFile) == os.path.abspath(file):
+            UncompressedFile = self.WorkspaceFile(self.rawFileBasename+"_uncompressed.fits")
+        self.logger.debug("Writing uncompressed copy of image: {0}".format(UncompressedFile))
+        HDU = hdulist[ImageHDU]
+        Header = HDU.header.copy()
+        for keyword in ['SIMPLE', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME']:
+            if keyword in Header: del Header[keyword]
+        Header.insert(0, ('SIMPLE', True))
+        nY = Header['NAXIS2']
+        nX = Header['NAXIS1']
+        BZero = Header.get('BZERO', 0)
+        if Header['BITPIX'] > 0 and Header.get('BSCALE', 1) == 1 and BZero == int(BZero):
+            ## Sections are returned with BZERO applied, which is removed
+            ## again to write the stored integers
+            DataType = np.dtype('>u1') if Header['BITPIX'] == 8 else np.dtype('>i{0}'.format(Header['BITPIX'] // 8))
+        else:
+            DataType = np.dtype('>f4')
+            BZero = 0
+            Header['BITPIX'] = -32
+            for keyword in ['BZERO', 'BSCALE']:
+                if keyword in Header: del Header[keyword]
+        MemoryBudget = getattr(self.config, 'memoryBudget', None) or 64*1024**2
+        if os.path.exists(UncompressedFile): os.remove(UncompressedFile)
+        Output = fits.StreamingHDU(UncompressedFile, Header)
+        for y1, y2 in Strips(nY, StripRows(nX, MemoryBudget, copies=3)):
+            Strip = ReadSection(HDU, y1, y2, 0, nX)
+            if BZero:
+                Strip = np.asarray(Strip, dtype=np.float64) - BZero
+            Output.write(np.asarray(Strip).astype(DataType))
+        Output.close()
+        hdulist.close()
+        return UncompressedFile
+
+
+    ##-------------------------------------------------------------------------
+    ## Make Sure Working File is Uncompressed
+    ##-------------------------------------------------------------------------
+    def UncompressWorkingFile(self):
+        '''
+        Replace a compressed (or multi extension) working file with an
+        uncompressed copy.  This is called by any step which runs an external
+        tool on the working file or edits it.
+        '''
+        if self.workingFile and (self.compression or self.imageExtension):
+            self.workingFile = self.Uncompressed(self.workingFile)
+            self.compression = None
+            self.imageExtension = 0
+
+
+    ##-------------------------------------------------------------------------
+    ## Triage Image Before Expensive Analysis
+    ##-------------------------------------------------------------------------
+    def Triage(self, decimation=8, nSigma=5., minPeaks=3, maxSaturatedFraction=0.05):
+        '''
+        Decide cheaply whether the image is worth analyzing, so that frames
+        taken with the dome closed, through thick clouds, or which are
+        heavily saturated do not go through the expensive steps.
+
+        The image is read a strip at a time.  The background (median), noise
+        (scaled median absolute deviation, or the standard deviation if that
+        is zero), and fraction of saturated pixels (if
+        tel.SExtractorSaturation is set) are determined from every
+        decimation-th pixel in each direction.  The number of peaks (local
+        maxima more than nSigma times the noise above background) is counted
+        in the image reduced to the maximum of each decimation x decimation
+        block (see BlockMax), so that stars whose cores fall between the
+        sampled pixels are not missed.  The image is uncalibrated, so a peak
+        has to be at least two adjacent pixels above the threshold (see
+        PairMinimum) so that hot pixels and cosmic rays are not counted.  The
+        number of peaks is a proxy for the number of stars, not an estimate
+        of it.
+
+        Every pixel is read (no more than 64 MB at a time), so the cost of
+        Triage is one read of the image plus a few passes of numpy over it,
+        which is small next to SExtractor but not next to reading a header.
+        For tile compressed images, most of that is decompression.
+
+        The results are stored in self.triage and the image is classified by
+        setting self.analyzable and self.triageReason, which is one of:
+          'OK':         image should be analyzed
+          'BLANK':      image has no noise (i.e. constant value)
+          'SATURATED':  more than maxSaturatedFraction of pixels saturated
+          'NOSTARS':    fewer than minPeaks peaks found
+        ProcessImage skips the expensive stages (see TriagedStages) for
+        images which are not analyzable.
+        '''
+        if self.workingFile:
+            SourceFile = self.workingFile
+        else:
+            SourceFile = self.rawFile
+        hdulist = fits.open(SourceFile, memmap=False, ignore_missing_end=True)
+        ImageHDU = hdulist[FindImageHDU(hdulist)[0]]
+        nY = ImageHDU.header['NAXIS2']
+        nX = ImageHDU.header['NAXIS1']
+        Sampled = []
+        Maxima = []
+        for y1, y2 in Strips(nY - nY % decimation, StripRows(nX, 64*1024**2, copies=6, multiple=decimation)):
+            Strip = ReadSection(ImageHDU, y1, y2, 0, nX)
+            Sampled.append(np.asarray(Strip[::decimation,::decimation], dtype=np.float32))
+            Maxima.append(BlockMax(PairMinimum(Strip), decimation))
+        hdulist.close()
+        Decimated = np.concatenate(Sampled)
+        Maxima = np.concatenate(Maxima)
+
+        Background = float(np.median(Decimated))
+        Noise = 1.4826 * float(np.median(np.abs(Decimated - Background)))
+        if Noise == 0:
+            Noise = float(np.std(Decimated))
+        if self.tel.SExtractorSaturation:
+            SaturatedFraction = float(np.mean(Decimated >= self.tel.SExtractorSaturation.to(u.adu).value))
+        else:
+            SaturatedFraction = None
+        ## Count local maxima above threshold (compare each pixel to its four
+        ## neighbors)
+        Center = Maxima[1:-1,1:-1]
+        Peaks = (Center > Background + nSigma*Noise) &\
+                (Center >= Maxima[:-2,1:-1]) & (Center >= Maxima[2:,1:-1]) &\
+                (Center >= Maxima[1:-1,:-2]) & (Center >= Maxima[1:-1,2:])
+        nPeaks = int(Peaks.sum())
+        self.triage = {'background': Background,
+                       'noise': Noise,
+                       'saturatedFraction': SaturatedFraction,
+                       'nPeaks': nPeaks,
+                       'decimation': decimation}
+
+        if np.ptp(Decimated) == 0:
+            self.triageReason = 'BLANK'
+        elif SaturatedFraction is not None and SaturatedFraction > maxSaturatedFraction:
+            self.triageReason = 'SATURATED'
+        elif nPeaks < minPeaks:
+            self.triageReason = 'NOSTARS'
+        else:
+            self.triageReason = 'OK'
+        self.analyzable = (self.triageReason == 'OK')
+        self.logger.info("Triage: background = {0:.1f}, noise = {1:.1f}, {2} peaks: {3}".format(Background, Noise, nPeaks, self.triageReason))
+        if SaturatedFraction is not None:
+            self.logger.debug("Triage: saturated fraction = {0:.4f}".format(SaturatedFraction))
+        if not self.analyzable:
+            self.logger.warning("Image failed triage ({0}).  Skipping expensive analysis steps.".format(self.triageReason))
+
 
     ##-------------------------------------------------------------------------
     ## Dark Subtract Image
@@ -580,47 +2425,97 @@ class Image(object):
         Create master dark and subtract from image.
         
         Input the filename of the appropriate master dark.  May want to write
-        own function to make the master dark given input file data.
+        own function to make the master dark given input file data.  Darks
+        may also be a DarkLibrary, which picks the master dark.
+
+        The image and dark are read as float32 (see ReadFloat32) and the dark
+        is subtracted in place, so the working file is written as float32.
         '''
-        self.logger.debug("Dark subtracting image.  Opening image data.")
-        hdulist_image = fits.open(self.workingFile, mode='update')
+        if isinstance(Darks, DarkLibrary):
+            MasterDarkData = Darks.MasterDark(self)
+            if MasterDarkData is None:
+                self.logger.warning("Image will not be dark subtracted.")
+                return
         ## Load master dark if provided, but if multiple files input, combine
         ## them in to master dark, then load combined master dark.
-        if len(Darks) == 1:
+        elif len(Darks) == 1:
             self.logger.debug("Found master dark.  Opening master dark data.")
-            hdulist_dark = fits.open(Darks[0])
-            MasterDarkData = hdulist_dark[0].data
+            MasterDarkData = ReadFloat32(Darks[0])[0]
         elif len(Darks) > 1:
             self.logger.info("Multiple input darks detected.  Median combining {0} darks.".format(len(Darks)))
             ## Combine multiple darks frames
             DarkData = []
             for Dark in Darks:
-                hdulist = fits.open(Dark)
-                DarkData.append(hdulist[0].data)
-            DarkData = np.array(DarkData)
-            MasterDarkData = np.median(DarkData, axis=0)
+                Data, DarkHeader = ReadFloat32(Dark)
+                DarkData.append(Data)
+            MasterDarkData = np.median(np.array(DarkData), axis=0).astype(np.float32)
             ## Save Master Dark to Fits File
             DataPath = os.path.split(self.rawFile)[0]
             DataNightString = os.path.split(DataPath)[1]
             MasterDarkFilename = "MasterDark_"+self.tel.name+"_"+DataNightString+"_"+str(int(math.floor(self.exptime.to(u.s).value)))+".fits"
-            MasterDarkFile  = os.path.join(self.config.pathTemp, MasterDarkFilename)    
-            hdu_MasterDark = fits.PrimaryHDU(MasterDarkData)
-            hdulist_MasterDark = fits.HDUList([hdu_MasterDark])
-            hdulist_MasterDark.header = hdulist[0].header
-            hdulist_MasterDark.header['history'] = "Combined {0} images to make this master dark.".format(len(Darks))
+            MasterDarkFile = self.WorkspaceFile(MasterDarkFilename)
+            DarkHeader['history'] = "Combined {0} images to make this master dark.".format(len(Darks))
             self.logger.info("Writing master dark file: {0}".format(MasterDarkFile))
-            hdulist_MasterDark.writeto(MasterDarkFile)
+            if os.path.exists(MasterDarkFile): os.remove(MasterDarkFile)
+            fits.PrimaryHDU(MasterDarkData, DarkHeader).writeto(MasterDarkFile)
         else:
             self.logger.error("No input dark files detected.")
+            return
         ## Now Subtract MasterDark from Image
+        self.UncompressWorkingFile()
+        self.logger.debug("Dark subtracting image.  Opening image data.")
+        ImageData, Header = ReadFloat32(self.workingFile)
         self.logger.info("Subtracting dark from image.")
-        ImageData = hdulist_image[0].data
-        DifferenceImage = ImageData - MasterDarkData
-        hdulist_image[0].data = DifferenceImage
-        hdulist_image.flush()
-#         self.logger.debug("Median level of image = {0}".format(np.median(ImageData)))
-#         self.logger.debug("Median level of dark = {0}".format(np.median(MasterDarkData)))
-#         self.logger.debug("Median level of dark subtracted = {0}".format(np.median(DifferenceImage)))
+        ImageData -= MasterDarkData
+        Header['history'] = "Dark subtracted by IQMon."
+        os.remove(self.workingFile)
+        fits.PrimaryHDU(ImageData, Header).writeto(self.workingFile)
+
+
+    ##-------------------------------------------------------------------------
+    ## Bias, Dark, and Flat Correct Image
+    ##-------------------------------------------------------------------------
+    def Calibrate(self, engine=None, Darks=None, memoryBudget=None):
+        '''
+        Bias, dark, and flat correct the image using a CalibrationEngine (or,
+        if engine is not given, dark subtract it using Darks) and write the
+        result to a new float32 working file.  The uncalibrated working file
+        is kept in self.fullFrameFile for full frame jpegs.
+
+        If memoryBudget (default config.memoryBudget) is set and the image
+        is larger than a quarter of it, the image is calibrated one strip of
+        rows at a time (see CalibrationEngine.Stream).
+        '''
+        if engine is None:
+            if not Darks:
+                self.logger.warning("No calibration frames.  Image will not be calibrated.")
+                return
+            engine = CalibrationEngine(darks=Darks, nThreads=1)
+        if self.workingFile:
+            SourceFile = self.workingFile
+        else:
+            SourceFile = self.rawFile
+        CalibratedFile = self.WorkspaceFile(self.rawFileBasename+"_cal.fits")
+        if memoryBudget is None:
+            memoryBudget = getattr(self.config, 'memoryBudget', None)
+        if memoryBudget and self.nXPix and 4*self.nXPix*self.nYPix > memoryBudget/4:
+            self.logger.info("Calibrating image in strips (memory budget {0:.0f} MB).".format(memoryBudget/1024**2))
+            Applied = engine.Stream(SourceFile, CalibratedFile, self, memoryBudget)
+        else:
+            ImageData, Header = engine.Read(SourceFile)
+            Applied = engine.Apply(ImageData, self)
+            if Applied:
+                Header['history'] = "Calibrated by IQMon ({0}).".format(", ".join(Applied))
+                if os.path.exists(CalibratedFile): os.remove(CalibratedFile)
+                fits.PrimaryHDU(ImageData, Header).writeto(CalibratedFile)
+        if not Applied:
+            self.logger.warning("No calibration frames applied.")
+            return
+        self.logger.info("Calibrated image ({0}).".format(", ".join(Applied)))
+        self.fullFrameFile = SourceFile
+        self.workingFile = CalibratedFile
+        self.compression = None
+        self.imageExtension = 0
 
 
     ##-------------------------------------------------------------------------
@@ -630,22 +2525,105 @@ class Image(object):
         '''
         Crop working image to region of interest.
         '''
-        if self.tel.ROI:
-            ## Parse ROI String
-            try:
-                MatchROI = re.match("\[?(\d{1,5}):(\d{1,5}),(\d{1,5}):(\d{1,5})\]?", self.tel.ROI)
-            except:
+        ROI = self.ParseROI()
+        if ROI:
+            x1, x2, y1, y2 = ROI
+            self.logger.info("Cropping Image To [{0}:{1},{2}:{3}]".format(x1, x2, y1, y2))
+            self.UncompressWorkingFile()
+            hdulist = fits.open(self.workingFile, mode="update")
+            hdulist[0].data = hdulist[0].data[y1:y2,x1:x2]
+            CropHeader(hdulist[0].header, x1, y1)
+            hdulist.flush()
+            hdulist.close()
+
+
+    ##-------------------------------------------------------------------------
+    ## Parse Region of Interest
+    ##-------------------------------------------------------------------------
+    def ParseROI(self):
+        '''
+        Parse the ROI string in the telescope object.  Returns a tuple of
+        (x1, x2, y1, y2) or None if there is no ROI or it can not be parsed.
+        The result is stored in self.ROI so the string is only parsed once.
+        '''
+        if self.ROI is None and self.tel.ROI:
+            self.ROI = ParseRegion(self.tel.ROI)
+            if not self.ROI:
                 self.logger.warning("Could not parse ROI string in telescope object.")
+        return self.ROI
+
+
+    ##-------------------------------------------------------------------------
+    ## Dark Subtract and Crop Only the Region of Interest
+    ##-------------------------------------------------------------------------
+    def CalibrateROI(self, Darks=None):
+        '''
+        Dark subtract and crop the image in one step, reading only the region
+        of interest from the image and from the dark files.  This replaces
+        calling DarkSubtract followed by Crop.
+
+        The calibrated region of interest is written to a new working file.
+        The uncropped working file (if ReadImage was called) is left untouched
+        and is kept in self.fullFrameFile so that a full frame jpeg can still
+        be made from it.  If no ROI is defined, this falls back to
+        DarkSubtract.
+        '''
+        ROI = self.ParseROI()
+        if not ROI:
+            if Darks:
+                self.DarkSubtract(Darks)
+            return
+        x1, x2, y1, y2 = ROI
+        if self.workingFile:
+            SourceFile = self.workingFile
+        else:
+            SourceFile = self.rawFile
+        self.fullFrameFile = SourceFile
+        self.logger.info("Calibrating region of interest [{0}:{1},{2}:{3}]".format(x1, x2, y1, y2))
+        ## Read only the region of interest from the image (section access
+        ## reads only the rows in the ROI from disk and applies any
+        ## BZERO/BSCALE scaling to those rows only)
+        hdulist_image = fits.open(SourceFile, memmap=False, ignore_missing_end=True)
+        ImageHDU = FindImageHDU(hdulist_image)[0]
+        ImageData = ReadSection(hdulist_image[ImageHDU], y1, y2, x1, x2).astype(np.float32)
+        Header = hdulist_image[ImageHDU].header.copy()
+        hdulist_image.close()
+        ## Read the same region of the dark(s)
+        if isinstance(Darks, DarkLibrary):
+            MasterDarkData = Darks.MasterDark(self, (y1, y2, x1, x2))
+            if MasterDarkData is not None:
+                self.logger.info("Subtracting dark from image.")
+                ImageData -= MasterDarkData
+                Header['history'] = "Dark subtracted using dark library."
+            else:
+                self.logger.warning("Region of interest will not be dark subtracted.")
+        elif Darks:
+            DarkData = []
+            for Dark in Darks:
+                hdulist_dark = fits.open(Dark, memmap=False)
+                DarkData.append(ReadSection(hdulist_dark[FindImageHDU(hdulist_dark)[0]], y1, y2, x1, x2))
+                hdulist_dark.close()
+            if len(DarkData) == 1:
+                self.logger.debug("Found master dark.  Read region of interest from master dark.")
+                MasterDarkData = DarkData[0]
             else:
-                x1 = int(MatchROI.group(1))
-                x2 = int(MatchROI.group(2))
-                y1 = int(MatchROI.group(3))
-                y2 = int(MatchROI.group(4))
-                self.logger.info("Cropping Image To [{0}:{1},{2}:{3}]".format(x1, x2, y1, y2))
-                hdulist = fits.open(self.workingFile, mode="update")
-                hdulist[0].data = hdulist[0].data[y1:y2,x1:x2]
-                hdulist.flush()
-                hdulist.close()
+                self.logger.info("Multiple input darks detected.  Median combining region of interest from {0} darks.".format(len(Darks)))
+                MasterDarkData = np.median(np.array(DarkData), axis=0)
+            self.logger.info("Subtracting dark from image.")
+            ImageData -= MasterDarkData
+            Header['history'] = "Dark subtracted using {0} dark frame(s).".format(len(Darks))
+        else:
+            self.logger.warning("No input dark files.  Region of interest will not be dark subtracted.")
+        ## Write calibrated region of interest to a new working file
+        for keyword in ['BZERO', 'BSCALE', 'XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME']:
+            if keyword in Header: del Header[keyword]
+        CropHeader(Header, x1, y1)
+        ROIFile = self.WorkspaceFile(self.rawFileBasename+"_roi.fits")
+        if os.path.exists(ROIFile): os.remove(ROIFile)
+        fits.PrimaryHDU(ImageData, Header).writeto(ROIFile)
+        self.workingFile = ROIFile
+        self.compression = None
+        self.imageExtension = 0
 
 
     ##-------------------------------------------------------------------------
@@ -656,6 +2634,7 @@ class Image(object):
         Solve astrometry in the working image using the astrometry.net solver.
         '''
         self.logger.info("Attempting to create WCS using Astrometry.net solver.")
+        self.UncompressWorkingFile()
         AstrometryCommand = ["solve-field", "-l", "5", "-O", "-p",
                              "-L", str(self.tel.pixelScale.value*0.90),
                              "-H", str(self.tel.pixelScale.value*1.10),
@@ -672,8 +2651,10 @@ class Image(object):
             for line in e.output.split("\n"):
                 self.logger.error(line)
             self.astrometrySolved = False
+            self.failedStages.append('SolveAstrometry')
         except:
             self.logger.error("solve-field process failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
+            self.failedStages.append('SolveAstrometry')
         else:
             ProcessTime = EndTime - StartTime
             self.logger.debug("Astrometry.net Processing Time: %.1f s", ProcessTime)
@@ -691,6 +2672,7 @@ class Image(object):
             if not os.path.exists(NewFile):
                 self.logger.warning("No new file created by astrometry.net")
                 self.astrometrySolved = False
+                self.failedStages.append('SolveAstrometry')
             else:
                 self.logger.debug("Astrometry.net succeeded")
                 if os.path.exists(NewFitsFile): os.remove(NewFitsFile)
@@ -703,15 +2685,6 @@ class Image(object):
 #                 hdulist[0].header['history'] = "Solved by Astrometry.net at {0}".format(time.strftime("%Y-%m-%dT%H:%M:%S UTC"))
 #                 hdulist.flush()
 #                 hdulist.close()
-            ## Add files created by astrometry.net to tempFiles list
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".axy"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".wcs"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".solved"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".rdls"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".match"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".corr"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+".new.fits"))
-            self.tempFiles.append(os.path.join(self.config.pathTemp, self.rawFileBasename+"-indx.xyls"))
 
     ##-------------------------------------------------------------------------
     ## Refine WCS
@@ -751,163 +2724,320 @@ class Image(object):
     ##-------------------------------------------------------------------------
     ## Run SExtractor
     ##-------------------------------------------------------------------------
-    def RunSExtractor(self):
+    def RunSExtractor(self, checkImage=False, memoryBudget=None):
         '''
-        Run SExtractor on image.
+        Run SExtractor on image.  SExtractor's low resolution background
+        map (MINIBACKGROUND, one value per background mesh) is kept in
+        self.backgroundGrid (see BackgroundModel).  Only if checkImage is
+        True does SExtractor also write a full size background subtracted
+        check image (MakeJPEG with backgroundSubtracted=True uses it if it
+        exists, otherwise it subtracts the interpolated grid).
+
+        If memoryBudget (default config.memoryBudget) is set and the image is
+        too large for SExtractor to process within it, SExtractor is run on
+        overlapping tiles instead (see TiledSExtract) and no check image is
+        written.
         '''
-        assert type(self.tel.gain) == u.quantity.Quantity
-        assert type(self.tel.pixelScale) == u.quantity.Quantity
-        assert type(self.tel.SExtractorSeeing) == u.quantity.Quantity
-        assert type(self.tel.SExtractorPhotAperture) == u.quantity.Quantity
-        if self.tel.gain and self.tel.pixelScale and self.tel.SExtractorSeeing and self.tel.SExtractorPhotAperture:
-            ## Set up file names
-            SExtractorConfigFile = os.path.join(self.config.pathTemp, self.rawFileBasename+".sex")
-            self.tempFiles.append(SExtractorConfigFile)
-            SExtractorCatalog = os.path.join(self.config.pathTemp, self.rawFileBasename+".cat")
-            self.tempFiles.append(SExtractorCatalog)
-            PhotometryCatalogFile_xy = os.path.join(self.config.pathTemp, self.rawFileBasename+"PhotCat_xy.txt")
-            self.tempFiles.append(PhotometryCatalogFile_xy)
-            CheckImageType = "-BACKGROUND"
-            self.CheckImageFile = os.path.join(self.config.pathPlots, self.rawFileBasename+"_bksub.fits")
-            self.tempFiles.append(self.CheckImageFile)
-
-            ## Create PhotometryCatalogFile_xy file for SExtractor Association
-            if os.path.exists(PhotometryCatalogFile_xy): os.remove(PhotometryCatalogFile_xy)
-            PhotCatFileObject = open(PhotometryCatalogFile_xy, 'w')
-            PhotCatFileObject.write("# No Existing WCS Found for this image\n")
-            PhotCatFileObject.write("# This is a dummy file to keep SExtractor happy\n")
-            PhotCatFileObject.write("0.0  0.0  0.0  0.0\n")
-            PhotCatFileObject.close()
-            
-            ## Make edits To default.sex based on telescope:
-            ## Read in default config file
-            DefaultConfig = subprocess.check_output(["sex", "-dd"]).split("\n")
-            NewConfig     = open(SExtractorConfigFile, 'w')
-            backgroundFilterSize = max(5.*self.tel.SExtractorSeeing.to(u.arcsec).value / self.tel.pixelScale.value, 5.)
-            self.logger.debug("Using background filter size of 5x seeing = {0:.1f} pixels.".format(backgroundFilterSize))
-            for line in DefaultConfig:
-                newline = line
-                if re.match("CATALOG_NAME\s+", line):
-                    newline = "CATALOG_NAME     "+SExtractorCatalog+"\n"
-                if re.match("CATALOG_TYPE\s+", line):
-                    newline = "CATALOG_TYPE     "+"FITS_LDAC"+"\n"
-                if re.match("PARAMETERS_NAME\s+", line):
-                    newline = "PARAMETERS_NAME  "+os.path.join(self.config.pathIQMonExec, "default.param")+"\n"
-                if re.match("DETECT_MINAREA\s+", line) and (2.*self.tel.pixelScale.value > self.tel.SExtractorSeeing.to(u.arcsec).value):
-                    newline = "DETECT_MINAREA   "+"4"+"\n"
-                if re.match("DETECT_THRESH\s+", line):
-                    newline = "DETECT_THRESH    "+"5.0"+"\n"
-                if re.match("ANALYSIS_THRESH\s+", line):
-                    newline = "ANALYSIS_THRESH  "+"5.0"+"\n"
-                if re.match("FILTER\s+", line):
-                    newline = "FILTER           "+"N"+"\n"
-                if re.match("BACK_SIZE\s+", line):
-                    newline = "BACK_SIZE        {0:.1f}\n".format(backgroundFilterSize)
-                if re.match("ASSOC_NAME\s+", line):
-                    newline = "ASSOC_NAME       "+PhotometryCatalogFile_xy+"\n"
-                if re.match("ASSOC_NAME\s+", line):
-                    newline = "ASSOC_NAME       "+PhotometryCatalogFile_xy+"\n"
-                if re.match("ASSOCSELEC_TYPE\s+", line):
-                    newline = "ASSOCSELEC_TYPE  "+"ALL"+"\n"
-                if re.match("CHECKIMAGE_TYPE\s+", line):
-                    newline = "CHECKIMAGE_TYPE  "+CheckImageType+"\n"
-                if re.match("CHECKIMAGE_NAME\s+", line):
-                    newline = "CHECKIMAGE_NAME  "+self.CheckImageFile+"\n"
-                if re.match("PHOT_APERTURES\s+", line):
-                    newline = "PHOT_APERTURES   "+str(self.tel.SExtractorPhotAperture.to(u.pix).value)+"\n"
-                if re.match("GAIN\s+", line):
-                    newline = "GAIN             "+str(self.tel.gain.value)+"\n"
-                if re.match("PIXEL_SCALE\s+", line):
-                    newline = "PIXEL_SCALE      "+str(self.tel.pixelScale.value)+"\n"
-                if self.tel.SExtractorSaturation:
-                    if re.match("SATUR_LEVEL\s+", line):
-                        newline = "SATUR_LEVEL      "+str(self.tel.SExtractorSaturation.to(u.adu).value)+"\n"
-                if re.match("SEEING_FWHM\s+", line):
-                    newline = "SEEING_FWHM      "+str(self.tel.SExtractorSeeing.to(u.arcsec).value)+"\n"
-                NewConfig.write(newline+"\n")
-            NewConfig.close()
-
-            ## Run SExtractor
-            SExtractorCommand = ["sex", self.workingFile, "-c", SExtractorConfigFile]
-            self.logger.info("Invoking SExtractor")
-            self.logger.debug("SExtractor command: {}".format(repr(SExtractorCommand)))
-            try:
-                SExSTDOUT = subprocess.check_output(SExtractorCommand, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                self.logger.error("SExtractor failed.")
-                for line in e.output.split("\n"):
-                    self.logger.error(line)
-            except:
-                self.logger.error("SExtractor process failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
-            else:
-                for line in SExSTDOUT.split("\n"):
-                    line.replace("[1A", "")
-                    line.replace("[1M>", "")
-                    if not re.match(".*Setting up background map.*", line) and not re.match(".*Line:\s[0-9]*.*", line):
-                        self.logger.debug("  "+line)
-                ## Extract Number of Stars from SExtractor Output
-                pos = SExSTDOUT.find("sextracted ")
-                IsSExCount = re.match("\s*([0-9]+)\s+", SExSTDOUT[pos+11:pos+21])
-                if IsSExCount:
-                    self.nSExtracted = int(IsSExCount.group(1))
-                    self.logger.info("SExtractor found {0} sources.".format(self.nSExtracted))
-                else:
-                    self.nSExtracted = None
-                ## Extract Background Level from SExtractor Output
-                pos = SExSTDOUT.find("Background: ")
-                IsSExBkgnd = re.match("\s*([0-9\.]+)\s*", SExSTDOUT[pos+11:pos+21])
-                if IsSExBkgnd:
-                    self.SExBackground = float(IsSExBkgnd.group(1))
-                    self.logger.info("SExtractor background is {0:.1f}".format(self.SExBackground))
-                else:
-                    self.SExBackground = None
-                ## Extract Background RMS from SExtractor Output
-                IsSExBRMS = re.match("\s*RMS:\s([0-9\.]+)\s*", SExSTDOUT[pos+21:pos+37])
-                if IsSExBRMS:
-                    self.SExBRMS = float(IsSExBRMS.group(1))
-                    self.logger.info("SExtractor background RMS is {0:.1f}".format(self.SExBRMS))
-                else:
-                    self.SExBRMS = None
+        if memoryBudget is None:
+            memoryBudget = getattr(self.config, 'memoryBudget', None)
+        if memoryBudget and self.nXPix and 4*self.nXPix*self.nYPix*8 > memoryBudget:
+            self.CheckImageFile = None
+            SExtracted = self.TiledSExtract(memoryBudget)
+            self.StoreSExtracted(SExtracted)
+            return
+        if checkImage:
+            self.CheckImageFile = self.WorkspaceFile(self.rawFileBasename+"_bksub.fits")
+        else:
+            self.CheckImageFile = None
+        self.UncompressWorkingFile()
+        SExtracted = self.SExtract(self.workingFile, self.rawFileBasename,
+                                   checkImageFile=self.CheckImageFile,
+                                   backgroundGrid=True)
+        self.StoreSExtracted(SExtracted)
+        if SExtracted and SExtracted.get('backgroundGrid'):
+            self.backgroundGrid = SExtracted['backgroundGrid']
 
-                ## If No Output Catalog Created ...
-                if not os.path.exists(SExtractorCatalog):
-                    self.logger.warning("SExtractor failed to create catalog.")
-                    self.SExtractorCatalog = None
-                else:
-                    self.SExtractorCatalog = SExtractorCatalog
-
-                ## Read FITS_LDAC SExtractor Catalog
-                self.logger.debug("Reading SExtractor output catalog.")
-                hdu = fits.open(self.SExtractorCatalog)
-                self.SExtractorResults = table.Table(hdu[2].data)
-#                 self.SExtractorResults = ascii.read(self.SExtractorCatalog, Reader=ascii.sextractor.SExtractor)
-                SExImageRadius = []
-                SExAngleInImage = []
-                for star in self.SExtractorResults:
-                    SExImageRadius.append(math.sqrt((self.nXPix/2-star['X_IMAGE'])**2 + (self.nYPix/2-star['Y_IMAGE'])**2))
-                    SExAngleInImage.append(math.atan((star['X_IMAGE']-self.nXPix/2)/(self.nYPix/2-star['Y_IMAGE']))*180.0/math.pi)
+
+    ##-------------------------------------------------------------------------
+    ## Store SExtractor Results
+    ##-------------------------------------------------------------------------
+    def StoreSExtracted(self, SExtracted):
+        '''
+        Store the results of SExtract in the image.
+        '''
+        if not SExtracted or SExtracted['results'] is None:
+            self.failedStages.append('RunSExtractor')
+        if SExtracted:
+            self.nSExtracted = SExtracted['nSExtracted']
+            self.SExBackground = SExtracted['background']
+            self.SExBRMS = SExtracted['backgroundRMS']
+            self.SExtractorCatalog = SExtracted['catalog']
+            self.SExtractorResults = SExtracted['results']
+            if self.SExtractorResults is not None:
+                dX = np.asarray(self.SExtractorResults['X_IMAGE']) - self.nXPix/2
+                dY = self.nYPix/2 - np.asarray(self.SExtractorResults['Y_IMAGE'])
+                SExImageRadius = np.sqrt(dX**2 + dY**2)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    SExAngleInImage = np.degrees(np.arctan(dX/dY))
                 self.SExtractorResults.add_column(table.Column(data=SExImageRadius, name='ImageRadius'))
                 self.SExtractorResults.add_column(table.Column(data=SExAngleInImage, name='AngleInImage'))
                 self.nStarsSEx = len(self.SExtractorResults)
                 self.logger.info("Read in {0} stars from SExtractor catalog.".format(self.nStarsSEx))
 
-        else:
+
+    ##-------------------------------------------------------------------------
+    ## Run SExtractor on Tiles of a Large Image
+    ##-------------------------------------------------------------------------
+    def TiledSExtract(self, memoryBudget, overlap=None):
+        '''
+        Run SExtractor on square tiles of the working file which fit in
+        memoryBudget (allowing for the several copies of the tile SExtractor
+        keeps), one tile at a time.  Tiles overlap by overlap pixels
+        (default: twice the background filter size) so that stars on the
+        tile borders are measured whole, and each star is kept only from the
+        tile whose core contains its center.  Returns a dictionary like
+        SExtract.
+        '''
+        self.UncompressWorkingFile()
+        PixelScale = self.tel.pixelScale.value
+        if overlap is None:
+            overlap = int(math.ceil(2.*max(5.*self.tel.SExtractorSeeing.to(u.arcsec).value / PixelScale, 5.)))
+        TileSize = max(int(math.sqrt(memoryBudget / (4*8))) - 2*overlap, overlap)
+        hdulist = fits.open(self.workingFile, memmap=False, ignore_missing_end=True)
+        hdu = hdulist[FindImageHDU(hdulist)[0]]
+        TileFile = self.WorkspaceFile(self.rawFileBasename+"_tile.fits")
+        Columns = {}
+        Backgrounds = []
+        BackgroundRMSs = []
+        nTiles = 0
+        for (y1, y2, x1, x2), (cy1, cy2, cx1, cx2) in Tiles(self.nYPix, self.nXPix, TileSize, overlap):
+            Header = hdu.header.copy()
+            for keyword in ['BZERO', 'BSCALE']:
+                if keyword in Header: del Header[keyword]
+            CropHeader(Header, x1, y1)
+            if os.path.exists(TileFile): os.remove(TileFile)
+            fits.PrimaryHDU(np.asarray(ReadSection(hdu, y1, y2, x1, x2), dtype=np.float32), Header).writeto(TileFile)
+            SExtracted = self.SExtract(TileFile, self.rawFileBasename+"_tile")
+            nTiles += 1
+            if not SExtracted or SExtracted['results'] is None:
+                continue
+            if SExtracted['background'] is not None:
+                Backgrounds.append(SExtracted['background'])
+            if SExtracted['backgroundRMS'] is not None:
+                BackgroundRMSs.append(SExtracted['backgroundRMS'])
+            Results = SExtracted['results']
+            X = np.asarray(Results['X_IMAGE']) + x1
+            Y = np.asarray(Results['Y_IMAGE']) + y1
+            ## Pixel i (from 0) has its center at i+1
+            Core = (X > cx1 + 0.5) & (X <= cx2 + 0.5) & (Y > cy1 + 0.5) & (Y <= cy2 + 0.5)
+            for name in Results.colnames:
+                Column = np.asarray(Results[name])[Core]
+                if name in ['X_IMAGE', 'XWIN_IMAGE']:
+                    Column = Column + x1
+                if name in ['Y_IMAGE', 'YWIN_IMAGE']:
+                    Column = Column + y1
+                Columns.setdefault(name, []).append(Column)
+        hdulist.close()
+        if os.path.exists(TileFile): os.remove(TileFile)
+        SExtracted = {'nSExtracted': None, 'background': None,
+                      'backgroundRMS': None, 'catalog': None, 'results': None}
+        if Columns:
+            Results = table.Table()
+            for name in Columns.keys():
+                Results.add_column(table.Column(data=np.concatenate(Columns[name]), name=name))
+            SExtracted['results'] = Results
+            SExtracted['nSExtracted'] = len(Results)
+        if Backgrounds:
+            SExtracted['background'] = float(np.median(Backgrounds))
+        if BackgroundRMSs:
+            SExtracted['backgroundRMS'] = float(np.median(BackgroundRMSs))
+        self.logger.info("SExtractor found {0} sources in {1} tiles of {2} pixels.".format(SExtracted['nSExtracted'], nTiles, TileSize))
+        return SExtracted
+
+
+    ##-------------------------------------------------------------------------
+    ## Run SExtractor on a File
+    ##-------------------------------------------------------------------------
+    def SExtract(self, imageFile, name, binning=1, checkImageFile=None, backgroundGrid=False):
+        '''
+        Run SExtractor on imageFile using the telescope properties.  name is
+        used to name the SExtractor files in the workspace.  If the image has
+        been binned, binning is used to scale the pixel scale and photometry
+        aperture.  If checkImageFile is given, a background subtracted check
+        image is written to it.
+
+        If backgroundGrid is True, SExtractor's MINIBACKGROUND map is read in
+        to a background grid dictionary (see BackgroundModel) and returned
+        as backgroundGrid.
+
+        If self.SExtractorColumns is set (ProcessImage sets it from the
+        stages being run if asked to, see SExtractorParameters), SExtractor
+        only measures those columns and only they are read from the catalog.
+        Otherwise the columns in default.param are used.
+
+        Returns a dictionary with the number of sources extracted
+        (nSExtracted), the background and background RMS, the catalog file
+        name, and the catalog as an astropy table (results).  Returns None if
+        SExtractor could not be run.
+        '''
+        assert type(self.tel.gain) == u.quantity.Quantity
+        assert type(self.tel.pixelScale) == u.quantity.Quantity
+        assert type(self.tel.SExtractorSeeing) == u.quantity.Quantity
+        assert type(self.tel.SExtractorPhotAperture) == u.quantity.Quantity
+        if not (self.tel.gain and self.tel.pixelScale and self.tel.SExtractorSeeing and self.tel.SExtractorPhotAperture):
             self.logger.warning("Telescope proerties not set.")
+            return None
+        PixelScale = self.tel.pixelScale.value * binning
+        ## Set up file names
+        SExtractorConfigFile = self.WorkspaceFile(name+".sex")
+        SExtractorCatalog = self.WorkspaceFile(name+".cat")
+        PhotometryCatalogFile_xy = self.WorkspaceFile(name+"PhotCat_xy.txt")
+        if self.SExtractorColumns:
+            ParametersFile = self.WorkspaceFile(name+".param")
+            with open(ParametersFile, 'w') as output:
+                output.write("\n".join(self.SExtractorColumns) + "\n")
+        else:
+            ParametersFile = os.path.join(self.config.pathIQMonExec, "default.param")
+        CheckImageTypes = []
+        CheckImageFiles = []
+        if checkImageFile:
+            CheckImageTypes.append("-BACKGROUND")
+            CheckImageFiles.append(checkImageFile)
+        if backgroundGrid:
+            GridFile = self.WorkspaceFile(name+"_minibackground.fits")
+            CheckImageTypes.append("MINIBACKGROUND")
+            CheckImageFiles.append(GridFile)
+        CheckImageType = ",".join(CheckImageTypes) or "NONE"
+
+        ## Create PhotometryCatalogFile_xy file for SExtractor Association
+        if os.path.exists(PhotometryCatalogFile_xy): os.remove(PhotometryCatalogFile_xy)
+        PhotCatFileObject = open(PhotometryCatalogFile_xy, 'w')
+        PhotCatFileObject.write("# No Existing WCS Found for this image\n")
+        PhotCatFileObject.write("# This is a dummy file to keep SExtractor happy\n")
+        PhotCatFileObject.write("0.0  0.0  0.0  0.0\n")
+        PhotCatFileObject.close()
+        
+        ## Make edits To default.sex based on telescope:
+        ## Read in default config file
+        DefaultConfig = subprocess.check_output(["sex", "-dd"]).split("\n")
+        NewConfig     = open(SExtractorConfigFile, 'w')
+        backgroundFilterSize = max(5.*self.tel.SExtractorSeeing.to(u.arcsec).value / PixelScale, 5.)
+        self.logger.debug("Using background filter size of 5x seeing = {0:.1f} pixels.".format(backgroundFilterSize))
+        for line in DefaultConfig:
+            newline = line
+            if re.match("CATALOG_NAME\s+", line):
+                newline = "CATALOG_NAME     "+SExtractorCatalog+"\n"
+            if re.match("CATALOG_TYPE\s+", line):
+                newline = "CATALOG_TYPE     "+"FITS_LDAC"+"\n"
+            if re.match("PARAMETERS_NAME\s+", line):
+                newline = "PARAMETERS_NAME  "+ParametersFile+"\n"
+            if re.match("DETECT_MINAREA\s+", line) and (2.*PixelScale > self.tel.SExtractorSeeing.to(u.arcsec).value):
+                newline = "DETECT_MINAREA   "+"4"+"\n"
+            if re.match("DETECT_THRESH\s+", line):
+                newline = "DETECT_THRESH    "+"5.0"+"\n"
+            if re.match("ANALYSIS_THRESH\s+", line):
+                newline = "ANALYSIS_THRESH  "+"5.0"+"\n"
+            if re.match("FILTER\s+", line):
+                newline = "FILTER           "+"N"+"\n"
+            if re.match("BACK_SIZE\s+", line):
+                newline = "BACK_SIZE        {0:d}\n".format(int(backgroundFilterSize))
+            if re.match("ASSOC_NAME\s+", line):
+                newline = "ASSOC_NAME       "+PhotometryCatalogFile_xy+"\n"
+            if re.match("ASSOCSELEC_TYPE\s+", line):
+                newline = "ASSOCSELEC_TYPE  "+"ALL"+"\n"
+            if re.match("CHECKIMAGE_TYPE\s+", line):
+                newline = "CHECKIMAGE_TYPE  "+CheckImageType+"\n"
+            if re.match("CHECKIMAGE_NAME\s+", line) and CheckImageFiles:
+                newline = "CHECKIMAGE_NAME  "+",".join(CheckImageFiles)+"\n"
+            if re.match("PHOT_APERTURES\s+", line):
+                newline = "PHOT_APERTURES   "+str(self.tel.SExtractorPhotAperture.to(u.pix).value / binning)+"\n"
+            if re.match("GAIN\s+", line):
+                newline = "GAIN             "+str(self.tel.gain.value)+"\n"
+            if re.match("PIXEL_SCALE\s+", line):
+                newline = "PIXEL_SCALE      "+str(PixelScale)+"\n"
+            if self.tel.SExtractorSaturation:
+                if re.match("SATUR_LEVEL\s+", line):
+                    newline = "SATUR_LEVEL      "+str(self.tel.SExtractorSaturation.to(u.adu).value * binning**2)+"\n"
+            if re.match("SEEING_FWHM\s+", line):
+                newline = "SEEING_FWHM      "+str(self.tel.SExtractorSeeing.to(u.arcsec).value)+"\n"
+            NewConfig.write(newline+"\n")
+        NewConfig.close()
+
+        ## Run SExtractor
+        SExtractorCommand = ["sex", imageFile, "-c", SExtractorConfigFile]
+        self.logger.info("Invoking SExtractor")
+        self.logger.debug("SExtractor command: {}".format(repr(SExtractorCommand)))
+        try:
+            SExSTDOUT = subprocess.check_output(SExtractorCommand, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            self.logger.error("SExtractor failed.")
+            for line in e.output.split("\n"):
+                self.logger.error(line)
+            return None
+        except:
+            self.logger.error("SExtractor process failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
+            return None
+        SExtracted = {'nSExtracted': None, 'background': None,
+                      'backgroundRMS': None, 'catalog': None, 'results': None,
+                      'backgroundGrid': None}
+        if backgroundGrid and os.path.exists(GridFile):
+            hdulist = fits.open(GridFile, memmap=False)
+            SExtracted['backgroundGrid'] = {'grid': np.asarray(hdulist[0].data, dtype=np.float32),
+                                            'meshSize': int(backgroundFilterSize),
+                                            'shape': (fits.getval(imageFile, 'NAXIS2'), fits.getval(imageFile, 'NAXIS1')),
+                                            'source': 'SExtractor'}
+            hdulist.close()
+            os.remove(GridFile)
+        for line in SExSTDOUT.split("\n"):
+            line.replace("[1A", "")
+            line.replace("[1M>", "")
+            if not re.match(".*Setting up background map.*", line) and not re.match(".*Line:\s[0-9]*.*", line):
+                self.logger.debug("  "+line)
+        ## Extract Number of Stars from SExtractor Output
+        pos = SExSTDOUT.find("sextracted ")
+        IsSExCount = re.match("\s*([0-9]+)\s+", SExSTDOUT[pos+11:pos+21])
+        if IsSExCount:
+            SExtracted['nSExtracted'] = int(IsSExCount.group(1))
+            self.logger.info("SExtractor found {0} sources.".format(SExtracted['nSExtracted']))
+        ## Extract Background Level from SExtractor Output
+        pos = SExSTDOUT.find("Background: ")
+        IsSExBkgnd = re.match("\s*([0-9\.]+)\s*", SExSTDOUT[pos+11:pos+21])
+        if IsSExBkgnd:
+            SExtracted['background'] = float(IsSExBkgnd.group(1))
+            self.logger.info("SExtractor background is {0:.1f}".format(SExtracted['background']))
+        ## Extract Background RMS from SExtractor Output
+        IsSExBRMS = re.match("\s*RMS:\s([0-9\.]+)\s*", SExSTDOUT[pos+21:pos+37])
+        if IsSExBRMS:
+            SExtracted['backgroundRMS'] = float(IsSExBRMS.group(1))
+            self.logger.info("SExtractor background RMS is {0:.1f}".format(SExtracted['backgroundRMS']))
+
+        ## If No Output Catalog Created ...
+        if not os.path.exists(SExtractorCatalog):
+            self.logger.warning("SExtractor failed to create catalog.")
+            return SExtracted
+        SExtracted['catalog'] = SExtractorCatalog
+
+        ## Read FITS_LDAC SExtractor Catalog
+        self.logger.debug("Reading SExtractor output catalog.")
+        SExtracted['results'] = ReadLDAC(SExtractorCatalog, self.SExtractorColumns)
+#         self.SExtractorResults = ascii.read(self.SExtractorCatalog, Reader=ascii.sextractor.SExtractor)
+        return SExtracted
 
 
     ##-------------------------------------------------------------------------
     ## Determine Image FWHM from SExtractor Catalog
     ##-------------------------------------------------------------------------
-    def DetermineFWHM(self):
+    def DetermineFWHM(self, IQRadiusFactor=1.0):
         '''
-        Determine typical FWHM of image from SExtractor results.
+        Determine typical FWHM of image from SExtractor results.  Only stars
+        within IQRadiusFactor times the half diagonal of the image are used.
         '''
         if self.nStarsSEx > 1:
-            IQRadiusFactor = 1.0
             DiagonalRadius = math.sqrt((self.nXPix/2)**2+(self.nYPix/2)**2)
             IQRadius = DiagonalRadius*IQRadiusFactor
-            CentralFWHMs = [star['FWHM_IMAGE'] for star in self.SExtractorResults if star['ImageRadius'] <= IQRadius]
-            CentralEllipticities = [star['ELLIPTICITY'] for star in self.SExtractorResults if star['ImageRadius'] <= IQRadius]
+            Central = np.asarray(self.SExtractorResults['ImageRadius']) <= IQRadius
+            CentralFWHMs = np.asarray(self.SExtractorResults['FWHM_IMAGE'])[Central]
+            CentralEllipticities = np.asarray(self.SExtractorResults['ELLIPTICITY'])[Central]
 #             CentralFWHMs = []
 #             CentralEllipticities = []
 #             for star in self.SExtractorResults:
@@ -928,24 +3058,502 @@ class Image(object):
 
 
     ##-------------------------------------------------------------------------
-    ## Determine Zero Point from SExtractor Catalog
+    ## Determine Map of PSF Across Image from SExtractor Catalog
     ##-------------------------------------------------------------------------
-    def DetermineZeroPoint(self):
+    def DeterminePSFMap(self, mode='grid', nBins=3, minStars=5):
         '''
-        Determine zero point by comparing measured magnitudes with catalog
-        magnitudes.
-        '''
-        pass
+        Determine how the PSF varies across the image from SExtractor results.
 
+        Stars are binned either on an nBins x nBins grid (mode='grid') or in
+        nBins radial annuli about the image center (mode='radial').  For each
+        cell the median FWHM (pixels), median ellipticity and the mean
+        orientation (THETA_IMAGE, in degrees) of the stars are determined.
+        Cells with fewer than minStars stars are set to nan.
 
-    ##-------------------------------------------------------------------------
-    ## Make JPEG of Image
-    ##-------------------------------------------------------------------------
-    def MakeJPEG(self, jpegFileName, markStars=False, markPointing=False, rotate=False, binning=1, backgroundSubtracted=False):
+        The FWHM of all stars is also fit with a tilt and curvature model:
+          FWHM = c0 + cx*x + cy*y + cr*(x**2 + y**2)
+        where x and y are measured from the image center in units of the half
+        diagonal.  The tilt (cx, cy) is a sign of a tilted detector, the
+        curvature (cr) a sign of field curvature or miscollimation.
+
+        All of the binning is done with vectorized operations, so the cost
+        scales linearly with the number of stars.  Results are stored in the
+        self.PSFMap dictionary.
         '''
-        Make jpegs of image.
+        if not self.nStarsSEx or self.nStarsSEx < 4:
+            self.logger.warning("Not enough stars to determine PSF map.")
+            self.PSFMap = None
+            return
+        X = np.asarray(self.SExtractorResults['X_IMAGE'], dtype=float)
+        Y = np.asarray(self.SExtractorResults['Y_IMAGE'], dtype=float)
+        FWHMs = np.asarray(self.SExtractorResults['FWHM_IMAGE'], dtype=float)
+        Ellipticities = np.asarray(self.SExtractorResults['ELLIPTICITY'], dtype=float)
+        Thetas = np.radians(np.asarray(self.SExtractorResults['THETA_IMAGE'], dtype=float))
+        DiagonalRadius = math.sqrt((self.nXPix/2)**2+(self.nYPix/2)**2)
+
+        ## Assign each star to a cell
+        if mode == 'grid':
+            iX = np.clip((X-1)*nBins//self.nXPix, 0, nBins-1).astype(int)
+            iY = np.clip((Y-1)*nBins//self.nYPix, 0, nBins-1).astype(int)
+            Cell = iY*nBins + iX
+            nCells = nBins*nBins
+            Shape = (nBins, nBins)
+        elif mode == 'radial':
+            Radius = np.sqrt((X-self.nXPix/2)**2 + (Y-self.nYPix/2)**2)
+            Cell = np.clip(Radius*nBins//DiagonalRadius, 0, nBins-1).astype(int)
+            nCells = nBins
+            Shape = (nBins,)
+        else:
+            raise ValueError("PSF map mode must be 'grid' or 'radial'")
+        self.logger.info("Determining PSF map ({0}, {1} bins) from {2} stars.".format(mode, nBins, len(X)))
+
+        ## Per cell medians
+        MedianFWHM, nStars = BinnedMedian(FWHMs, Cell, nCells)
+        MedianEllipticity, nStars = BinnedMedian(Ellipticities, Cell, nCells)
+        ## Orientation is an axis (period of 180 deg), so average the doubled
+        ## angle weighted by ellipticity.
+        SumCos = np.bincount(Cell, weights=Ellipticities*np.cos(2*Thetas), minlength=nCells)
+        SumSin = np.bincount(Cell, weights=Ellipticities*np.sin(2*Thetas), minlength=nCells)
+        MeanTheta = np.degrees(0.5*np.arctan2(SumSin, SumCos))
+        Sparse = nStars < minStars
+        MedianFWHM[Sparse] = np.nan
+        MedianEllipticity[Sparse] = np.nan
+        MeanTheta[Sparse] = np.nan
+
+        ## Fit tilt and curvature terms to FWHM of individual stars
+        xNorm = (X - self.nXPix/2) / DiagonalRadius
+        yNorm = (Y - self.nYPix/2) / DiagonalRadius
+        Design = np.column_stack([np.ones(len(X)), xNorm, yNorm, xNorm**2 + yNorm**2])
+        Coefficients = np.linalg.lstsq(Design, FWHMs, rcond=-1)[0]
+        Tilt = math.sqrt(Coefficients[1]**2 + Coefficients[2]**2)
+        TiltAngle = math.degrees(math.atan2(Coefficients[2], Coefficients[1]))
+        self.logger.debug("PSF map FWHM tilt = {0:.2f} pix toward {1:.0f} deg, curvature = {2:.2f} pix".format(Tilt, TiltAngle, Coefficients[3]))
+
+        self.PSFMap = {'mode': mode,
+                       'nBins': nBins,
+                       'nStars': nStars.reshape(Shape),
+                       'FWHM': MedianFWHM.reshape(Shape),
+                       'ellipticity': MedianEllipticity.reshape(Shape),
+                       'theta': MeanTheta.reshape(Shape),
+                       'coefficients': Coefficients,
+                       'tilt': Tilt,
+                       'tiltAngle': TiltAngle,
+                       'curvature': Coefficients[3],
+                      }
+
+
+    ##-------------------------------------------------------------------------
+    ## Estimate Background Grid
+    ##-------------------------------------------------------------------------
+    def EstimateBackground(self, meshSize=None, memoryBudget=None):
+        '''
+        Estimate the background on a grid of meshSize pixel meshes (default:
+        the background filter size used by SExtract) without SExtractor (see
+        BackgroundGrid) and store it in self.backgroundGrid.  RunSExtractor
+        already stores SExtractor's background grid, so this is only needed
+        if SExtractor was not run (or was run on tiles).
+
+        If memoryBudget (default config.memoryBudget) is set and the image
+        does not fit in a quarter of it, the grid is estimated from a block
+        binned copy of the image (see BinFile).
+        '''
+        if memoryBudget is None:
+            memoryBudget = getattr(self.config, 'memoryBudget', None)
+        if not meshSize:
+            meshSize = int(max(5.*self.tel.SExtractorSeeing.to(u.arcsec).value / self.tel.pixelScale.value, 5.))
+        self.UncompressWorkingFile()
+        Shape = (fits.getval(self.workingFile, 'NAXIS2'), fits.getval(self.workingFile, 'NAXIS1'))
+        Binning = 1
+        if memoryBudget and 4*Shape[0]*Shape[1]*3 > memoryBudget/4:
+            Binning = min(int(math.ceil(math.sqrt(4.*Shape[0]*Shape[1]*3 / (memoryBudget/4)))), meshSize)
+            meshSize = (meshSize // Binning) * Binning
+            Data = BinFile(self.workingFile, Binning, memoryBudget/4)
+        else:
+            Data, Header = ReadFloat32(self.workingFile)
+        self.logger.info("Estimating background on {0} pixel meshes.".format(meshSize))
+        Grid, RMS = BackgroundGrid(Data, meshSize // Binning)
+        del Data
+        self.backgroundGrid = {'grid': Grid, 'meshSize': meshSize,
+                               'shape': Shape, 'source': 'IQMon'}
+        self.logger.debug("Background ranges from {0:.1f} to {1:.1f}.".format(np.nanmin(Grid), np.nanmax(Grid)))
+
+
+    ##-------------------------------------------------------------------------
+    ## Interpolate Background Grid to a Background Model
+    ##-------------------------------------------------------------------------
+    def BackgroundModel(self, binning=1):
+        '''
+        Return the background model: the background grid (from RunSExtractor
+        or EstimateBackground) bilinearly interpolated to each pixel of the
+        image, or of the image block binned by binning.  Returns None if
+        there is no background grid.
+        '''
+        if not self.backgroundGrid:
+            return None
+        return InterpolateGrid(self.backgroundGrid['grid'], self.backgroundGrid['meshSize'],
+                               self.backgroundGrid['shape'], binning=binning)
+
+
+    ##-------------------------------------------------------------------------
+    ## Write Background Subtracted Image
+    ##-------------------------------------------------------------------------
+    def SubtractBackground(self, memoryBudget=None):
+        '''
+        Write the working file minus the background model to the workspace
+        (estimating the background first if there is no background grid)
+        and return the file name and its binning.  If memoryBudget is set
+        and the image does not fit in a quarter of it, the image is block
+        binned (see BinFile) and the model is evaluated at the binned pixels.
+        '''
+        if not self.backgroundGrid:
+            self.EstimateBackground(memoryBudget=memoryBudget)
+        self.UncompressWorkingFile()
+        Shape = self.backgroundGrid['shape']
+        Binning = 1
+        if memoryBudget and 4*Shape[0]*Shape[1]*2 > memoryBudget/4:
+            Binning = int(math.ceil(math.sqrt(4.*Shape[0]*Shape[1]*2 / (memoryBudget/4))))
+            Data = BinFile(self.workingFile, Binning, memoryBudget/4)
+        else:
+            Data, Header = ReadFloat32(self.workingFile)
+        Data -= self.BackgroundModel(binning=Binning)
+        SubtractedFile = self.WorkspaceFile(self.rawFileBasename+"_bksub.fits")
+        if os.path.exists(SubtractedFile): os.remove(SubtractedFile)
+        fits.PrimaryHDU(Data).writeto(SubtractedFile)
+        return SubtractedFile, Binning
+
+
+    ##-------------------------------------------------------------------------
+    ## Add SExtractor Catalog to Archive
+    ##-------------------------------------------------------------------------
+    def ArchiveCatalog(self, archive=None):
+        '''
+        Add the SExtractor catalog to a CatalogArchive (default: the archive
+        in config.pathArchive) so the metrics can be derived again later
+        without running SExtractor.
+        '''
+        if archive is None:
+            if not getattr(self.config, 'pathArchive', None):
+                self.logger.warning("No catalog archive set (IQMONARCHIVE).")
+                return
+            archive = CatalogArchive.Get(self.config.pathArchive)
+        archive.Append(self)
+
+
+    ##-------------------------------------------------------------------------
+    ## Quick Look Analysis of Binned Image
+    ##-------------------------------------------------------------------------
+    def QuickLook(self, binning=2, mode='bin', nWindows=3, windowSize=256):
+        '''
+        Make a fast, lower precision estimate of FWHM, ellipticity, and number
+        of stars by running SExtractor on a reduced image.
+
+        - mode='bin': the image is block binned by binning x binning.  This
+          cuts the SExtractor time by about binning**2, but every pixel is
+          still read (one strip at a time, see BinFile), so the I/O and any
+          decompression cost the same as for the full image.  After
+          ReadImage this is a read of the uncompressed working file.
+        - mode='windows': only an nWindows x nWindows grid of windowSize pixel
+          square windows are read and are tiled in to one small image.  Stars
+          near the window edges are ignored.  Use this mode when reading the
+          image dominates (i.e. large compressed images).
+
+        The FWHM is converted back to unbinned pixels and corrected for the
+        broadening caused by the larger pixels.  For the windows mode, the
+        number of stars is scaled up to the area of the full image.  A
+        confidence flag of 'high', 'medium', or 'low' is set based on how
+        well the stars are sampled in the reduced image and how many there
+        are.  Results are stored in self.quickLook and do not replace the
+        results of the full resolution analysis (RunSExtractor and
+        DetermineFWHM), which can be run afterwards.
+        '''
+        StartTime = time.time()
+        if self.workingFile:
+            SourceFile = self.workingFile
+        else:
+            SourceFile = self.rawFile
+        hdulist = fits.open(SourceFile, memmap=False, ignore_missing_end=True)
+        ImageHDU = hdulist[FindImageHDU(hdulist)[0]]
+        nY = ImageHDU.header['NAXIS2']
+        nX = ImageHDU.header['NAXIS1']
+        if mode == 'bin':
+            self.logger.info("Quick look: binning image {0}x{0}.".format(binning))
+            Reduced = BinFile(SourceFile, binning)
+            AreaFraction = 1.
+        elif mode == 'windows':
+            binning = 1
+            windowSize = min(windowSize, nX//nWindows, nY//nWindows)
+            self.logger.info("Quick look: reading {0}x{0} grid of {1} pixel windows.".format(nWindows, windowSize))
+            Reduced = np.zeros((nWindows*windowSize, nWindows*windowSize), dtype=np.float32)
+            for j in range(nWindows):
+                y1 = int((j+0.5)*nY/nWindows) - windowSize//2
+                for i in range(nWindows):
+                    x1 = int((i+0.5)*nX/nWindows) - windowSize//2
+                    Reduced[j*windowSize:(j+1)*windowSize,i*windowSize:(i+1)*windowSize] =\
+                        ReadSection(ImageHDU, y1, y1+windowSize, x1, x1+windowSize)
+            AreaFraction = (nWindows*windowSize)**2 / (nX*nY)
+        else:
+            raise ValueError("Quick look mode must be 'bin' or 'windows'")
+        hdulist.close()
+        QuickLookFile = self.WorkspaceFile(self.rawFileBasename+"_quicklook.fits")
+        if os.path.exists(QuickLookFile): os.remove(QuickLookFile)
+        fits.PrimaryHDU(Reduced).writeto(QuickLookFile)
+
+        self.quickLook = {'mode': mode, 'binning': binning, 'FWHM': None,
+                          'ellipticity': None, 'nStars': None,
+                          'confidence': 'low'}
+        SExtracted = self.SExtract(QuickLookFile, self.rawFileBasename+"_quicklook", binning=binning)
+        if SExtracted and SExtracted['results'] is not None:
+            Stars = SExtracted['results']
+            X = np.asarray(Stars['X_IMAGE'])
+            Y = np.asarray(Stars['Y_IMAGE'])
+            Good = np.ones(len(Stars), dtype=bool)
+            if mode == 'windows':
+                ## Ignore stars which may be cut by a window edge
+                Margin = 5.
+                Good = ((X-0.5) % windowSize > Margin) & ((X-0.5) % windowSize < windowSize-Margin) &\
+                       ((Y-0.5) % windowSize > Margin) & ((Y-0.5) % windowSize < windowSize-Margin)
+            FWHMs = np.asarray(Stars['FWHM_IMAGE'])[Good]
+            nStars = int(Good.sum())
+            if nStars > 0:
+                BinnedFWHM = np.median(FWHMs)
+                ## Remove (in quadrature) the extra width from the larger
+                ## pixels.  A box of width b pixels has a FWHM equivalent of
+                ## about 0.68*b.
+                FWHM = math.sqrt(max((BinnedFWHM*binning)**2 - (0.68**2)*(binning**2 - 1), 0.))
+                self.quickLook['FWHM'] = FWHM * u.pix
+                self.quickLook['ellipticity'] = np.median(np.asarray(Stars['ELLIPTICITY'])[Good])
+                if BinnedFWHM < 1.5 or nStars < 5:
+                    self.quickLook['confidence'] = 'low'
+                elif BinnedFWHM < 2.0 or nStars < 20:
+                    self.quickLook['confidence'] = 'medium'
+                else:
+                    self.quickLook['confidence'] = 'high'
+            self.quickLook['nStars'] = int(round(nStars / AreaFraction))
+        self.quickLook['processTime'] = time.time() - StartTime
+        if self.quickLook['FWHM'] is not None:
+            self.logger.info("Quick look FWHM = {0:.2f} pix, ellipticity = {1:.2f}, {2} stars ({3} confidence)".format(
+                             self.quickLook['FWHM'].value, self.quickLook['ellipticity'],
+                             self.quickLook['nStars'], self.quickLook['confidence']))
+        else:
+            self.logger.warning("Quick look could not determine FWHM.")
+
+
+    ##-------------------------------------------------------------------------
+    ## Track Stars from a Reference Star List
+    ##-------------------------------------------------------------------------
+    def TrackStars(self, reference, nBright=10, searchRadius=20, maxLostFraction=0.3):
+        '''
+        Measure the stars in a TrackingReference at their predicted positions
+        instead of running SExtractor.  This is meant for time series of one
+        field, where blind extraction of every image is mostly wasted effort.
+
+        The shift of the image relative to the reference is measured from the
+        nBright brightest reference stars, each of which is searched for
+        within searchRadius pixels of its position in the previous image.
+        All reference stars are then measured at once at the shifted
+        positions (see ForcedMeasure) and the results are stored in
+        self.SExtractorResults (with the same column names as the SExtractor
+        catalog) so DetermineFWHM and DeterminePSFMap can be used as usual.
+        The FWHM of the forced measurements is from adaptive moments, which
+        agree with SExtractor's FWHM_IMAGE for gaussian stars but not in
+        general, so the rows have a FORCED column (True) and the mode is
+        reported as trackingMode by Results.
+
+        If the reference is not set, the field (OBJECT) or image size has
+        changed, the shift can not be measured, or more than maxLostFraction
+        of the reference stars are not found, RunSExtractor is run instead
+        and the reference is updated from its results.  The outcome is
+        stored in self.tracking.
+        '''
+        Reference = reference.Snapshot()
+        self.tracking = {'mode': None, 'shift': None, 'nReference': None,
+                         'nMeasured': None, 'lostFraction': None, 'reason': None}
+        Reason = None
+        self.UncompressWorkingFile()
+        if not Reference:
+            Reason = "no reference star list"
+        elif Reference['field'] != self.objectName:
+            Reason = "field changed from {0} to {1}".format(Reference['field'], self.objectName)
+        elif Reference['shape'] != (self.nYPix, self.nXPix):
+            Reason = "image size changed"
+        else:
+            hdulist = fits.open(self.workingFile, ignore_missing_end=True)
+            Data = hdulist[FindImageHDU(hdulist)[0]].data
+            hdulist.close()
+            ## Size of the box used to measure each star
+            SeeingPix = self.tel.SExtractorSeeing.to(u.arcsec).value / self.tel.pixelScale.value
+            ApertureRadius = self.tel.SExtractorPhotAperture.to(u.pix).value / 2.
+            HalfSize = int(math.ceil(max(2.*ApertureRadius, 3.*SeeingPix, 5.)))
+            MinSNR = 5.
+
+            ## Find the bright stars near their positions in the previous image
+            Bright = np.argsort(Reference['flux'])[::-1][:nBright]
+            PredictedX = Reference['X'][Bright] + Reference['shift'][0]
+            PredictedY = Reference['Y'][Bright] + Reference['shift'][1]
+            Offsets = np.arange(-searchRadius, searchRadius+1)
+            iX = np.clip(np.round(PredictedX).astype(int)[:,None] - 1 + Offsets, 0, self.nXPix-1)
+            iY = np.clip(np.round(PredictedY).astype(int)[:,None] - 1 + Offsets, 0, self.nYPix-1)
+            SearchBoxes = Data[iY[:,:,None], iX[:,None,:]].reshape(len(Bright), -1)
+            Peak = np.argmax(SearchBoxes, axis=1)
+            PeakX = iX[np.arange(len(Bright)), Peak % len(Offsets)] + 1
+            PeakY = iY[np.arange(len(Bright)), Peak // len(Offsets)] + 1
+            BrightStars = ForcedMeasure(Data, PeakX, PeakY, HalfSize, ApertureRadius)
+            with np.errstate(invalid='ignore'):
+                Found = BrightStars['inBounds'] &\
+                        (BrightStars['flux'] > MinSNR*BrightStars['noise']*math.sqrt(math.pi)*ApertureRadius)
+            if Found.sum() < max(3, len(Bright)//2):
+                Reason = "only {0} of {1} bright stars found".format(Found.sum(), len(Bright))
+            else:
+                dX = BrightStars['X'][Found] - Reference['X'][Bright][Found]
+                dY = BrightStars['Y'][Found] - Reference['Y'][Bright][Found]
+                Shift = (float(np.median(dX)), float(np.median(dY)))
+                Scatter = np.median(np.sqrt((dX - Shift[0])**2 + (dY - Shift[1])**2))
+                if Scatter > HalfSize/2.:
+                    Reason = "inconsistent shifts of bright stars"
+        if not Reason:
+            self.logger.info("Tracking {0} reference stars, shift = ({1:.2f}, {2:.2f}) pix".format(len(Reference['X']), Shift[0], Shift[1]))
+            X = Reference['X'] + Shift[0]
+            Y = Reference['Y'] + Shift[1]
+            Stars = ForcedMeasure(Data, X, Y, HalfSize, ApertureRadius)
+            with np.errstate(invalid='ignore'):
+                Measured = Stars['inBounds'] &\
+                           (Stars['flux'] > MinSNR*Stars['noise']*math.sqrt(math.pi)*ApertureRadius) &\
+                           (np.sqrt((Stars['X'] - X)**2 + (Stars['Y'] - Y)**2) < HalfSize/2.)
+            LostFraction = 1. - float(Measured.sum()) / len(X)
+            if LostFraction > maxLostFraction:
+                Reason = "{0:.0f}% of reference stars lost".format(100.*LostFraction)
+        if Reason:
+            self.logger.info("Not tracking stars ({0}).  Running SExtractor.".format(Reason))
+            self.RunSExtractor(checkImage=False)
+            reference.Update(self)
+            self.tracking['mode'] = 'extracted'
+            self.tracking['reason'] = Reason
+            return
+
+        reference.Record(Shift)
+        Results = table.Table()
+        Results.add_column(table.Column(data=Stars['X'][Measured], name='X_IMAGE'))
+        Results.add_column(table.Column(data=Stars['Y'][Measured], name='Y_IMAGE'))
+        Results.add_column(table.Column(data=Stars['FWHM'][Measured], name='FWHM_IMAGE'))
+        Results.add_column(table.Column(data=Stars['ellipticity'][Measured], name='ELLIPTICITY'))
+        Results.add_column(table.Column(data=Stars['theta'][Measured], name='THETA_IMAGE'))
+        Results.add_column(table.Column(data=Stars['flux'][Measured], name='FLUX_APER'))
+        Results.add_column(table.Column(data=np.ones(Measured.sum(), dtype=bool), name='FORCED'))
+        dX = Stars['X'][Measured] - self.nXPix/2
+        dY = self.nYPix/2 - Stars['Y'][Measured]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            Results.add_column(table.Column(data=np.sqrt(dX**2 + dY**2), name='ImageRadius'))
+            Results.add_column(table.Column(data=np.degrees(np.arctan(dX/dY)), name='AngleInImage'))
+        self.SExtractorResults = Results
+        self.nStarsSEx = len(Results)
+        self.SExBackground = float(np.median(Stars['background'][Measured]))
+        self.SExBRMS = float(np.median(Stars['noise'][Measured]))
+        self.tracking['mode'] = 'forced'
+        self.tracking['shift'] = Shift
+        self.tracking['nReference'] = len(X)
+        self.tracking['nMeasured'] = self.nStarsSEx
+        self.tracking['lostFraction'] = LostFraction
+        self.logger.info("Measured {0} of {1} reference stars.".format(self.nStarsSEx, len(X)))
+
+
+    ##-------------------------------------------------------------------------
+    ## Measure Drift Relative to a Reference Image of the Same Field
+    ##-------------------------------------------------------------------------
+    def MeasureDrift(self, references, binning=4, minPeak=0.05, driftLog=None):
+        '''
+        Measure how far the field has drifted since a reference image of the
+        same field by phase correlation (see PhaseCorrelate) of binned,
+        background subtracted images.  This needs no astrometric solution and
+        takes milliseconds, so it can be used to monitor guiding and tracking
+        on every image.
+
+        references is a DriftReferences object which holds the reference for
+        each field.  The first image of a field (or the first after the image
+        size changes) becomes the reference.  The drift is stored in
+        self.drift in pixels and arcsec.  If the correlation peak is lower
+        than minPeak the images do not match and the drift is not set.  If
+        driftLog is given, a line with the drift is appended to that file.
+        '''
+        if self.workingFile:
+            SourceFile = self.workingFile
+        else:
+            SourceFile = self.rawFile
+        Binned = BinFile(SourceFile, binning)
+        ## Subtract the background and suppress the edges of the image so the
+        ## correlation is dominated by the stars.
+        Binned -= np.median(Binned)
+        np.clip(Binned, 0., None, out=Binned)
+        Binned *= np.outer(np.hanning(Binned.shape[0]), np.hanning(Binned.shape[1])).astype(np.float32)
+
+        Key = (self.objectName, Binned.shape, binning)
+        Reference = references.Get(Key)
+        if Reference is None:
+            references.Set(Key, np.fft.fft2(Binned), self.rawFileName)
+            self.logger.info("Using {0} as drift reference for field {1}.".format(self.rawFileName, self.objectName))
+            dX, dY, Peak = 0., 0., 1.
+            ReferenceFile = self.rawFileName
+        else:
+            ReferenceFFT, ReferenceFile = Reference
+            dX, dY, Peak = PhaseCorrelate(ReferenceFFT, Binned)
+            dX *= binning
+            dY *= binning
+        if Peak < minPeak:
+            self.logger.warning("Image does not match drift reference {0} (correlation peak = {1:.3f}).".format(ReferenceFile, Peak))
+            return
+        PixelScale = self.tel.pixelScale.to(u.arcsec/u.pix).value
+        self.drift = {'reference': ReferenceFile, 'dX': dX, 'dY': dY,
+                      'dXArcsec': dX*PixelScale, 'dYArcsec': dY*PixelScale,
+                      'driftArcsec': math.sqrt(dX**2 + dY**2)*PixelScale,
+                      'peak': Peak}
+        self.logger.info("Drift relative to {0} is ({1:.2f}, {2:.2f}) pix = {3:.2f} arcsec".format(
+                         ReferenceFile, dX, dY, self.drift['driftArcsec']))
+        if driftLog:
+            references.Log(driftLog, "{0:22s} {1:40s} {2:8.2f} {3:8.2f} {4:8.2f} {5:6.3f}\n".format(
+                           getattr(self, 'dateObs', None) or "--", self.rawFileName,
+                           self.drift['dXArcsec'], self.drift['dYArcsec'],
+                           self.drift['driftArcsec'], Peak))
+
+
+    ##-------------------------------------------------------------------------
+    ## Determine Zero Point from SExtractor Catalog
+    ##-------------------------------------------------------------------------
+    def DetermineZeroPoint(self):
+        '''
+        Determine zero point by comparing measured magnitudes with catalog
+        magnitudes.
+        '''
+        pass
+
+
+    ##-------------------------------------------------------------------------
+    ## Make JPEG of Image
+    ##-------------------------------------------------------------------------
+    def MakeJPEG(self, jpegFileName, markStars=False, markPointing=False, rotate=False, binning=1, backgroundSubtracted=False, fullFrame=False, memoryBudget=None):
+        '''
+        Make jpegs of image.  If fullFrame is True and the working file has
+        been replaced by a calibrated region of interest (see CalibrateROI),
+        the jpeg is made from the uncropped image.  Stars and pointing are
+        measured in the region of interest, so they are not marked on a full
+        frame jpeg of a cropped image.
+
+        If memoryBudget (default config.memoryBudget) is set and the image is
+        larger than a quarter of it, the image is block binned strip by strip
+        (see BinFile) in to a small preview file (binned further if needed to
+        fit in the budget) and the jpeg is made from that, so convert never
+        loads the full image.
         '''
         jpegFile = os.path.join(self.config.pathPlots, jpegFileName)
+        if memoryBudget is None:
+            memoryBudget = getattr(self.config, 'memoryBudget', None)
+        if backgroundSubtracted:
+            if self.CheckImageFile and os.path.exists(self.CheckImageFile):
+                SubtractedFile, SubtractedBinning = self.CheckImageFile, 1
+            else:
+                SubtractedFile, SubtractedBinning = self.SubtractBackground(memoryBudget)
+        if fullFrame and self.fullFrameFile and not backgroundSubtracted and self.ROI and (markStars or markPointing):
+            self.logger.warning("Not marking stars or pointing in full frame jpeg of region of interest.")
+            markStars = False
+            markPointing = False
         self.logger.info("Making jpeg (binning = {0}): {1}.".format(binning, jpegFileName))
         if os.path.exists(jpegFile): os.remove(jpegFile)
         binningString = str(1./binning*100)+"%"
@@ -993,7 +3601,10 @@ class Image(object):
                 MarkRadius = 4
             nStarsMarked = 0
             nStarsLimit = 5000
-            sortedSExtractorResults = np.sort(self.SExtractorResults, order=['MAG_AUTO'])
+            if 'MAG_AUTO' in self.SExtractorResults.colnames:
+                sortedSExtractorResults = np.sort(self.SExtractorResults, order=['MAG_AUTO'])
+            else:
+                sortedSExtractorResults = self.SExtractorResults
             for star in sortedSExtractorResults:
                 nStarsMarked += 1
                 if nStarsMarked <= nStarsLimit:
@@ -1013,7 +3624,22 @@ class Image(object):
                     JPEGcommand.append("-flop")
             else:
                 self.logger.warning("No position angle value found.  Not rotating JPEG.")
-        if not backgroundSubtracted:
+        if not backgroundSubtracted and fullFrame and self.fullFrameFile:
+            SourceFile = self.fullFrameFile
+        else:
+            SourceFile = self.workingFile
+        if not backgroundSubtracted and memoryBudget and 4*self.nXPix*self.nYPix > memoryBudget/4:
+            PreviewBinning = max(binning, int(math.ceil(math.sqrt(4.*self.nXPix*self.nYPix / (memoryBudget/4)))))
+            self.logger.debug("Making binned ({0}x{0}) preview for jpeg.".format(PreviewBinning))
+            PreviewFile = self.WorkspaceFile(self.rawFileBasename+"_preview.fits")
+            if os.path.exists(PreviewFile): os.remove(PreviewFile)
+            fits.PrimaryHDU(BinFile(SourceFile, PreviewBinning, memoryBudget/4)).writeto(PreviewFile)
+            JPEGcommand[JPEGcommand.index("-resize")+1] = str(PreviewBinning/binning*100)+"%"
+            JPEGcommand.append(PreviewFile)
+        elif not backgroundSubtracted and fullFrame and self.fullFrameFile:
+            JPEGcommand.append(self.Uncompressed(self.fullFrameFile))
+        elif not backgroundSubtracted:
+            self.UncompressWorkingFile()
             JPEGcommand.append(self.workingFile)
         else:
             JPEGcommand.append("-stroke")
@@ -1026,7 +3652,9 @@ class Image(object):
             JPEGcommand.append('fixed')
             JPEGcommand.append('-draw')
             JPEGcommand.append("text {0},80 'Background Subtracted Image'".format(self.nXPix/2 - 170))
-            JPEGcommand.append(self.CheckImageFile)
+            if SubtractedBinning > 1:
+                JPEGcommand[JPEGcommand.index("-resize")+1] = str(SubtractedBinning/binning*100)+"%"
+            JPEGcommand.append(SubtractedFile)
         if markStars and nStarsMarked > nStarsLimit:
             JPEGcommand.append("-stroke")
             JPEGcommand.append("none")
@@ -1047,12 +3675,15 @@ class Image(object):
             self.logger.error("Failed to create jpeg.")
             for line in e.output.split("\n"):
                 self.logger.error(line)
+            self.failedStages.append('MakeJPEG')
         except OSError as e:
             self.logger.error("Failed to create jpeg.")
             for line in e.strerror.split("\n"):
                 self.logger.error(line)
+            self.failedStages.append('MakeJPEG')
         except:
             self.logger.error("Convert process failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
+            self.failedStages.append('MakeJPEG')
         else:
             for line in ConvertSTDOUT.split("\n"):
                 if len(line) > 0:
@@ -1065,13 +3696,19 @@ class Image(object):
     ##-------------------------------------------------------------------------
     def CleanUp(self):
         '''
-        Clean up by deleting temporary files.
+        Clean up by deleting the image's scratch workspace (and everything
+        in it) and any other temporary files.
         '''
         self.logger.info("Cleaning Up Temporary Files.")
+        if self.workspace and os.path.exists(self.workspace):
+            self.logger.debug("Deleting workspace {0}".format(self.workspace))
+            shutil.rmtree(self.workspace, ignore_errors=True)
+        self.workspace = None
         for item in self.tempFiles:
             if os.path.exists(item):
                 self.logger.debug("Deleting {0}".format(item))
                 os.remove(item)
+        self.tempFiles = []
 
 
     ##-------------------------------------------------------------------------
@@ -1294,6 +3931,166 @@ class Image(object):
         HTML.close()
 
 
+    ##-------------------------------------------------------------------------
+    ## Make Report Row
+    ##-------------------------------------------------------------------------
+    def ReportRow(self, plotsURL=os.path.join("..", "..", "Plots")):
+        '''
+        Return the row for this image in the report (see ReportColumns) as a
+        dictionary of plain python values, with the FWHM, ellipticity, and
+        pointing error flagged 'ok' or 'bad' against the telescope
+        thresholds as in AddWebLogEntry.
+        '''
+        def Value(quantity, digits):
+            if quantity is None or quantity is False:
+                return None
+            quantity = float(quantity)
+            if math.isnan(quantity) or math.isinf(quantity):
+                return None
+            return round(quantity, digits)
+        Row = OrderedDict([(name, None) for name, heading in ReportColumns])
+        Row['date'] = self.dateObs
+        Row['file'] = self.rawFileBasename
+        Row['jpegs'] = [os.path.join(plotsURL, jpeg).replace(os.sep, '/') for jpeg in self.jpegFileNames]
+        Row['target'] = self.objectName
+        if self.exptime: Row['exptime'] = Value(self.exptime.to(u.s).value, 1)
+        if self.targetAlt: Row['alt'] = Value(self.targetAlt.to(u.deg).value, 1)
+        if self.targetAz:
+            Row['az'] = Value(self.targetAz.to(u.deg).value, 1)
+            Row['airmass'] = Value(self.airmass, 2)
+        if self.moonSep: Row['moonSep'] = Value(self.moonSep.to(u.deg).value, 1)
+        if self.moonPhase: Row['moonIllum'] = Value(self.moonPhase, 1)
+        if self.FWHM:
+            if self.FWHM > self.tel.thresholdFWHM.to(u.pix, equivalencies=self.tel.pixelScaleEquivalency):
+                Row['flagFWHM'] = 'bad'
+            else:
+                Row['flagFWHM'] = 'ok'
+            if self.tel.unitsForFWHM.unit == u.arcsec:
+                Row['FWHM'] = Value((self.FWHM * u.radian.to(u.arcsec)*self.tel.pixelSize.to(u.mm)/self.tel.focalLength.to(u.mm)).value, 2)
+            else:
+                Row['FWHM'] = Value(self.FWHM.value, 2)
+        if self.ellipticity:
+            if self.ellipticity > self.tel.thresholdEllipticity:
+                Row['flagEllipticity'] = 'bad'
+            else:
+                Row['flagEllipticity'] = 'ok'
+            Row['ellipticity'] = Value(self.ellipticity, 2)
+        if self.SExBackground and self.SExBRMS:
+            Row['background'] = Value(self.SExBackground, 0)
+            Row['backgroundRMS'] = Value(self.SExBRMS, 0)
+        if self.pointingError:
+            if self.pointingError.arcmins > self.tel.thresholdPointingErr.to(u.arcmin).value:
+                Row['flagPointingError'] = 'bad'
+            else:
+                Row['flagPointingError'] = 'ok'
+            Row['pointingError'] = Value(self.pointingError.arcmins, 1)
+        if self.positionAngle: Row['positionAngle'] = Value(self.positionAngle.to(u.deg).value, 1)
+        if self.zeroPoint: Row['zeroPoint'] = Value(self.zeroPoint, 2)
+        if self.nStarsSEx: Row['nStars'] = int(self.nStarsSEx)
+        if self.processTime: Row['processTime'] = Value(self.processTime, 1)
+        return Row
+
+
+    ##-------------------------------------------------------------------------
+    ## Add Entry to Paginated Report
+    ##-------------------------------------------------------------------------
+    def AddReportEntry(self, reportDirectory, format='json', plotsURL=os.path.join("..", "..", "Plots")):
+        '''
+        Add this image to the report in reportDirectory.  Replaces
+        AddWebLogEntry for long running logs: the results are written as one
+        small data file (shard) per night (JSON or CSV, set by format) and a
+        static index.html page loads the shard for the chosen night and only
+        renders the rows which are on screen.  Only the shard for this
+        image's night and the small index.json listing the shards are
+        rewritten; the page is written once.  A row for the same file
+        replaces the old one, so images can be reprocessed.  The update holds
+        a FileLock on the index, so images can be added from several threads
+        or processes at once.
+        '''
+        if not format in ['json', 'csv']:
+            raise ValueError("Unknown report format: {0}".format(format))
+        if not os.path.exists(reportDirectory):
+            os.makedirs(reportDirectory)
+        if self.dateObs:
+            Night = self.dateObs[0:10].replace("-", "") + "UT"
+        else:
+            Night = "Unknown"
+        Shard = "{0}.{1}".format(Night, format)
+        ShardFile = os.path.join(reportDirectory, Shard)
+        self.logger.info("Adding image data to report {0}.".format(ShardFile))
+        Columns = [name for name, heading in ReportColumns]
+        IndexFile = os.path.join(reportDirectory, "index.json")
+        with FileLock(IndexFile):
+            ## Read this night's rows
+            Rows = []
+            if os.path.exists(ShardFile):
+                with open(ShardFile, 'r') as input:
+                    if format == 'json':
+                        Rows = json.load(input)
+                    else:
+                        for Row in csv.DictReader(input):
+                            Rows.append(Row)
+            Row = self.ReportRow(plotsURL=plotsURL)
+            Rows = [OldRow for OldRow in Rows if OldRow['file'] != Row['file']]
+            Rows.append(Row)
+            Rows.sort(key=lambda Row: Row['date'] or "")
+            ## Write shard (to a temporary file first so the page never loads
+            ## a partly written shard)
+            TempFile = self.ReportTempFile(reportDirectory, Shard)
+            with open(TempFile, 'w') as output:
+                if format == 'json':
+                    json.dump(Rows, output, separators=(',', ':'))
+                else:
+                    Writer = csv.writer(output, lineterminator='\n')
+                    Writer.writerow(Columns)
+                    for Row in Rows:
+                        if isinstance(Row['jpegs'], list):
+                            Row['jpegs'] = ";".join(Row['jpegs'])
+                        Writer.writerow(["" if Row.get(name) is None else Row[name] for name in Columns])
+            if os.path.exists(ShardFile) and sys.platform.startswith('win'):
+                os.remove(ShardFile)
+            os.rename(TempFile, ShardFile)
+            ## Update the list of shards
+            Index = {'telescope': self.tel.longName, 'nights': []}
+            if os.path.exists(IndexFile):
+                with open(IndexFile, 'r') as input:
+                    Index = json.load(input)
+            Nights = dict([(Entry['night'], Entry) for Entry in Index['nights']])
+            Nights[Night] = {'night': Night, 'shard': Shard, 'nImages': len(Rows)}
+            Index['nights'] = [Nights[Key] for Key in sorted(Nights.keys())]
+            TempFile = self.ReportTempFile(reportDirectory, "index.json")
+            with open(TempFile, 'w') as output:
+                json.dump(Index, output, indent=1)
+            if os.path.exists(IndexFile) and sys.platform.startswith('win'):
+                os.remove(IndexFile)
+            os.rename(TempFile, IndexFile)
+            ## Write the page if it does not exist
+            PageFile = os.path.join(reportDirectory, "index.html")
+            if not os.path.exists(PageFile):
+                self.logger.debug("Writing report page {0}.".format(PageFile))
+                Headings = [[name, heading] for name, heading in ReportColumns if heading]
+                for Heading in Headings:
+                    if Heading[0] == 'FWHM':
+                        Heading[1] = "FWHM ({0})".format(str(self.tel.unitsForFWHM.unit))
+                with open(PageFile, 'w') as output:
+                    output.write(ReportPage.replace("TITLE", str(self.tel.longName)).replace("COLUMNS", json.dumps(Headings)))
+
+
+    ##-------------------------------------------------------------------------
+    ## Make a Temporary File for the Report
+    ##-------------------------------------------------------------------------
+    def ReportTempFile(self, reportDirectory, name):
+        '''
+        Return the name of a new, uniquely named temporary file (readable by
+        the web server) in reportDirectory to write name to before it is
+        renamed.
+        '''
+        Handle, TempFile = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=reportDirectory)
+        os.close(Handle)
+        os.chmod(TempFile, 0o644)
+        return TempFile
+
+
     ##-------------------------------------------------------------------------
     ## Append Line With Image Info to Summary Text File
     ##-------------------------------------------------------------------------
@@ -1305,8 +4102,8 @@ class Image(object):
             self.logger.info("Making new astropy table object")
             SummaryTable = table.Table(names=("ExpStart", "File", "FWHM (pix)", "Ellipticity", 
                                        "Alt (deg)", "Az (deg)", "Airmass", "PointingError (arcmin)", 
-                                       "ZeroPoint", "nStars", "Background", "Background RMS"),
-                                 dtypes=('S22', 'S100', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'i4', 'f4', 'f4'),
+                                       "ZeroPoint", "nStars", "Background", "Background RMS", "Triage"),
+                                 dtypes=('S22', 'S100', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'f4', 'i4', 'f4', 'f4', 'S12'),
                                  masked=True)
         else:
             self.logger.info("Reading astropy table object from file: {0}".format(summaryFile))
@@ -1328,13 +4125,19 @@ class Image(object):
                                           'ZeroPoint': [ascii.convert_numpy('f4')],
                                           'nStars': [ascii.convert_numpy('i4')],
                                           'Background': [ascii.convert_numpy('f4')],
-                                          'Background RMS': [ascii.convert_numpy('f4')]
+                                          'Background RMS': [ascii.convert_numpy('f4')],
+                                          'Triage': [ascii.convert_numpy('S12')]
                                           })
             except:
                 self.logger.critical("Failed to read summary file: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
+            ## Summary files written before the Triage column was added
+            if not 'Triage' in SummaryTable.colnames:
+                SummaryTable.add_column(table.MaskedColumn(data=['']*len(SummaryTable),
+                                        name='Triage', dtype='S12',
+                                        mask=[True]*len(SummaryTable)))
         ## Astropy table writer can not write None to table initialized
         ## with type.  If any outputs are None, change to some value.
-        tableMask = np.zeros(12)
+        tableMask = np.zeros(13)
         ## dateObs
         if self.dateObs: dateObs = self.dateObs
         else: 
@@ -1395,6 +4198,11 @@ class Image(object):
         else:
             SExBRMS = 0.
             tableMask[11] = True
+        ## Triage reason code
+        if self.triageReason: triageReason = self.triageReason
+        else:
+            triageReason = ""
+            tableMask[12] = True
         ## Add row to table
         self.logger.debug("Writing new row to log table.  Filename: {0}".format(rawFileName))
         SummaryTable.add_row((dateObs, rawFileName,
@@ -1402,7 +4210,7 @@ class Image(object):
                               targetAlt, targetAz,
                               airmass, pointingError,
                               zeroPoint, nStarsSEx,
-                              SExBackground, SExBRMS),
+                              SExBackground, SExBRMS, triageReason),
                               mask=tableMask)
         ## Write Table to File
         self.logger.info("Writing new summary file.")
@@ -1418,4 +4226,2409 @@ class Image(object):
         self.processTime = self.endProcessTime - self.startProcessTime
         self.logger.info("IQMon processing time = {0:.1f} seconds".format(self.processTime))
 
-    
\ No newline at end of file
+
+    ##-------------------------------------------------------------------------
+    ## Collect Results in a Dictionary
+    ##-------------------------------------------------------------------------
+    def Results(self):
+        '''
+        Return the results of the analysis as a dictionary of plain python
+        values (suitable for writing as JSON).  Values which were not
+        determined are None.
+        '''
+        def Value(quantity, unit=None):
+            if quantity is None:
+                return None
+            if unit:
+                quantity = quantity.to(unit).value
+            quantity = float(quantity)
+            if math.isnan(quantity) or math.isinf(quantity):
+                return None
+            return quantity
+        Results = {'file': self.rawFileName,
+                   'chip': self.chip,
+                   'dateObs': getattr(self, 'dateObs', None),
+                   'object': self.objectName,
+                   'filter': self.filter,
+                   'focusPos': self.focusPos,
+                   'exptime': Value(self.exptime, u.s),
+                   'FWHM': Value(self.FWHM, u.pix),
+                   'ellipticity': Value(self.ellipticity),
+                   'pointingError': Value(self.pointingError.arcmins) if self.pointingError else None,
+                   'positionAngle': Value(self.positionAngle, u.deg),
+                   'airmass': Value(getattr(self, 'airmass', None)),
+                   'nStars': self.nStarsSEx,
+                   'background': Value(self.SExBackground),
+                   'backgroundRMS': Value(self.SExBRMS),
+                   'processTime': Value(self.processTime),
+                   'triage': self.triageReason,
+                   'stageTimes': dict(self.stageTimes),
+                  }
+        if self.quickLook:
+            Results['quickLookFWHM'] = Value(self.quickLook['FWHM'], u.pix)
+            Results['quickLookEllipticity'] = Value(self.quickLook['ellipticity'])
+            Results['quickLookNStars'] = self.quickLook['nStars']
+            Results['quickLookConfidence'] = self.quickLook['confidence']
+        if self.tracking:
+            Results['trackingMode'] = self.tracking['mode']
+            Results['trackingShift'] = self.tracking['shift']
+        if self.drift:
+            Results['driftX'] = Value(self.drift['dXArcsec'])
+            Results['driftY'] = Value(self.drift['dYArcsec'])
+        if self.PSFMap:
+            Results['PSFTilt'] = Value(self.PSFMap['tilt'])
+            Results['PSFTiltAngle'] = Value(self.PSFMap['tiltAngle'])
+            Results['PSFCurvature'] = Value(self.PSFMap['curvature'])
+        return Results
+
+
+##-----------------------------------------------------------------------------
+## Group Images in to Focus Sequences
+##-----------------------------------------------------------------------------
+def GroupFocusSequences(files, keywords=("FILTER", "EXPTIME"), maxGap=120.):
+    '''
+    Group a list of fits files in to focus sequences.
+
+    Files without a FOCUSPOS or DATE-OBS keyword are ignored.  The remaining
+    files are sorted by DATE-OBS and a new sequence is started whenever one of
+    the header keywords listed in keywords changes value or when the time
+    between successive exposures exceeds maxGap seconds.  Returns a list of
+    sequences, each of which is a list of filenames in time order.
+    '''
+    Frames = []
+    for file in files:
+        header = fits.getheader(file, ignore_missing_end=True)
+        if not 'FOCUSPOS' in header or not 'DATE-OBS' in header:
+            continue
+        DateObs = datetime.datetime.strptime(header['DATE-OBS'][0:19], "%Y-%m-%dT%H:%M:%S")
+        Values = tuple([header.get(keyword, None) for keyword in keywords])
+        Frames.append((DateObs, Values, file))
+    Frames.sort(key=lambda Frame: (Frame[0], Frame[2]))
+    Sequences = []
+    for i, Frame in enumerate(Frames):
+        if i == 0 or Frame[1] != Frames[i-1][1] or\
+           (Frame[0] - Frames[i-1][0]).total_seconds() > maxGap:
+            Sequences.append([])
+        Sequences[-1].append(Frame[2])
+    return Sequences
+
+
+##-----------------------------------------------------------------------------
+## Fit Hyperbola to FWHM vs. Focus Position
+##-----------------------------------------------------------------------------
+def FitFocusCurve(positions, FWHMs):
+    '''
+    Fit a hyperbola to FWHM as a function of focuser position.
+
+    A hyperbola, FWHM**2 = a*(x-x0)**2 + b, is linear in its parameters when
+    written in terms of FWHM**2, so it is fit as a parabola in FWHM**2 by
+    linear least squares.  Returns a tuple of the best focus position (x0),
+    its uncertainty, and the FWHM at best focus.  Returns None if there are
+    fewer than 4 points or if the curve does not open upward.
+    '''
+    x = np.asarray(positions, dtype=float)
+    y = np.asarray(FWHMs, dtype=float)**2
+    if len(x) < 4:
+        return None
+    ## Center positions to keep the fit well conditioned
+    x0 = np.mean(x)
+    Design = np.column_stack([(x-x0)**2, x-x0, np.ones(len(x))])
+    Coefficients, RSS, Rank, SV = np.linalg.lstsq(Design, y, rcond=-1)
+    A, B, C = Coefficients
+    if A <= 0:
+        return None
+    BestFocus = x0 - B/(2.*A)
+    MinFWHMSquared = C - B**2/(4.*A)
+    MinFWHM = math.sqrt(MinFWHMSquared) if MinFWHMSquared > 0 else 0.
+    ## Propagate the covariance of A and B in to the uncertainty of x0
+    Residuals = y - Design.dot(Coefficients)
+    Variance = np.sum(Residuals**2) / (len(x) - 3)
+    Covariance = Variance * np.linalg.pinv(Design.T.dot(Design))
+    Gradient = np.array([B/(2.*A**2), -1./(2.*A), 0.])
+    Uncertainty = math.sqrt(max(Gradient.dot(Covariance).dot(Gradient), 0.))
+    return BestFocus, Uncertainty, MinFWHM
+
+
+##-----------------------------------------------------------------------------
+## Analyze Single Image in a Focus Sequence
+##-----------------------------------------------------------------------------
+def AnalyzeFocusImage(file, tel, config):
+    '''
+    Default analysis for one image of a focus sequence.  Runs the minimum
+    set of steps needed to measure the FWHM and returns a tuple of the focus
+    position and the FWHM in pixels (None if it could not be measured).
+    '''
+    image = Image(file, tel, config)
+    image.logger = logging.getLogger('IQMonLogger')
+    try:
+        image.ReadImage()
+        image.GetHeader()
+        image.RunSExtractor()
+        image.DetermineFWHM()
+    except:
+        image.logger.error("Failed to analyze {0}: {1} {2}".format(file, sys.exc_info()[0], sys.exc_info()[1]))
+    finally:
+        image.CleanUp()
+    if image.FWHM:
+        return image.focusPos, image.FWHM.to(u.pix).value
+    else:
+        return image.focusPos, None
+
+
+##-----------------------------------------------------------------------------
+## Define FocusRun object to analyze a focus sequence
+##-----------------------------------------------------------------------------
+class FocusRun(object):
+    '''
+    Analyzes a sequence of images taken at different focuser positions (see
+    GroupFocusSequences) to determine the best focus position.
+
+    The images are analyzed concurrently on a pool of worker threads (the
+    heavy lifting is done by SExtractor in a subprocess).  As each result
+    arrives a hyperbola is fit to FWHM vs. focus position (FitFocusCurve) and
+    once the minimum is bracketed by at least minPointsPerSide images on each
+    side, the remaining images are not analyzed.
+
+    Properties:
+      files:                 The images in the sequence.
+      results:               List of (focus position, FWHM) tuples.
+      bestFocus:             Best focus position.
+      bestFocusUncertainty:  Uncertainty on the best focus position.
+      minFWHM:               Fitted FWHM (in pixels) at best focus.
+      bracketed:             True if the minimum was bracketed.
+    '''
+    def __init__(self, files, tel, config, logger=None):
+        self.files = list(files)
+        self.tel = tel
+        self.config = config
+        if logger:
+            self.logger = logger
+        else:
+            self.logger = logging.getLogger('IQMonLogger')
+        self.results = []
+        self.bestFocus = None
+        self.bestFocusUncertainty = None
+        self.minFWHM = None
+        self.bracketed = False
+
+    def IsBracketed(self, minPointsPerSide=2, rise=1.5):
+        '''
+        The minimum is considered bracketed if there are at least
+        minPointsPerSide measurements on each side of the best focus position
+        and the outermost measurement on each side has a FWHM at least rise
+        times the minimum FWHM.
+        '''
+        if self.bestFocus is None:
+            return False
+        Positions = np.array([r[0] for r in self.results], dtype=float)
+        FWHMs = np.array([r[1] for r in self.results], dtype=float)
+        Below = Positions < self.bestFocus
+        Above = Positions > self.bestFocus
+        if Below.sum() < minPointsPerSide or Above.sum() < minPointsPerSide:
+            return False
+        Threshold = rise * self.minFWHM
+        return FWHMs[Below][np.argmin(Positions[Below])] >= Threshold and\
+               FWHMs[Above][np.argmax(Positions[Above])] >= Threshold
+
+    def Analyze(self, nWorkers=4, analyze=AnalyzeFocusImage, stopEarly=True,
+                minPointsPerSide=2, rise=1.5):
+        '''
+        Analyze the images in the sequence and fit the focus curve.  The
+        analyze argument is the function called on each file (with the file,
+        telescope, and config objects as arguments) and must return a tuple
+        of focus position and FWHM.
+        '''
+        self.logger.info("Analyzing focus sequence of {0} images using {1} workers.".format(len(self.files), nWorkers))
+        pool = ThreadPool(nWorkers)
+        try:
+            Jobs = pool.imap_unordered(lambda file: analyze(file, self.tel, self.config), self.files)
+            for FocusPos, FWHM in Jobs:
+                if FocusPos is None or FWHM is None:
+                    self.logger.warning("No FWHM measured for image at focus position {0}".format(FocusPos))
+                    continue
+                self.results.append((float(FocusPos), FWHM))
+                self.logger.debug("Focus position {0}: FWHM = {1:.2f} pix".format(FocusPos, FWHM))
+                Fit = FitFocusCurve([r[0] for r in self.results], [r[1] for r in self.results])
+                if Fit:
+                    self.bestFocus, self.bestFocusUncertainty, self.minFWHM = Fit
+                    self.bracketed = self.IsBracketed(minPointsPerSide, rise)
+                if stopEarly and self.bracketed:
+                    self.logger.info("Best focus bracketed after {0} images.  Skipping remaining images.".format(len(self.results)))
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+        if self.bestFocus is not None:
+            if self.bestFocusUncertainty is not None:
+                self.logger.info("Best focus position = {0:.0f} +/- {1:.0f} (FWHM = {2:.2f} pix)".format(self.bestFocus, self.bestFocusUncertainty, self.minFWHM))
+            else:
+                self.logger.info("Best focus position = {0:.0f} (FWHM = {1:.2f} pix)".format(self.bestFocus, self.minFWHM))
+            if not self.bracketed:
+                self.logger.warning("Best focus position is not bracketed by the focus sequence.")
+        else:
+            self.logger.warning("Could not fit focus curve.")
+        return self.bestFocus, self.bestFocusUncertainty
+
+
+##-----------------------------------------------------------------------------
+## Define Mosaic object to analyze multi extension images
+##-----------------------------------------------------------------------------
+class Mosaic(object):
+    '''
+    Analyzes a multi extension fits file (i.e. from a mosaic camera) in which
+    each image extension is a chip with its own WCS.
+
+    Each chip is analyzed as a separate Image on a pool of worker threads
+    (see ProcessImage).  The worker analyzing a chip first writes (and for
+    compressed files decompresses) it to a single HDU file, with the
+    keywords of the primary header, such as DATE-OBS and EXPTIME, added to
+    its header.  The chip results are then combined in to focal plane
+    values:
+      - FWHM and ellipticity are the medians over the stars on all chips,
+      - the pointing error is the separation between the mean of the header
+        coordinates and the mean of the WCS coordinates of the centers of
+        the chips which have both (the header coordinates of all chips are
+        the same unless the chips have their own RA and DEC keywords).
+
+    Properties:
+      chips:          List of dictionaries with the results for each chip
+                      (chip name, FWHM, ellipticity, nStars, pointingError
+                      of the chip center in arcmin, and Image.Results()).
+      FWHM:           Focal plane FWHM (pixels).
+      ellipticity:    Focal plane ellipticity.
+      nStars:         Number of stars on all chips.
+      pointingError:  Focal plane pointing error (arcmin).
+    '''
+    def __init__(self, file, tel, config, logFile=None, verbose=False):
+        self.file = file
+        self.tel = tel
+        self.config = config
+        self.logFile = logFile
+        self.verbose = verbose
+        self.logger = logging.getLogger('IQMonLogger')
+        self.rawFileBasename = os.path.splitext(os.path.basename(file))[0]
+        if self.rawFileBasename.endswith('.fits'):
+            self.rawFileBasename = os.path.splitext(self.rawFileBasename)[0]
+        self.workspace = None
+        self.chips = []
+        self.FWHM = None
+        self.ellipticity = None
+        self.nStars = None
+        self.pointingError = None
+
+    def Split(self):
+        '''
+        Make a scratch directory for the chip files and list the image
+        extensions (only the headers are read).  Returns a list of (chip
+        name, extension) tuples.
+        '''
+        ScratchPath = getattr(self.config, 'pathScratch', None) or self.config.pathTemp
+        if not os.path.exists(ScratchPath):
+            os.makedirs(ScratchPath)
+        self.workspace = tempfile.mkdtemp(prefix=self.rawFileBasename+"_", dir=ScratchPath)
+        hdulist = fits.open(self.file, ignore_missing_end=True)
+        Chips = [(str(hdulist[i].header.get('EXTNAME', i)).strip(), i) for i in ImageExtensions(hdulist)]
+        hdulist.close()
+        self.logger.info("Split {0} in to {1} chips.".format(os.path.basename(self.file), len(Chips)))
+        return Chips
+
+    def WriteChip(self, chip):
+        '''
+        Write one image extension to its own file in the scratch directory.
+        Each call opens the file itself, so chips can be written by several
+        threads at once.  Returns the file name.
+        '''
+        Name, i = chip
+        hdulist = fits.open(self.file, memmap=False, ignore_missing_end=True)
+        PrimaryHeader = hdulist[0].header
+        Header = hdulist[i].header.copy()
+        for keyword in ['XTENSION', 'PCOUNT', 'GCOUNT', 'EXTNAME', 'ZIMAGE',
+                        'ZBITPIX', 'ZNAXIS', 'ZNAXIS1', 'ZNAXIS2', 'ZCMPTYPE']:
+            if keyword in Header: del Header[keyword]
+        if i != 0:
+            for card in PrimaryHeader.cards:
+                if not card.keyword in Header and\
+                   not card.keyword in ['SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'NEXTEND', 'COMMENT', 'HISTORY', '']:
+                    Header[card.keyword] = (card.value, card.comment)
+        ChipFile = os.path.join(self.workspace, "{0}_{1}.fits".format(self.rawFileBasename, Name))
+        fits.PrimaryHDU(hdulist[i].data, Header).writeto(ChipFile)
+        hdulist.close()
+        return ChipFile
+
+    def AnalyzeChip(self, chip, stages, darks, cache):
+        Name = chip[0]
+        ChipFile = self.WriteChip(chip)
+        image = Image(ChipFile, self.tel, self.config)
+        if self.logFile:
+            image.MakeLogger(self.logFile, self.verbose)
+        else:
+            image.logger = self.logger
+        image.chip = Name
+        Result = {'chip': Name, 'FWHM': None, 'ellipticity': None,
+                  'nStars': None, 'pointingError': None, 'center': None,
+                  'coordinate_header': None, 'FWHMs': [], 'ellipticities': []}
+        with image:
+            try:
+                ProcessImage(image, stages=stages, darks=darks, cache=cache)
+            except:
+                image.logger.error("Failed to analyze chip {0}: {1} {2}".format(Name, sys.exc_info()[0], sys.exc_info()[1]))
+            if image.FWHM is not None:
+                Result['FWHM'] = image.FWHM.to(u.pix).value
+                Result['ellipticity'] = image.ellipticity
+            Result['nStars'] = image.nStarsSEx
+            if image.pointingError:
+                Result['pointingError'] = image.pointingError.arcmins
+            if image.SExtractorResults is not None and len(image.SExtractorResults) > 0 and\
+               'FWHM_IMAGE' in image.SExtractorResults.colnames:
+                Result['FWHMs'] = np.asarray(image.SExtractorResults['FWHM_IMAGE'])
+                Result['ellipticities'] = np.asarray(image.SExtractorResults['ELLIPTICITY'])
+            if image.imageWCS:
+                Result['center'] = image.imageWCS.wcs_pix2world([[image.nXPix/2, image.nYPix/2]], 1)[0]
+            Result['coordinate_header'] = image.coordinate_header
+            Result['results'] = image.Results()
+        return Result
+
+    def Analyze(self, stages=None, nWorkers=4, darks=None, cache=None):
+        '''
+        Analyze all chips concurrently and combine the results.  stages,
+        darks, and cache are passed to ProcessImage for each chip (darks may
+        be a function of the chip image, which has the chip name in
+        image.chip).
+        '''
+        Chips = self.Split()
+        pool = ThreadPool(nWorkers)
+        try:
+            self.chips = pool.map(lambda chip: self.AnalyzeChip(chip, stages, darks, cache), Chips)
+        finally:
+            pool.terminate()
+            pool.join()
+            shutil.rmtree(self.workspace, ignore_errors=True)
+        for Chip in self.chips:
+            if Chip['FWHM'] is not None:
+                self.logger.info("Chip {0}: FWHM = {1:.2f} pix, ellipticity = {2:.2f}, {3} stars".format(
+                                 Chip['chip'], Chip['FWHM'], Chip['ellipticity'], Chip['nStars']))
+            else:
+                self.logger.warning("Chip {0}: FWHM not determined.".format(Chip['chip']))
+        ## Focal plane image quality from the stars on all chips
+        FWHMs = np.concatenate([np.asarray(Chip['FWHMs'], dtype=float) for Chip in self.chips] or [np.array([])])
+        Ellipticities = np.concatenate([np.asarray(Chip['ellipticities'], dtype=float) for Chip in self.chips] or [np.array([])])
+        self.nStars = len(FWHMs)
+        if self.nStars > 3:
+            self.FWHM = float(np.median(FWHMs))
+            self.ellipticity = float(np.median(Ellipticities))
+            self.logger.info("Focal plane: FWHM = {0:.2f} pix, ellipticity = {1:.2f}, {2} stars".format(self.FWHM, self.ellipticity, self.nStars))
+        ## Focal plane pointing from the mean directions of the chip centers
+        ## and of the header coordinates of the same chips
+        def MeanDirection(RA, Dec):
+            RA = np.radians(RA)
+            Dec = np.radians(Dec)
+            Vector = np.array([np.sum(np.cos(Dec)*np.cos(RA)), np.sum(np.cos(Dec)*np.sin(RA)), np.sum(np.sin(Dec))])
+            return coords.ICRSCoordinates(ra=math.degrees(math.atan2(Vector[1], Vector[0])) % 360.,
+                                          dec=math.degrees(math.atan2(Vector[2], math.sqrt(Vector[0]**2 + Vector[1]**2))),
+                                          unit=(u.degree, u.degree))
+        Chips = [Chip for Chip in self.chips if Chip['center'] is not None and Chip['coordinate_header'] is not None]
+        if Chips:
+            coordinate_WCS = MeanDirection([Chip['center'][0] for Chip in Chips],
+                                           [Chip['center'][1] for Chip in Chips])
+            coordinate_header = MeanDirection([Chip['coordinate_header'].ra.hours*15. for Chip in Chips],
+                                              [Chip['coordinate_header'].dec.radians*180./math.pi for Chip in Chips])
+            self.pointingError = coordinate_WCS.separation(coordinate_header).arcmins
+            self.logger.info("Focal plane pointing error is {0:.2f} arcmin".format(self.pointingError))
+        return self.Results()
+
+    def Results(self):
+        '''
+        Return the focal plane and per chip results as a dictionary of plain
+        python values.
+        '''
+        return {'file': os.path.basename(self.file),
+                'FWHM': self.FWHM,
+                'ellipticity': self.ellipticity,
+                'nStars': self.nStars,
+                'pointingError': self.pointingError,
+                'chips': [Chip['results'] for Chip in self.chips if 'results' in Chip]}
+
+
+##-----------------------------------------------------------------------------
+## Define TrackingReference object to hold the stars tracked through a field
+##-----------------------------------------------------------------------------
+class TrackingReference(object):
+    '''
+    Reference star list for tracking the stars in a time series of images of
+    one field (see Image.TrackStars).  It is set from the SExtractor results
+    of an image and is shared by the images in the series, so it may be used
+    from several worker threads.
+
+    Properties:
+      field:    The object name (OBJECT header keyword) of the field.
+      shape:    The (nY, nX) size of the image the reference was made from.
+      X, Y:     Positions of the reference stars in the reference image.
+      flux:     Peak flux of the reference stars (used to pick bright stars).
+      shift:    (dX, dY) shift of the most recently tracked image relative to
+                the reference image.
+      nTracked: Number of images tracked since the reference was set.
+    '''
+    def __init__(self, maxStars=500, edge=10):
+        self.maxStars = maxStars
+        self.edge = edge
+        self.field = None
+        self.shape = None
+        self.X = None
+        self.Y = None
+        self.flux = None
+        self.shift = (0., 0.)
+        self.nTracked = 0
+        self.lock = threading.Lock()
+
+    def Update(self, image):
+        '''
+        Set the reference from the SExtractor results of an image.  The
+        maxStars brightest unsaturated stars which are more than edge pixels
+        from the edge of the image are used.
+        '''
+        if image.SExtractorResults is None or len(image.SExtractorResults) == 0:
+            return
+        X = np.asarray(image.SExtractorResults['X_IMAGE'], dtype=float)
+        Y = np.asarray(image.SExtractorResults['Y_IMAGE'], dtype=float)
+        Flux = np.asarray(image.SExtractorResults['FLUX_MAX'], dtype=float)
+        Use = (X > self.edge) & (X < image.nXPix - self.edge) &\
+              (Y > self.edge) & (Y < image.nYPix - self.edge)
+        if image.tel.SExtractorSaturation:
+            Use &= Flux < image.tel.SExtractorSaturation.to(u.adu).value
+        Brightest = np.argsort(Flux[Use])[::-1][:self.maxStars]
+        with self.lock:
+            self.field = image.objectName
+            self.shape = (image.nYPix, image.nXPix)
+            self.X = X[Use][Brightest]
+            self.Y = Y[Use][Brightest]
+            self.flux = Flux[Use][Brightest]
+            self.shift = (0., 0.)
+            self.nTracked = 0
+        image.logger.info("Tracking reference set with {0} stars in field {1}.".format(len(self.X), self.field))
+
+    def Record(self, shift):
+        '''
+        Record the shift of a tracked image, which is used as the starting
+        point for the next image.
+        '''
+        with self.lock:
+            self.shift = shift
+            self.nTracked += 1
+
+    def Snapshot(self):
+        '''
+        Return a consistent copy of the reference as a dictionary, or None if
+        the reference has not been set.
+        '''
+        with self.lock:
+            if self.X is None or len(self.X) == 0:
+                return None
+            return {'field': self.field, 'shape': self.shape, 'X': self.X,
+                    'Y': self.Y, 'flux': self.flux, 'shift': self.shift}
+
+
+##-----------------------------------------------------------------------------
+## Define DriftReferences object to hold the drift reference for each field
+##-----------------------------------------------------------------------------
+class DriftReferences(object):
+    '''
+    Holds the FFT of the binned reference image for each field used by
+    Image.MeasureDrift, so the reference is only read and transformed once.
+    It may be shared by images processed in several worker threads.
+    '''
+    def __init__(self):
+        self.references = {}
+        self.lock = threading.Lock()
+
+    def Get(self, key):
+        '''
+        Return the (FFT, file name) tuple for the reference with this key, or
+        None if there is none yet.
+        '''
+        with self.lock:
+            return self.references.get(key)
+
+    def Set(self, key, referenceFFT, fileName):
+        with self.lock:
+            self.references[key] = (referenceFFT, fileName)
+
+    def Invalidate(self, field=None):
+        '''
+        Remove the reference for field (or all references), so the next image
+        of the field becomes the new reference.
+        '''
+        with self.lock:
+            for key in list(self.references.keys()):
+                if field is None or key[0] == field:
+                    del self.references[key]
+
+    def Log(self, driftLog, line):
+        '''
+        Append a line to the drift log, writing a header if the file is new.
+        '''
+        with self.lock:
+            IsNew = not os.path.exists(driftLog)
+            with open(driftLog, 'a') as LogFile:
+                if IsNew:
+                    LogFile.write("# {0:20s} {1:40s} {2:>8s} {3:>8s} {4:>8s} {5:>6s}\n".format(
+                                  "ExpStart", "File", "dX(\")", "dY(\")", "Drift(\")", "Peak"))
+                LogFile.write(line)
+
+
+##-----------------------------------------------------------------------------
+## Exceptions Raised by ProcessImage and AnalysisService
+##-----------------------------------------------------------------------------
+class DeadlineExceeded(RuntimeError):
+    '''
+    Raised when an image could not be processed before its deadline.
+    '''
+    pass
+
+
+class ServiceBusy(RuntimeError):
+    '''
+    Raised when the AnalysisService already has as many requests pending as
+    it will accept.
+    '''
+    pass
+
+
+##-----------------------------------------------------------------------------
+## Define CatalogArchive object to keep the SExtractor catalog of every image
+##-----------------------------------------------------------------------------
+class CatalogArchive(object):
+    '''
+    An append only, columnar archive of the SExtractor catalogs of many
+    images, so that FWHM, ellipticity, and PSF maps can be derived again
+    (i.e. after a change to DetermineFWHM or the thresholds) without running
+    SExtractor again.
+
+    Each column (see columns) is stored as one file of little endian float32
+    values in the archive directory and is read through a memory map.  The
+    index of frames (frames.jsonl) has one line per image with the file name,
+    observation date, telescope, image size, and the first row and number of
+    rows of its stars in the column files.  Appending writes the column data
+    before the index line, so a crash while appending leaves the archive
+    consistent (rows past the end of the last indexed frame are ignored and
+    overwritten by the next Append).
+
+    Appending and reading the index hold a FileLock on the index, so
+    several threads or processes can append to the same archive.  Get
+    returns one shared CatalogArchive object per directory.
+
+    Use the ArchiveCatalog stage to add images and Rederive (or "python
+    IQMon.py archive rederive") to derive the metrics of all frames at once.
+    '''
+    columns = ['X_IMAGE', 'Y_IMAGE', 'FWHM_IMAGE', 'ELLIPTICITY', 'THETA_IMAGE',
+               'FLUX_MAX', 'MAG_APER', 'MAGERR_APER']
+    archives = {}
+    archivesLock = threading.Lock()
+
+    def __init__(self, directory, columns=None):
+        self.directory = directory
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.indexFile = os.path.join(directory, "frames.jsonl")
+        self.lock = FileLock(self.indexFile)
+        self.frames = []
+        self.indexSize = None
+        self.logger = logging.getLogger('IQMonLogger')
+        ## Columns are fixed by the first Append (see columns.json)
+        ColumnsFile = os.path.join(directory, "columns.json")
+        with self.lock:
+            if os.path.exists(ColumnsFile):
+                with open(ColumnsFile, 'r') as input:
+                    self.columns = json.load(input)
+            else:
+                if columns:
+                    self.columns = list(columns)
+                with open(ColumnsFile, 'w') as output:
+                    json.dump(self.columns, output)
+
+    @classmethod
+    def Get(cls, directory):
+        '''
+        Return the shared CatalogArchive for directory.
+        '''
+        Key = os.path.abspath(directory)
+        with cls.archivesLock:
+            if not Key in cls.archives:
+                cls.archives[Key] = cls(directory)
+            return cls.archives[Key]
+
+    def __repr__(self):
+        return "CatalogArchive({0})".format(self.directory)
+
+    def ColumnFile(self, name):
+        return os.path.join(self.directory, name + ".f4")
+
+    def Frames(self):
+        '''
+        Return the list of frames in the index (re-read only if it grew).
+        '''
+        with self.lock:
+            return self.ReadIndex()
+
+    def ReadIndex(self):
+        '''
+        Read the index if it changed.  The caller must hold self.lock.
+        '''
+        Size = os.path.getsize(self.indexFile) if os.path.exists(self.indexFile) else 0
+        if Size != self.indexSize:
+            self.frames = []
+            if Size:
+                with open(self.indexFile, 'r') as input:
+                    for line in input:
+                        if line.strip():
+                            self.frames.append(json.loads(line))
+            self.indexSize = Size
+        return list(self.frames)
+
+    def nRows(self):
+        Frames = self.Frames()
+        if not Frames:
+            return 0
+        return Frames[-1]['start'] + Frames[-1]['count']
+
+    def Column(self, name):
+        '''
+        Return a column for all archived stars as a read only memory map.
+        '''
+        nRows = self.nRows()
+        if nRows == 0:
+            return np.zeros(0, dtype='<f4')
+        return np.memmap(self.ColumnFile(name), dtype='<f4', mode='r', shape=(nRows,))
+
+    def Append(self, image):
+        '''
+        Add the SExtractor catalog of an image to the archive.  Images already
+        in the archive (same file name and observation date) are skipped.
+        Returns the frame number or None.
+        '''
+        Results = image.SExtractorResults
+        if Results is None:
+            image.logger.warning("No SExtractor catalog to archive.")
+            return None
+        Missing = [name for name in self.columns if not name in Results.colnames]
+        if Missing:
+            raise KeyError("SExtractor catalog has no {0} column".format(", ".join(Missing)))
+        with self.lock:
+            Frames = self.ReadIndex()
+            for Frame in Frames:
+                if Frame['file'] == image.rawFileName and Frame['dateObs'] == image.dateObs:
+                    image.logger.info("Catalog of {0} is already archived.".format(image.rawFileName))
+                    return Frame['frame']
+            Start = 0
+            if Frames:
+                Start = Frames[-1]['start'] + Frames[-1]['count']
+            for name in self.columns:
+                with open(self.ColumnFile(name), 'ab') as output:
+                    output.truncate(4*Start)
+                    output.seek(4*Start)
+                    np.asarray(Results[name], dtype='<f4').tofile(output)
+            Frame = {'frame': len(Frames),
+                     'file': image.rawFileName,
+                     'dateObs': image.dateObs,
+                     'telescope': image.tel.name,
+                     'nXPix': image.nXPix,
+                     'nYPix': image.nYPix,
+                     'start': Start,
+                     'count': len(Results)}
+            with open(self.indexFile, 'a') as output:
+                output.write(json.dumps(Frame) + "\n")
+        image.logger.info("Archived {0} stars as frame {1}.".format(len(Results), Frame['frame']))
+        return Frame['frame']
+
+    def Rederive(self, IQRadiusFactor=1.0, nBins=3, minStars=5, frames=None):
+        '''
+        Derive the FWHM and ellipticity (as DetermineFWHM) and the grid PSF
+        map (as DeterminePSFMap) of every archived frame, or of the frames
+        whose numbers are in frames, at once.  The stars of all frames are
+        binned together (BinnedMedian with one bin per frame, or per frame
+        and grid cell) and the tilt and curvature are fit to all frames with
+        one stacked solve, so the cost scales with the number of stars, not
+        the number of frames.
+
+        Returns a dictionary of per frame arrays (nan where not determined)
+        and the list of frames.
+        '''
+        Frames = self.Frames()
+        if frames is not None:
+            Frames = [Frames[i] for i in frames]
+        nFrames = len(Frames)
+        Counts = np.array([Frame['count'] for Frame in Frames], dtype=int)
+        Starts = np.array([Frame['start'] for Frame in Frames], dtype=int)
+        ## Rows of the selected frames and the frame of each row
+        FrameIndex = np.repeat(np.arange(nFrames), Counts)
+        if frames is None:
+            Rows = slice(0, int(Counts.sum()))
+        else:
+            Rows = np.repeat(Starts - np.cumsum(Counts) + Counts, Counts) + np.arange(Counts.sum())
+        X = np.asarray(self.Column('X_IMAGE')[Rows], dtype=float)
+        Y = np.asarray(self.Column('Y_IMAGE')[Rows], dtype=float)
+        FWHMs = np.asarray(self.Column('FWHM_IMAGE')[Rows], dtype=float)
+        Ellipticities = np.asarray(self.Column('ELLIPTICITY')[Rows], dtype=float)
+        Thetas = np.radians(np.asarray(self.Column('THETA_IMAGE')[Rows], dtype=float))
+        nXPix = np.array([Frame['nXPix'] for Frame in Frames], dtype=float)[FrameIndex]
+        nYPix = np.array([Frame['nYPix'] for Frame in Frames], dtype=float)[FrameIndex]
+        DiagonalRadius = np.sqrt((nXPix/2)**2 + (nYPix/2)**2)
+
+        ## FWHM and ellipticity of stars in the central region
+        Central = np.sqrt((X - nXPix/2)**2 + (Y - nYPix/2)**2) <= DiagonalRadius*IQRadiusFactor
+        FWHM, nCentral = BinnedMedian(FWHMs[Central], FrameIndex[Central], nFrames)
+        Ellipticity, nCentral = BinnedMedian(Ellipticities[Central], FrameIndex[Central], nFrames)
+        Undetermined = (nCentral <= 3) | (Counts <= 1)
+        FWHM[Undetermined] = np.nan
+        Ellipticity[Undetermined] = np.nan
+
+        ## Grid PSF map
+        nCells = nBins*nBins
+        iX = np.clip((X-1)*nBins//nXPix, 0, nBins-1).astype(int)
+        iY = np.clip((Y-1)*nBins//nYPix, 0, nBins-1).astype(int)
+        Cell = FrameIndex*nCells + iY*nBins + iX
+        MapFWHM, nStars = BinnedMedian(FWHMs, Cell, nFrames*nCells)
+        MapEllipticity, nStars = BinnedMedian(Ellipticities, Cell, nFrames*nCells)
+        SumCos = np.bincount(Cell, weights=Ellipticities*np.cos(2*Thetas), minlength=nFrames*nCells)
+        SumSin = np.bincount(Cell, weights=Ellipticities*np.sin(2*Thetas), minlength=nFrames*nCells)
+        MapTheta = np.degrees(0.5*np.arctan2(SumSin, SumCos))
+        Sparse = nStars < minStars
+        MapFWHM[Sparse] = np.nan
+        MapEllipticity[Sparse] = np.nan
+        MapTheta[Sparse] = np.nan
+
+        ## Tilt and curvature: normal equations of every frame, solved at once
+        xNorm = (X - nXPix/2) / DiagonalRadius
+        yNorm = (Y - nYPix/2) / DiagonalRadius
+        Design = [np.ones(len(X)), xNorm, yNorm, xNorm**2 + yNorm**2]
+        Normal = np.zeros((nFrames, 4, 4))
+        RightSide = np.zeros((nFrames, 4))
+        for i in range(4):
+            RightSide[:,i] = np.bincount(FrameIndex, weights=Design[i]*FWHMs, minlength=nFrames)
+            for j in range(i, 4):
+                Normal[:,i,j] = np.bincount(FrameIndex, weights=Design[i]*Design[j], minlength=nFrames)
+                Normal[:,j,i] = Normal[:,i,j]
+        Fitted = (Counts >= 4) & (np.abs(np.linalg.det(Normal)) > 1e-12)
+        Coefficients = np.empty((nFrames, 4))
+        Coefficients.fill(np.nan)
+        if Fitted.any():
+            Coefficients[Fitted] = np.linalg.solve(Normal[Fitted], RightSide[Fitted][:,:,None])[:,:,0]
+
+        return {'frames': Frames,
+                'nStars': Counts,
+                'nCentral': nCentral,
+                'FWHM': FWHM,
+                'ellipticity': Ellipticity,
+                'PSFMapFWHM': MapFWHM.reshape((nFrames, nBins, nBins)),
+                'PSFMapEllipticity': MapEllipticity.reshape((nFrames, nBins, nBins)),
+                'PSFMapTheta': MapTheta.reshape((nFrames, nBins, nBins)),
+                'PSFMapNStars': nStars.reshape((nFrames, nBins, nBins)),
+                'coefficients': Coefficients,
+                'tilt': np.sqrt(Coefficients[:,1]**2 + Coefficients[:,2]**2),
+                'tiltAngle': np.degrees(np.arctan2(Coefficients[:,2], Coefficients[:,1])),
+                'curvature': Coefficients[:,3]}
+
+
+##-----------------------------------------------------------------------------
+## Define ResultCache object to reuse the results of analysis stages
+##-----------------------------------------------------------------------------
+## Stages whose results are stored in a ResultCache.  ReadImage and GetHeader
+## are cheap and always run, MakeJPEG writes outside the workspace, and
+## CalculateProcessTime depends on the time.
+CachedStages = ['SolveAstrometry', 'DeterminePointingError', 'DarkSubtract',
+                'CalibrateROI', 'Crop', 'RunSExtractor', 'EstimateBackground',
+                'DetermineFWHM', 'DeterminePSFMap', 'QuickLook', 'Triage',
+                'Calibrate']
+
+## Stages whose results depend on other images (through a TrackingReference
+## or DriftReferences object).  No stages after one of these are cached.
+StatefulStages = ['TrackStars', 'MeasureDrift']
+
+## Version of each stage.  Increment a stage's version when a change to it
+## alters its results, so that cached results from the old version are not
+## used.
+StageVersions = {'RunSExtractor': 2}
+
+class ResultCache(object):
+    '''
+    Stores the results of each analysis stage so that reprocessing an image
+    (i.e. after a crash or a change to the reporting) skips every stage whose
+    inputs have not changed.
+
+    Results are keyed by a hash of:
+      - the content of the raw file,
+      - a fingerprint of the Telescope properties and the SExtractor
+        parameter file,
+      - the stage name, version (StageVersions), and arguments, including
+        the size and modification time of any files (i.e. darks) passed as
+        arguments,
+      - and the key of the previous stage, so a change early in the stage
+        list invalidates everything after it.
+
+    A cache entry holds the image attributes changed by the stage (pickled),
+    copies of any workspace files they refer to (i.e. the solved working
+    file or the SExtractor catalog) or which the stage rewrote in place
+    (i.e. the working file after Crop or DarkSubtract), and the stages
+    which failed (see image.failedStages).  When the total size exceeds
+    maxSize bytes, the least recently used entries are removed.
+
+    Use with ProcessImage (cache argument).  Verify and Invalidate can also
+    be run from the command line (see main).
+    '''
+    ## Attributes which are not results of a stage.
+    excluded = ['logger', 'logFile', 'tel', 'config', 'workspace', 'tempFiles',
+                'startProcessTime', 'stageTimes', 'stageFinished',
+                'skippedStages', 'triagedStages', 'cacheKey', 'rawHash', 'cachedStages',
+                'failedStages', 'SExtractorColumns']
+
+    def __init__(self, config=None, directory=None, maxSize=2*1024**3):
+        if not directory:
+            directory = getattr(config, 'pathCache', None) or os.path.join(config.pathTemp, "Cache")
+        self.directory = directory
+        self.maxSize = maxSize
+        self.logger = logging.getLogger('IQMonLogger')
+        self.lock = threading.Lock()
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        ## Size and last use time of each entry
+        self.entries = {}
+        for key in os.listdir(self.directory):
+            EntryPath = os.path.join(self.directory, key)
+            if os.path.exists(os.path.join(EntryPath, "entry.json")):
+                self.entries[key] = [self.EntrySize(EntryPath), os.path.getmtime(EntryPath)]
+
+    def EntrySize(self, entryPath):
+        return sum([os.path.getsize(os.path.join(entryPath, file)) for file in os.listdir(entryPath)])
+
+    def Fingerprint(self, value):
+        '''
+        Return a string describing value for use in a cache key.  Strings
+        which are the paths of existing files include the file size and
+        modification time.
+        '''
+        if isinstance(value, dict):
+            return "{" + ", ".join(["{0}: {1}".format(key, self.Fingerprint(value[key])) for key in sorted(value.keys())]) + "}"
+        if isinstance(value, (list, tuple)):
+            return "[" + ", ".join([self.Fingerprint(item) for item in value]) + "]"
+        if isinstance(value, str) and os.path.isfile(value):
+            return "{0} ({1} bytes, {2:.3f})".format(value, os.path.getsize(value), os.path.getmtime(value))
+        return repr(value)
+
+    def ImageKey(self, image):
+        '''
+        Return the starting key for an image: the hash of the raw file
+        content and the telescope fingerprint.
+        '''
+        if not getattr(image, 'rawHash', None):
+            Hash = hashlib.sha1()
+            with open(image.rawFile, 'rb') as FileObject:
+                for Block in iter(lambda: FileObject.read(1024**2), b''):
+                    Hash.update(Block)
+            image.rawHash = Hash.hexdigest()
+        Telescope = dict([(key, value) for key, value in vars(image.tel).items()
+                          if not key in ['site', 'frozen', 'pixelScaleEquivalency']])
+        Site = getattr(image.tel, 'site', None)
+        if Site is not None:
+            Telescope['site'] = (str(Site.lat), str(Site.lon), Site.elevation)
+        Key = hashlib.sha1()
+        Key.update(image.rawHash.encode())
+        Key.update(self.Fingerprint(Telescope).encode())
+        if image.SExtractorColumns:
+            Key.update(self.Fingerprint(image.SExtractorColumns).encode())
+        elif image.config and image.config.pathIQMonExec:
+            Key.update(self.Fingerprint(os.path.join(image.config.pathIQMonExec, "default.param")).encode())
+        return Key.hexdigest()
+
+    def StageKey(self, previousKey, name, kwargs):
+        Key = hashlib.sha1()
+        Key.update(previousKey.encode())
+        Key.update("{0} v{1} {2}".format(name, StageVersions.get(name, 1), self.Fingerprint(kwargs)).encode())
+        return Key.hexdigest()
+
+    def Load(self, key, image):
+        '''
+        If there is an entry for key, restore its attributes (and files, in
+        to the image's workspace) to image and return True.
+        '''
+        EntryPath = os.path.join(self.directory, key)
+        with self.lock:
+            if not key in self.entries:
+                return False
+            try:
+                with open(os.path.join(EntryPath, "entry.json"), 'r') as FileObject:
+                    Entry = json.load(FileObject)
+                with open(os.path.join(EntryPath, "attributes.pickle"), 'rb') as FileObject:
+                    Attributes = pickle.load(FileObject)
+                for attribute, file in Entry['files'].items():
+                    Attributes[attribute] = image.WorkspaceFile(file)
+                    if os.path.exists(Attributes[attribute]): os.remove(Attributes[attribute])
+                    try:
+                        os.link(os.path.join(EntryPath, file), Attributes[attribute])
+                    except OSError:
+                        shutil.copy2(os.path.join(EntryPath, file), Attributes[attribute])
+            except:
+                self.logger.warning("Failed to read cache entry {0}: {1} {2}".format(key, sys.exc_info()[0], sys.exc_info()[1]))
+                return False
+            os.utime(EntryPath, None)
+            self.entries[key][1] = time.time()
+        for attribute, value in Attributes.items():
+            setattr(image, attribute, value)
+        image.failedStages.extend(Entry.get('failed', []))
+        return True
+
+    def WorkspaceFiles(self, image):
+        '''
+        Return the (size, modification time, inode) of each workspace file
+        an attribute of image refers to, by attribute.
+        '''
+        Files = {}
+        Workspace = image.workspace
+        for attribute, value in vars(image).items():
+            if isinstance(value, str) and Workspace and value.startswith(Workspace) and os.path.isfile(value):
+                Stat = os.stat(value)
+                Files[attribute] = (value, Stat.st_size, Stat.st_mtime, Stat.st_ino)
+        return Files
+
+    def Digest(self, value):
+        '''
+        Return a hash of the pickled value, or None if it can not be pickled.
+        '''
+        try:
+            return hashlib.sha1(pickle.dumps(value, 2)).hexdigest()
+        except:
+            return None
+
+    def Snapshot(self, image):
+        '''
+        Record the state of image before a stage is run (see Store): each
+        attribute and a hash of its pickled value, so that lists, dicts, and
+        tables changed in place are noticed.
+        '''
+        return {'attributes': dict([(attribute, (value, self.Digest(value)))
+                                    for attribute, value in vars(image).items()
+                                    if not attribute in self.excluded]),
+                'files': self.WorkspaceFiles(image),
+                'nFailed': len(image.failedStages)}
+
+    def Store(self, key, name, image, before):
+        '''
+        Store the attributes of image which changed since before (a Snapshot
+        from before the stage was run), including attributes which are the
+        same object but were changed in place and attributes which still
+        refer to the same workspace file if the stage rewrote that file, and
+        the stages which failed.
+        '''
+        Attributes = {}
+        Files = {}
+        Workspace = image.workspace
+        FilesBefore = before['files']
+        FilesAfter = self.WorkspaceFiles(image)
+        for attribute, value in vars(image).items():
+            if attribute in self.excluded:
+                continue
+            if attribute in before['attributes'] and FilesBefore.get(attribute) == FilesAfter.get(attribute):
+                ValueBefore, DigestBefore = before['attributes'][attribute]
+                if ValueBefore is value and (DigestBefore is None or DigestBefore == self.Digest(value)):
+                    continue
+            if attribute in FilesAfter:
+                Files[attribute] = os.path.basename(value)
+            else:
+                Attributes[attribute] = value
+        NewEntryPath = os.path.join(self.directory, ".new_" + key)
+        EntryPath = os.path.join(self.directory, key)
+        try:
+            if os.path.exists(NewEntryPath): shutil.rmtree(NewEntryPath)
+            os.makedirs(NewEntryPath)
+            with open(os.path.join(NewEntryPath, "attributes.pickle"), 'wb') as FileObject:
+                pickle.dump(Attributes, FileObject, 2)
+            Entry = {'key': key, 'stage': name, 'file': image.rawFileName,
+                     'created': time.time(), 'files': Files, 'checksums': {},
+                     'failed': image.failedStages[before['nFailed']:]}
+            for attribute, file in Files.items():
+                shutil.copy2(getattr(image, attribute), os.path.join(NewEntryPath, file))
+            for file in os.listdir(NewEntryPath):
+                Entry['checksums'][file] = self.Checksum(os.path.join(NewEntryPath, file))
+            with open(os.path.join(NewEntryPath, "entry.json"), 'w') as FileObject:
+                json.dump(Entry, FileObject)
+        except:
+            self.logger.warning("Not caching {0} stage: {1} {2}".format(name, sys.exc_info()[0], sys.exc_info()[1]))
+            shutil.rmtree(NewEntryPath, ignore_errors=True)
+            return
+        with self.lock:
+            if os.path.exists(EntryPath): shutil.rmtree(EntryPath)
+            os.rename(NewEntryPath, EntryPath)
+            self.entries[key] = [self.EntrySize(EntryPath), time.time()]
+            self.Evict()
+
+    def Checksum(self, file):
+        Hash = hashlib.sha1()
+        with open(file, 'rb') as FileObject:
+            for Block in iter(lambda: FileObject.read(1024**2), b''):
+                Hash.update(Block)
+        return Hash.hexdigest()
+
+    def Evict(self):
+        '''
+        Remove the least recently used entries until the cache is smaller
+        than maxSize.  Must be called with the lock held.
+        '''
+        TotalSize = sum([entry[0] for entry in self.entries.values()])
+        for key in sorted(self.entries.keys(), key=lambda key: self.entries[key][1]):
+            if TotalSize <= self.maxSize:
+                break
+            TotalSize -= self.entries[key][0]
+            self.Remove(key)
+
+    def Remove(self, key):
+        shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+        self.entries.pop(key, None)
+
+    def Verify(self):
+        '''
+        Check that every entry is complete and its files match their
+        checksums.  Bad entries are removed.  Returns the number of entries
+        checked and the number removed.
+        '''
+        nRemoved = 0
+        with self.lock:
+            Keys = list(self.entries.keys())
+            for key in Keys:
+                EntryPath = os.path.join(self.directory, key)
+                try:
+                    with open(os.path.join(EntryPath, "entry.json"), 'r') as FileObject:
+                        Entry = json.load(FileObject)
+                    Good = all([self.Checksum(os.path.join(EntryPath, file)) == checksum
+                                for file, checksum in Entry['checksums'].items()])
+                except:
+                    Good = False
+                if not Good:
+                    self.logger.warning("Removing bad cache entry {0}".format(key))
+                    self.Remove(key)
+                    nRemoved += 1
+        return len(Keys), nRemoved
+
+    def Invalidate(self, file=None, stage=None):
+        '''
+        Remove the entries for a raw file name and/or stage, or all entries if
+        neither is given.  Returns the number of entries removed.
+        '''
+        nRemoved = 0
+        with self.lock:
+            for key in list(self.entries.keys()):
+                try:
+                    with open(os.path.join(self.directory, key, "entry.json"), 'r') as FileObject:
+                        Entry = json.load(FileObject)
+                except:
+                    Entry = {}
+                if (file and Entry.get('file') != os.path.basename(file)) or\
+                   (stage and Entry.get('stage') != stage):
+                    continue
+                self.Remove(key)
+                nRemoved += 1
+        return nRemoved
+
+
+##-----------------------------------------------------------------------------
+## Run a Sequence of Analysis Steps on an Image
+##-----------------------------------------------------------------------------
+## Image methods which may be requested as processing stages.
+Stages = ['ReadImage', 'GetHeader', 'MakeJPEG', 'SolveAstrometry',
+          'DeterminePointingError', 'DarkSubtract', 'CalibrateROI', 'Crop',
+          'RunSExtractor', 'EstimateBackground', 'DetermineFWHM',
+          'DeterminePSFMap', 'QuickLook', 'Triage', 'TrackStars', 'MeasureDrift', 'Calibrate',
+          'ArchiveCatalog', 'CalculateProcessTime']
+
+## Stages which ProcessImage skips for images which fail Triage.
+TriagedStages = ['MakeJPEG', 'SolveAstrometry', 'DarkSubtract', 'CalibrateROI',
+                 'Crop', 'RunSExtractor', 'EstimateBackground', 'DetermineFWHM',
+                 'DeterminePSFMap', 'QuickLook', 'TrackStars', 'MeasureDrift',
+                 'Calibrate', 'ArchiveCatalog']
+
+## Stages needed to determine FWHM, ellipticity, and pointing error.
+DefaultStages = ['ReadImage', 'GetHeader', 'Triage', 'DeterminePointingError',
+                 'CalibrateROI', 'GetHeader', 'RunSExtractor', 'DetermineFWHM',
+                 'CalculateProcessTime']
+
+## SExtractor catalog columns read by each stage.  X_IMAGE and Y_IMAGE are
+## always measured (RunSExtractor uses them).
+StageColumns = {'RunSExtractor': ['X_IMAGE', 'Y_IMAGE'],
+                'DetermineFWHM': ['FWHM_IMAGE', 'ELLIPTICITY'],
+                'DeterminePSFMap': ['FWHM_IMAGE', 'ELLIPTICITY', 'THETA_IMAGE'],
+                'QuickLook': ['FWHM_IMAGE', 'ELLIPTICITY'],
+                'TrackStars': ['FLUX_MAX'],
+                'ArchiveCatalog': CatalogArchive.columns,
+               }
+
+## Columns needed to make a catalog for SCAMP (see default.param).
+SCAMPColumns = ['XWIN_IMAGE', 'YWIN_IMAGE', 'ERRAWIN_IMAGE', 'ERRBWIN_IMAGE',
+                'ERRTHETAWIN_IMAGE', 'FLUX_AUTO', 'FLUXERR_AUTO', 'FLAGS',
+                'FLAGS_WEIGHT', 'FLUX_RADIUS']
+
+def SExtractorParameters(stages, extra=None):
+    '''
+    Return the SExtractor catalog columns needed by a list of stages (see
+    StageColumns) plus any extra columns (i.e. SCAMPColumns), in the order
+    they were first needed.  MakeJPEG needs MAG_AUTO when it marks stars and
+    ArchiveCatalog needs the columns of its archive.
+    '''
+    Columns = list(StageColumns['RunSExtractor'])
+    for stage in stages:
+        if isinstance(stage, (list, tuple)):
+            name, kwargs = stage[0], dict(stage[1])
+        else:
+            name, kwargs = stage, {}
+        Needed = list(StageColumns.get(name, []))
+        if name == 'MakeJPEG' and kwargs.get('markStars'):
+            Needed = ['MAG_AUTO']
+        if name == 'ArchiveCatalog' and kwargs.get('archive'):
+            Needed = kwargs['archive'].columns
+        for column in Needed:
+            if not column in Columns:
+                Columns.append(column)
+    for column in (extra or []):
+        if not column in Columns:
+            Columns.append(column)
+    return Columns
+
+##-----------------------------------------------------------------------------
+## Define Metrics object to count processed images and time stages
+##-----------------------------------------------------------------------------
+class Metrics(object):
+    '''
+    In process counters, gauges, and histograms of the images processed,
+    stage times and failures, queue wait, and service requests, which can be
+    exported in the Prometheus text format (Text), written to a textfile for
+    the node exporter textfile collector (WriteTextfile, StartWriter), or
+    served at /metrics by an AnalysisService.
+
+    Updates only take a lock and add to a number, so the overhead on each
+    stage is negligible.  ProcessImage, Scheduler, and AnalysisService
+    update the module level ServiceMetrics object unless given another.
+
+    Metrics (labels):
+      iqmon_images_processed_total:      images processed (status).
+      iqmon_image_seconds:               processing time per image.
+      iqmon_stage_seconds:               time per stage (stage).
+      iqmon_stage_failures_total:        failed stages (stage).
+      iqmon_stages_skipped_total:        skipped stages (stage, reason: triage
+                                         or skip).
+      iqmon_stages_cached_total:         stages loaded from cache (stage).
+      iqmon_queue_wait_seconds:          time from submission to start.
+      iqmon_latency_seconds:             time from shutter to results.
+      iqmon_queue_depth:                 images waiting in the Scheduler.
+      iqmon_requests_total:              AnalysisService requests (status).
+    '''
+    buckets = [0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300.]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.descriptions = OrderedDict()
+        self.values = {}
+        self.writer = None
+        self.stopWriter = threading.Event()
+        for name, kind, description in [
+            ('iqmon_images_processed_total', 'counter', 'Images processed.'),
+            ('iqmon_image_seconds', 'histogram', 'Processing time per image in seconds.'),
+            ('iqmon_stage_seconds', 'histogram', 'Time taken by each stage in seconds.'),
+            ('iqmon_stage_failures_total', 'counter', 'Stages which failed.'),
+            ('iqmon_stages_skipped_total', 'counter', 'Stages which were skipped.'),
+            ('iqmon_stages_cached_total', 'counter', 'Stages whose results were loaded from the cache.'),
+            ('iqmon_queue_wait_seconds', 'histogram', 'Time from submission to start of processing in seconds.'),
+            ('iqmon_latency_seconds', 'histogram', 'Time from shutter (or submission) to results in seconds.'),
+            ('iqmon_queue_depth', 'gauge', 'Images waiting to be processed.'),
+            ('iqmon_requests_total', 'counter', 'Analysis service requests.')]:
+            self.Describe(name, kind, description)
+
+    def Describe(self, name, kind, description):
+        '''
+        Add a metric of type kind (counter, gauge, or histogram).
+        '''
+        with self.lock:
+            self.descriptions[name] = (kind, description)
+            self.values.setdefault(name, {})
+
+    def Increment(self, name, value=1, **labels):
+        Key = tuple(sorted(labels.items()))
+        with self.lock:
+            Values = self.values[name]
+            Values[Key] = Values.get(Key, 0) + value
+
+    def Set(self, name, value, **labels):
+        Key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][Key] = value
+
+    def Observe(self, name, value, **labels):
+        '''
+        Add value to a histogram.
+        '''
+        Key = tuple(sorted(labels.items()))
+        Bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            Values = self.values[name]
+            if not Key in Values:
+                Values[Key] = [[0]*(len(self.buckets)+1), 0., 0]
+            Histogram = Values[Key]
+            Histogram[0][Bucket] += 1
+            Histogram[1] += value
+            Histogram[2] += 1
+
+    def Text(self):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        '''
+        def Labels(key, extra=()):
+            Pairs = ['{0}="{1}"'.format(label, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for label, value in list(key) + list(extra)]
+            if Pairs:
+                return '{' + ','.join(Pairs) + '}'
+            return ''
+        Lines = []
+        with self.lock:
+            for name, (kind, description) in self.descriptions.items():
+                Lines.append('# HELP {0} {1}'.format(name, description))
+                Lines.append('# TYPE {0} {1}'.format(name, kind))
+                for Key in sorted(self.values[name].keys()):
+                    Value = self.values[name][Key]
+                    if kind != 'histogram':
+                        Lines.append('{0}{1} {2}'.format(name, Labels(Key), repr(float(Value))))
+                        continue
+                    Counts, Sum, Count = Value
+                    Cumulative = 0
+                    for Bound, n in zip(self.buckets + ['+Inf'], Counts):
+                        Cumulative += n
+                        Lines.append('{0}_bucket{1} {2}'.format(name, Labels(Key, [('le', Bound)]), Cumulative))
+                    Lines.append('{0}_sum{1} {2}'.format(name, Labels(Key), repr(float(Sum))))
+                    Lines.append('{0}_count{1} {2}'.format(name, Labels(Key), Count))
+        return '\n'.join(Lines) + '\n'
+
+    def WriteTextfile(self, file):
+        '''
+        Write the metrics to file, replacing it atomically so a collector
+        never reads a partial file.
+        '''
+        TempFile = file + ".tmp"
+        with open(TempFile, 'w') as output:
+            output.write(self.Text())
+        if os.path.exists(file) and sys.platform.startswith('win'):
+            os.remove(file)
+        os.rename(TempFile, file)
+
+    def StartWriter(self, file, interval=15.):
+        '''
+        Rewrite the textfile every interval seconds in a background thread.
+        '''
+        def Write():
+            while not self.stopWriter.wait(interval):
+                try:
+                    self.WriteTextfile(file)
+                except (IOError, OSError):
+                    logging.getLogger('IQMonLogger').warning("Failed to write metrics to {0}".format(file))
+            self.WriteTextfile(file)
+        self.stopWriter.clear()
+        self.writer = threading.Thread(target=Write, name="IQMonMetrics")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def StopWriter(self):
+        '''
+        Stop the background writer (writing the textfile one last time).
+        '''
+        if self.writer:
+            self.stopWriter.set()
+            self.writer.join()
+            self.writer = None
+
+
+ServiceMetrics = Metrics()
+
+
+def ProcessImage(image, stages=None, deadline=None, darks=None, skip=None,
+                 cache=None, metrics=None, columns=None):
+    '''
+    Run a sequence of stages on an image.
+
+    Each stage is the name of an Image method (see Stages) or a tuple of the
+    name and a dictionary of keyword arguments.  DarkSubtract, CalibrateROI,
+    and Calibrate stages given without arguments use darks, which is either a
+    list of dark files, a DarkLibrary, or a function which takes the image and
+    returns a list of dark files.
+    The time taken by each stage is accumulated in image.stageTimes and the
+    time each stage finished is recorded in image.stageFinished.
+
+    If deadline (a time.time() value) passes, DeadlineExceeded is raised
+    before the next stage is started.  skip is an optional function which
+    takes the image, stage name, and keyword arguments and returns True if
+    that stage should be skipped; those stages are listed in
+    image.skippedStages.  Stages in TriagedStages are also skipped if the
+    image failed Triage; those are listed in image.triagedStages.
+
+    SExtractor measures the columns in default.param unless columns is
+    given: with columns='stages' it only measures the catalog columns the
+    stages use (see SExtractorParameters), and a list of columns adds those
+    to the ones the stages use (i.e. SCAMPColumns).  This is not done if
+    image.SExtractorColumns is already set.
+
+    If cache (a ResultCache) is given, the stages in CachedStages whose
+    results are in the cache are not run and the cached results are used
+    instead.  The names of those stages are listed in image.cachedStages.
+
+    Stage times, failures (stages which raise or which add themselves to
+    image.failedStages), skipped and cached stages are counted in metrics
+    (default ServiceMetrics).
+    The caller is responsible for
+    cleaning up the image (i.e. by using it in a with statement).
+    '''
+    if stages is None:
+        stages = DefaultStages
+    if metrics is None:
+        metrics = ServiceMetrics
+    if image.SExtractorColumns is None and columns == 'stages':
+        image.SExtractorColumns = SExtractorParameters(stages)
+    elif image.SExtractorColumns is None and columns:
+        image.SExtractorColumns = SExtractorParameters(stages, extra=columns)
+    if cache:
+        image.cacheKey = cache.ImageKey(image)
+    ImageStartTime = time.time()
+    name = None
+    try:
+        for stage in stages:
+            if isinstance(stage, (list, tuple)):
+                name, kwargs = stage[0], dict(stage[1])
+            else:
+                name, kwargs = stage, {}
+            if not name in Stages:
+                raise ValueError("Unknown stage: {0}".format(name))
+            if deadline and time.time() > deadline:
+                raise DeadlineExceeded("Deadline passed before {0} stage of {1}".format(name, image.rawFileName))
+            if image.analyzable is False and name in TriagedStages:
+                image.logger.info("Skipping {0} stage (failed triage).".format(name))
+                image.triagedStages.append(name)
+                metrics.Increment('iqmon_stages_skipped_total', stage=name, reason='triage')
+                if image.cacheKey:
+                    image.cacheKey = cache.StageKey(image.cacheKey, "Skip"+name, {})
+                continue
+            if skip and skip(image, name, kwargs):
+                image.logger.info("Skipping {0} stage.".format(name))
+                image.skippedStages.append(name)
+                metrics.Increment('iqmon_stages_skipped_total', stage=name, reason='skip')
+                if image.cacheKey:
+                    image.cacheKey = cache.StageKey(image.cacheKey, "Skip"+name, {})
+                continue
+            if name in ['DarkSubtract', 'CalibrateROI', 'Calibrate'] and not kwargs:
+                if callable(darks):
+                    kwargs['Darks'] = darks(image)
+                else:
+                    kwargs['Darks'] = darks
+            StartTime = time.time()
+            nFailed = len(image.failedStages)
+            if image.cacheKey:
+                image.cacheKey = cache.StageKey(image.cacheKey, name, kwargs)
+            if image.cacheKey and name in CachedStages and cache.Load(image.cacheKey, image):
+                image.logger.info("Using cached results for {0} stage.".format(name))
+                image.cachedStages.append(name)
+                metrics.Increment('iqmon_stages_cached_total', stage=name)
+            elif image.cacheKey and name in CachedStages:
+                Before = cache.Snapshot(image)
+                getattr(image, name)(**kwargs)
+                cache.Store(image.cacheKey, name, image, Before)
+            else:
+                getattr(image, name)(**kwargs)
+            if name in StatefulStages:
+                image.cacheKey = None
+            image.stageFinished[name] = time.time()
+            image.stageTimes[name] = image.stageTimes.get(name, 0.) + image.stageFinished[name] - StartTime
+            metrics.Observe('iqmon_stage_seconds', image.stageFinished[name] - StartTime, stage=name)
+            if name in image.failedStages[nFailed:]:
+                metrics.Increment('iqmon_stage_failures_total', stage=name)
+    except DeadlineExceeded:
+        metrics.Increment('iqmon_images_processed_total', status='deadline')
+        raise
+    except:
+        if name:
+            metrics.Increment('iqmon_stage_failures_total', stage=name)
+        metrics.Increment('iqmon_images_processed_total', status='failed')
+        raise
+    metrics.Increment('iqmon_images_processed_total', status='ok')
+    metrics.Observe('iqmon_image_seconds', time.time() - ImageStartTime)
+    return image
+
+
+##-----------------------------------------------------------------------------
+## Define AnalysisService object to analyze images on request
+##-----------------------------------------------------------------------------
+class AnalysisService(object):
+    '''
+    Analyzes images on request using a pool of worker threads which share
+    already initialized Config and Telescope objects and calibration
+    information (darks), so that a request does not pay for starting python,
+    importing modules, or setting up the telescope.
+
+    Requests can be made directly (Analyze) or over HTTP on localhost (Serve
+    and AnalysisClient).  At most maxPending requests are accepted at once
+    (a request stays pending until its image is processed, even if its
+    deadline passed), further requests are rejected with ServiceBusy so that
+    callers can back off rather than pile up.  Each request can have a deadline in seconds.
+
+    Properties:
+      tel:          The IQMon.Telescope object.
+      config:       The IQMon.Config object.
+      darks:        List of dark files or function returning a list of dark
+                    files for an image (see ProcessImage).
+      logFile:      Log file used for all requests.
+      nWorkers:     Number of worker threads.
+      maxPending:   Maximum number of requests queued or in progress.
+      cache:        Optional ResultCache (see ProcessImage).
+      metrics:      Metrics object updated by each request (default
+                    ServiceMetrics) and served at /metrics.
+      columns:      SExtractor columns to measure (see ProcessImage).
+    '''
+    def __init__(self, tel, config, darks=None, logFile=None, verbose=False,
+                 nWorkers=4, maxPending=16, cache=None, metrics=None,
+                 columns=None):
+        self.tel = tel
+        self.cache = cache
+        self.columns = columns
+        self.metrics = metrics or ServiceMetrics
+        self.config = config
+        self.darks = darks
+        self.logFile = logFile
+        self.verbose = verbose
+        self.nWorkers = nWorkers
+        self.maxPending = maxPending
+        self.logger = logging.getLogger('IQMonLogger')
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.server = None
+        ## Warm up: import modules now rather than on the first request
+        for module in [ephem, u, fits, coords, table, wcs]:
+            module.Load()
+        self.pool = ThreadPool(nWorkers)
+
+    def Process(self, file, stages, deadline):
+        '''
+        Process one image in a worker thread and return its results.
+        '''
+        image = Image(file, self.tel, self.config)
+        if self.logFile:
+            image.MakeLogger(self.logFile, self.verbose)
+        else:
+            image.logger = self.logger
+        with image:
+            ProcessImage(image, stages=stages, deadline=deadline, darks=self.darks,
+                         cache=self.cache, metrics=self.metrics, columns=self.columns)
+            return image.Results()
+
+    def Run(self, file, stages, deadline):
+        '''
+        Process one image (see Process) and count the request as no longer
+        pending when it finishes, even if the caller stopped waiting for it.
+        '''
+        try:
+            return self.Process(file, stages, deadline)
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def Analyze(self, file, stages=None, deadline=None):
+        '''
+        Analyze an image and return the results dictionary (see
+        Image.Results).  deadline is in seconds from now.  Raises ServiceBusy
+        if too many requests are pending and DeadlineExceeded if the results
+        are not ready in time.
+        '''
+        if stages:
+            for stage in stages:
+                name = stage[0] if isinstance(stage, (list, tuple)) else stage
+                if not name in Stages:
+                    raise ValueError("Unknown stage: {0}".format(name))
+        with self.lock:
+            if self.pending >= self.maxPending:
+                self.metrics.Increment('iqmon_requests_total', status='busy')
+                raise ServiceBusy("{0} requests already pending".format(self.pending))
+            self.pending += 1
+        if deadline:
+            Deadline = time.time() + deadline
+        else:
+            Deadline = None
+        try:
+            Job = self.pool.apply_async(self.Run, (file, stages, Deadline))
+        except:
+            with self.lock:
+                self.pending -= 1
+            raise
+        try:
+            Results = Job.get(deadline)
+        except (multiprocessing.TimeoutError, DeadlineExceeded):
+            self.metrics.Increment('iqmon_requests_total', status='deadline')
+            if sys.exc_info()[0] == DeadlineExceeded:
+                raise
+            raise DeadlineExceeded("No result for {0} after {1:.1f} s".format(file, deadline))
+        except:
+            self.metrics.Increment('iqmon_requests_total', status='error')
+            raise
+        self.metrics.Increment('iqmon_requests_total', status='ok')
+        return Results
+
+    def Serve(self, port=8765, background=False):
+        '''
+        Serve requests over HTTP on localhost.  POST /analyze with a JSON body
+        of the form {"file": ..., "stages": [...], "deadline": ...} returns
+        the results as JSON.  GET /health returns the service status and GET
+        /metrics the metrics in Prometheus text format.  If background is
+        True, the server runs in a separate thread.
+        '''
+        self.server = AnalysisHTTPServer(('127.0.0.1', port), AnalysisRequestHandler)
+        self.server.service = self
+        self.logger.info("Analysis service listening on 127.0.0.1:{0}".format(self.server.server_address[1]))
+        if background:
+            ServerThread = threading.Thread(target=self.server.serve_forever, name="IQMonService")
+            ServerThread.daemon = True
+            ServerThread.start()
+        else:
+            self.server.serve_forever()
+        return self.server.server_address[1]
+
+    def Shutdown(self):
+        '''
+        Stop the HTTP server (if running) and the worker pool.
+        '''
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        self.pool.close()
+        self.pool.join()
+
+
+class AnalysisHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class AnalysisRequestHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP interface to an AnalysisService (see AnalysisService.Serve).
+    '''
+    def SendJSON(self, status, content):
+        Body = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(Body)))
+        self.end_headers()
+        self.wfile.write(Body)
+
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/health':
+            self.SendJSON(200, {'status': 'ok',
+                                'pending': service.pending,
+                                'maxPending': service.maxPending,
+                                'workers': service.nWorkers})
+        elif self.path == '/metrics':
+            Body = service.metrics.Text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(Body)))
+            self.end_headers()
+            self.wfile.write(Body)
+        else:
+            self.SendJSON(404, {'error': 'Unknown path {0}'.format(self.path)})
+
+    def do_POST(self):
+        service = self.server.service
+        if self.path != '/analyze':
+            self.SendJSON(404, {'error': 'Unknown path {0}'.format(self.path)})
+            return
+        try:
+            Length = int(self.headers.get('Content-Length', 0))
+            Request = json.loads(self.rfile.read(Length).decode('utf-8'))
+            Results = service.Analyze(Request['file'],
+                                      stages=Request.get('stages'),
+                                      deadline=Request.get('deadline'))
+        except ServiceBusy as e:
+            self.SendJSON(503, {'error': str(e)})
+        except DeadlineExceeded as e:
+            self.SendJSON(504, {'error': str(e)})
+        except (KeyError, ValueError, IOError) as e:
+            self.SendJSON(400, {'error': str(e)})
+        except:
+            service.logger.error("Analysis request failed: {0} {1}".format(sys.exc_info()[0], sys.exc_info()[1]))
+            self.SendJSON(500, {'error': str(sys.exc_info()[1])})
+        else:
+            self.SendJSON(200, Results)
+
+    def log_message(self, format, *args):
+        self.server.service.logger.debug("Service: " + format % args)
+
+
+##-----------------------------------------------------------------------------
+## Define AnalysisClient object to make requests of an AnalysisService
+##-----------------------------------------------------------------------------
+class AnalysisClient(object):
+    '''
+    Client for an AnalysisService.  If given a port, requests are made over
+    HTTP to the service on localhost.  If given an AnalysisService object
+    instead, requests are made directly, which is useful for testing
+    without a running server.  In either case, Analyze returns the results
+    dictionary and raises ServiceBusy or DeadlineExceeded as the service
+    does.
+    '''
+    def __init__(self, port=8765, service=None):
+        self.port = port
+        self.service = service
+
+    def Analyze(self, file, stages=None, deadline=None):
+        if self.service:
+            return self.service.Analyze(file, stages=stages, deadline=deadline)
+        Body = json.dumps({'file': file, 'stages': stages, 'deadline': deadline}).encode('utf-8')
+        HTTPRequest = Request("http://127.0.0.1:{0}/analyze".format(self.port), Body,
+                              {'Content-Type': 'application/json'})
+        try:
+            Response = urlopen(HTTPRequest)
+        except HTTPError as e:
+            Error = json.loads(e.read().decode('utf-8')).get('error')
+            if e.code == 503:
+                raise ServiceBusy(Error)
+            elif e.code == 504:
+                raise DeadlineExceeded(Error)
+            elif e.code == 400:
+                raise ValueError(Error)
+            else:
+                raise RuntimeError(Error)
+        return json.loads(Response.read().decode('utf-8'))
+
+
+##-----------------------------------------------------------------------------
+## Define Scheduler object to process a stream of images
+##-----------------------------------------------------------------------------
+class Scheduler(object):
+    '''
+    Processes a stream of images on a pool of worker threads, degrading the
+    processing when a backlog builds up so that the newest image is analyzed
+    within latencyTarget seconds.
+
+    - Images are processed newest first.
+    - The scheduler keeps a running average of the cost of each stage and of
+      the time between images.  When processing every queued image with
+      every stage would miss the latency target, or would take longer than
+      the workers have before the next images arrive, optional work is
+      dropped, in this order, until it would not:
+        1. the background subtracted jpeg and SExtractor check image,
+        2. any jpegs after the first,
+        3. SolveAstrometry for images which already have a WCS in the
+           header.
+    - When there is nothing else in the queue, the stages actually dropped
+      (or skipped) for an image are run (back fill, see BackFillStages).
+      Back filled images are not back filled again, and stages skipped
+      because an image failed Triage are not back filled.
+    - If quickLook is given (a dictionary of QuickLook keyword arguments, or
+      True for the defaults), each new image is first run through
+      QuickStages only (reading the image, its header, Triage and
+      QuickLook), and the full resolution analysis with every stage is
+      queued as its back fill.  The callback is then called twice for an
+      image: with the quick look results in image.quickLook, and again
+      after the full analysis (with image.backFill True).
+
+    cache is an optional ResultCache and columns the SExtractor columns to
+    measure (see ProcessImage), and metrics is an optional Metrics object
+    (default ServiceMetrics) in which the queue depth, queue wait, and
+    latency are recorded.  callback, if given, is called with the image
+    after each image has been processed (image.backFill is True for back
+    filled images and image.degradation is the degradation level used).
+
+    tel can be a TelescopeRegistry instead of a single Telescope, in which
+    case images from all of its telescopes share the worker pool.  Each
+    image is analyzed with the telescope given to Submit (a Telescope or
+    its name) or else the telescope matching its header (see
+    TelescopeRegistry.Match), and with that telescope's Config (config is
+    then not used and can be None).
+
+    Properties:
+      latencies:    List of (file, latency in seconds, degradation level)
+                    tuples, where latency is measured from submission (or
+                    the shutterTime given to Submit).
+      failures:     List of (file, back fill, error) tuples for the images
+                    which raised an exception while being processed.
+      stageCosts:   Running average of the time taken by each stage.
+    '''
+    def __init__(self, tel, config, stages=None, darks=None, nWorkers=2,
+                 latencyTarget=60., logFile=None, verbose=False,
+                 callback=None, cache=None, metrics=None, quickLook=None,
+                 columns=None):
+        if isinstance(tel, TelescopeRegistry):
+            self.registry = tel
+            self.tel = None
+        else:
+            self.registry = None
+            self.tel = tel
+        self.cache = cache
+        self.columns = columns
+        self.metrics = metrics or ServiceMetrics
+        self.config = config
+        self.stages = []
+        for stage in (stages or DefaultStages):
+            if isinstance(stage, (list, tuple)):
+                self.stages.append((stage[0], dict(stage[1])))
+            else:
+                self.stages.append((stage, {}))
+        if quickLook is True:
+            quickLook = {}
+        self.quickLook = quickLook
+        self.darks = darks
+        self.nWorkers = nWorkers
+        self.latencyTarget = latencyTarget
+        self.logFile = logFile
+        self.verbose = verbose
+        self.callback = callback
+        self.logger = logging.getLogger('IQMonLogger')
+        self.queue = []
+        self.backFill = []
+        self.nBusy = 0
+        self.condition = threading.Condition()
+        self.running = False
+        self.threads = []
+        self.stageCosts = {}
+        self.latencies = []
+        self.failures = []
+        self.lastSubmitTime = None
+        self.interval = None
+
+    def Submit(self, file, tel=None, shutterTime=None):
+        '''
+        Add an image to the queue.  tel is the Telescope (or, with a
+        TelescopeRegistry, the telescope name) which took the image.
+        '''
+        if self.registry:
+            if tel is None:
+                tel = self.registry.Match(file)
+            elif not isinstance(tel, Telescope):
+                tel = self.registry.Get(tel)
+        with self.condition:
+            Now = time.time()
+            if self.lastSubmitTime:
+                if self.interval:
+                    self.interval = 0.7*self.interval + 0.3*(Now - self.lastSubmitTime)
+                else:
+                    self.interval = Now - self.lastSubmitTime
+            self.lastSubmitTime = Now
+            self.queue.append((shutterTime or Now, file, tel or self.tel, Now))
+            self.metrics.Set('iqmon_queue_depth', len(self.queue))
+            self.condition.notify()
+
+    def Start(self):
+        '''
+        Start the worker threads.
+        '''
+        self.running = True
+        for i in range(self.nWorkers):
+            Worker = threading.Thread(target=self.Work, name="IQMonWorker{0}".format(i))
+            Worker.daemon = True
+            Worker.start()
+            self.threads.append(Worker)
+
+    def Wait(self):
+        '''
+        Block until the queue and back fill list are empty and all workers
+        are idle.
+        '''
+        with self.condition:
+            while self.queue or self.backFill or self.nBusy:
+                self.condition.wait(0.1)
+
+    def Stop(self):
+        '''
+        Stop the worker threads once their current images are done.
+        '''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for Worker in self.threads:
+            Worker.join()
+        self.threads = []
+
+    def Cost(self, index):
+        return self.stageCosts.get(self.stages[index][0], 0.)
+
+    def Degrade(self, level):
+        '''
+        Return the stage list for a degradation level (see class docstring),
+        whether SolveAstrometry should be skipped for images with a WCS, and
+        the indices (in self.stages) of the stages dropped or changed.
+        '''
+        Kept = list(enumerate(self.stages))
+        if level >= 1:
+            Kept = [(i, (name, kwargs)) for i, (name, kwargs) in Kept
+                    if not (name == 'MakeJPEG' and kwargs.get('backgroundSubtracted'))]
+            Kept = [(i, (name, dict(kwargs, checkImage=False))) if name == 'RunSExtractor' and kwargs.get('checkImage')
+                    else (i, (name, kwargs)) for i, (name, kwargs) in Kept]
+        if level >= 2:
+            JPEGs = [i for i, stage in Kept if stage[0] == 'MakeJPEG']
+            Kept = [(i, stage) for i, stage in Kept if not i in JPEGs[1:]]
+        Changed = [i for i, stage in enumerate(self.stages) if not (i, stage) in Kept]
+        return [stage for i, stage in Kept], level >= 3, Changed
+
+    def BackFillStages(self, missing):
+        '''
+        Return the stage list to back fill an image for which the stages at
+        the indices missing (in self.stages) were not run: the missing
+        stages and the analysis stages before them which they depend on (use
+        a ResultCache to avoid repeating those).  Jpegs and catalog archive
+        entries made in the first pass are not made again.
+        '''
+        return [stage for i, stage in enumerate(self.stages[:max(missing)+1])
+                if i in missing or not stage[0] in ['MakeJPEG', 'ArchiveCatalog']]
+
+    def QuickStages(self):
+        '''
+        Return the stage list for the quick look pass: the ReadImage,
+        GetHeader, and Triage stages of the full stage list (once each)
+        followed by QuickLook.
+        '''
+        Quick = []
+        for name, kwargs in self.stages:
+            if name in ['ReadImage', 'GetHeader', 'Triage'] and not name in [stage[0] for stage in Quick]:
+                Quick.append((name, kwargs))
+        return Quick + [('QuickLook', dict(self.quickLook))]
+
+    def Plan(self, nQueued):
+        '''
+        Choose the lowest degradation level at which the images currently
+        queued can all be processed within the latency target and the workers
+        can keep up with the rate at which images arrive.  Returns the level,
+        the stage list, whether to skip SolveAstrometry for images with a
+        WCS, and the indices of the stages dropped or changed.
+        '''
+        for level in range(4):
+            Stages, SkipSolve, Changed = self.Degrade(level)
+            Cost = sum([self.stageCosts.get(name, 0.) for name, kwargs in Stages
+                        if not (SkipSolve and name == 'SolveAstrometry')])
+            EstimatedLatency = Cost * (1. + nQueued / self.nWorkers)
+            KeepingUp = not self.interval or Cost <= self.nWorkers * self.interval
+            if EstimatedLatency <= self.latencyTarget and KeepingUp:
+                break
+        return level, Stages, SkipSolve, Changed
+
+    def IdleForBackFill(self):
+        '''
+        Back fill only if there is back fill to do and either the full stage
+        list can keep up with the rate images arrive or no image has arrived
+        for a while.
+        '''
+        if not self.backFill:
+            return False
+        if not self.interval:
+            return True
+        FullCost = sum([self.stageCosts.get(name, 0.) for name, kwargs in self.stages])
+        return FullCost <= self.nWorkers * self.interval or\
+               time.time() - self.lastSubmitTime > 2. * max(self.interval, FullCost)
+
+    def Next(self):
+        '''
+        Get the next image to process (newest first, then back fill).
+        Returns None when the scheduler is stopped.
+        '''
+        with self.condition:
+            while self.running and not self.queue and not self.IdleForBackFill():
+                self.condition.wait(0.1)
+            if self.queue:
+                self.queue.sort(key=lambda item: item[0])
+                Item = self.queue.pop()
+                if self.quickLook is not None:
+                    ## Every stage is run by the full resolution back fill
+                    level, Stages, SkipSolve, Changed = 0, self.QuickStages(), False, list(range(len(self.stages)))
+                else:
+                    level, Stages, SkipSolve, Changed = self.Plan(len(self.queue))
+                BackFill = False
+                self.metrics.Set('iqmon_queue_depth', len(self.queue))
+                self.metrics.Observe('iqmon_queue_wait_seconds', time.time() - Item[3])
+            elif self.IdleForBackFill():
+                Item = self.backFill.pop()
+                level, Stages, SkipSolve, Changed = 0, Item[4], False, []
+                Item = Item[:4]
+                BackFill = True
+            else:
+                return None
+            self.nBusy += 1
+            return Item, level, Stages, SkipSolve, Changed, BackFill
+
+    def Work(self):
+        while True:
+            Job = self.Next()
+            if Job is None:
+                return
+            (shutterTime, file, tel, submitTime), level, Stages, SkipSolve, Changed, BackFill = Job
+            try:
+                self.Process(shutterTime, file, tel, level, Stages, SkipSolve, Changed, BackFill)
+            except:
+                self.logger.error("Failed to process {0}: {1} {2}".format(file, sys.exc_info()[0], sys.exc_info()[1]))
+                with self.condition:
+                    self.failures.append((file, BackFill, "{0}: {1}".format(sys.exc_info()[0].__name__, sys.exc_info()[1])))
+            finally:
+                with self.condition:
+                    self.nBusy -= 1
+                    self.condition.notify_all()
+
+    def Process(self, shutterTime, file, tel, level, Stages, SkipSolve, Changed, BackFill):
+        if self.registry:
+            image = Image(file, tel, self.registry.Config(tel))
+        else:
+            image = Image(file, tel, self.config)
+        if self.logFile:
+            image.MakeLogger(self.logFile, self.verbose)
+        else:
+            image.logger = self.logger
+        image.degradation = level
+        image.backFill = BackFill
+        image.shutterTime = shutterTime
+        if level > 0:
+            image.logger.warning("Backlog: processing {0} at degradation level {1}".format(image.rawFileName, level))
+        if SkipSolve:
+            Skip = lambda image, name, kwargs: name == 'SolveAstrometry' and image.imageWCS
+        else:
+            Skip = None
+        with image:
+            ProcessImage(image, stages=Stages, darks=self.darks, skip=Skip,
+                         cache=self.cache, metrics=self.metrics, columns=self.columns)
+            Latency = time.time() - shutterTime
+            if not BackFill:
+                self.metrics.Observe('iqmon_latency_seconds', Latency)
+            with self.condition:
+                ## Update running average of stage costs
+                Counts = {}
+                for name, kwargs in Stages:
+                    Counts[name] = Counts.get(name, 0) + 1
+                for name in image.skippedStages + image.triagedStages:
+                    Counts[name] -= 1
+                for name, StageTime in image.stageTimes.items():
+                    Cost = StageTime / max(Counts.get(name, 1), 1)
+                    if name in self.stageCosts:
+                        self.stageCosts[name] = 0.7*self.stageCosts[name] + 0.3*Cost
+                    else:
+                        self.stageCosts[name] = Cost
+                if not BackFill:
+                    self.latencies.append((file, Latency, level))
+                ## Back fill the stages the scheduler dropped (not those skipped
+                ## because the image failed Triage), but only once
+                Missing = set(Changed) | set([i for i, (name, kwargs) in enumerate(self.stages)
+                                              if name in image.skippedStages])
+                if image.analyzable is False:
+                    Missing = set([i for i in Missing if not self.stages[i][0] in TriagedStages])
+                if not BackFill and Missing:
+                    self.backFill.insert(0, (shutterTime, file, tel, time.time(), self.BackFillStages(Missing)))
+            if self.callback:
+                self.callback(image)
+
+
+##-----------------------------------------------------------------------------
+## Make Synthetic Images for Testing
+##-----------------------------------------------------------------------------
+def MakeSyntheticFrames(directory, nFrames=100, cadence=30., shape=(1024, 1024),
+                        nStars=200, FWHM=3., background=1000., exptime=20.,
+                        objectName='Synthetic', startTime=None, seed=None):
+    '''
+    Write nFrames synthetic images of one field taken every cadence seconds
+    to directory.  Each image has nStars gaussian stars of the given FWHM
+    (pixels) on a noisy background and a header with DATE-OBS, EXPTIME,
+    OBJECT, FILTER, RA and DEC.  Returns the list of file names.
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    Random = np.random.RandomState(seed)
+    if startTime is None:
+        startTime = datetime.datetime.utcnow().replace(microsecond=0)
+    nY, nX = shape
+    StarX = Random.uniform(10, nX-10, nStars)
+    StarY = Random.uniform(10, nY-10, nStars)
+    StarFlux = 10.**Random.uniform(2.5, 4.5, nStars)
+    Sigma = FWHM / 2.3548
+    HalfSize = int(math.ceil(4.*Sigma))
+    Offsets = np.arange(-HalfSize, HalfSize+1)
+    Files = []
+    for i in range(nFrames):
+        Data = Random.normal(background, math.sqrt(background), shape).astype(np.float32)
+        for x, y, flux in zip(StarX, StarY, StarFlux):
+            iX = np.clip(int(round(x)) + Offsets, 0, nX-1)
+            iY = np.clip(int(round(y)) + Offsets, 0, nY-1)
+            Data[iY[:,None],iX[None,:]] += flux * np.exp(-((iX[None,:]-x)**2 + (iY[:,None]-y)**2) / (2.*Sigma**2))
+        HDU = fits.PrimaryHDU(Data)
+        DateObs = startTime + datetime.timedelta(seconds=i*cadence)
+        HDU.header['DATE-OBS'] = DateObs.strftime("%Y-%m-%dT%H:%M:%S")
+        HDU.header['EXPTIME'] = exptime
+        HDU.header['OBJECT'] = objectName
+        HDU.header['FILTER'] = 'PSr'
+        HDU.header['RA'] = '12:00:00.0'
+        HDU.header['DEC'] = '+30:00:00'
+        File = os.path.join(directory, "{0}_{1:04d}.fits".format(objectName, i))
+        if os.path.exists(File): os.remove(File)
+        HDU.writeto(File)
+        Files.append(File)
+    return Files
+
+
+##-----------------------------------------------------------------------------
+## Make Stand In Versions of the External Tools for Testing
+##-----------------------------------------------------------------------------
+StandInSExtractor = '''#!{python}
+## Stand in for SExtractor written by IQMon.MakeStandInTools
+import sys
+import os
+import time
+import shutil
+if sys.argv[1:2] == ['-dd']:
+    for Keyword in ['CATALOG_NAME', 'CATALOG_TYPE', 'PARAMETERS_NAME',
+                    'DETECT_MINAREA', 'DETECT_THRESH', 'ANALYSIS_THRESH',
+                    'FILTER', 'BACK_SIZE', 'ASSOC_NAME', 'ASSOCSELEC_TYPE',
+                    'CHECKIMAGE_TYPE', 'CHECKIMAGE_NAME', 'PHOT_APERTURES',
+                    'GAIN', 'PIXEL_SCALE', 'SATUR_LEVEL', 'SEEING_FWHM']:
+        print("{{0:16s}} NONE".format(Keyword))
+    sys.exit(0)
+time.sleep({latency})
+import numpy as np
+from astropy.io import fits
+Config = {{}}
+for line in open(sys.argv[sys.argv.index('-c')+1]):
+    Fields = line.split()
+    if len(Fields) >= 2:
+        Config[Fields[0]] = Fields[1]
+Header = fits.getheader(sys.argv[1])
+Random = np.random.RandomState()
+nStars = {nStars}
+Values = {{'X_IMAGE': Random.uniform(1, Header['NAXIS1'], nStars),
+          'Y_IMAGE': Random.uniform(1, Header['NAXIS2'], nStars),
+          'FWHM_IMAGE': Random.normal({FWHM}, 0.1*{FWHM}, nStars),
+          'THETA_IMAGE': Random.uniform(-90, 90, nStars),
+          'ELLIPTICITY': Random.uniform(0., 0.15, nStars),
+          'FLUX_MAX': 10.**Random.uniform(2.5, 4.5, nStars),
+          'MAG_APER': Random.uniform(10, 16, nStars)}}
+## Write the columns in the parameters file (made up values for others)
+Names = sorted(Values.keys())
+if os.path.exists(Config.get('PARAMETERS_NAME', '')):
+    Names = [line.split()[0] for line in open(Config['PARAMETERS_NAME'])
+             if line.strip() and not line.startswith('#')]
+for Name in Names:
+    if not Name in Values:
+        Values[Name] = Random.uniform(10, 16, nStars)
+Columns = [fits.Column(name=Name, format='E', array=Values[Name]) for Name in Names]
+try:
+    Objects = fits.BinTableHDU.from_columns(Columns, name='LDAC_OBJECTS')
+except AttributeError:
+    Objects = fits.new_table(Columns)
+if os.path.exists(Config['CATALOG_NAME']): os.remove(Config['CATALOG_NAME'])
+fits.HDUList([fits.PrimaryHDU(), fits.BinTableHDU(name='LDAC_IMHEAD'), Objects]).writeto(Config['CATALOG_NAME'])
+if Config.get('CHECKIMAGE_TYPE', 'NONE') != 'NONE':
+    for Type, Name in zip(Config['CHECKIMAGE_TYPE'].split(','), Config['CHECKIMAGE_NAME'].split(',')):
+        if Type == 'MINIBACKGROUND':
+            Size = int(float(Config.get('BACK_SIZE', 64)))
+            Shape = (-(-Header['NAXIS2'] // Size), -(-Header['NAXIS1'] // Size))
+            if os.path.exists(Name): os.remove(Name)
+            fits.PrimaryHDU(np.full(Shape, 1000., dtype=np.float32)).writeto(Name)
+        else:
+            shutil.copy(sys.argv[1], Name)
+print("(M+D) Background: 1000.00    RMS: 31.6228    / Threshold: 158.11")
+print("Objects: detected {{0}} / sextracted {{0}}".format(nStars))
+'''
+
+StandInSolveField = '''#!{python}
+## Stand in for astrometry.net solve-field written by IQMon.MakeStandInTools
+import sys
+import os
+import time
+import shutil
+time.sleep({latency})
+shutil.copy(sys.argv[-1], os.path.splitext(sys.argv[-1])[0]+".new")
+print("Field center: (RA H:M:S, Dec D:M:S) = (12:00:00.000, +30:00:00.00).")
+'''
+
+StandInConvert = '''#!{python}
+## Stand in for ImageMagick convert written by IQMon.MakeStandInTools
+import sys
+import time
+time.sleep({latency})
+open(sys.argv[-1], 'wb').close()
+'''
+
+def MakeStandInTools(directory, latency=None, nStars=100, FWHM=3.):
+    '''
+    Write stand in versions of sex, solve-field, and convert to directory
+    which take latency[tool] seconds and produce the files IQMon expects
+    (SExtractor's catalog of nStars fake stars with the given FWHM, a
+    "solved" copy of the image, and an empty jpeg).  Put directory at the
+    front of the PATH (as Replay does) to use them in place of the real
+    tools.  Returns directory.
+    '''
+    Latency = {'sex': 1., 'solve-field': 10., 'convert': 0.5}
+    if latency:
+        Latency.update(latency)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for Tool, Template in [('sex', StandInSExtractor),
+                           ('solve-field', StandInSolveField),
+                           ('convert', StandInConvert)]:
+        ToolFile = os.path.join(directory, Tool)
+        with open(ToolFile, 'w') as FileObject:
+            FileObject.write(Template.format(python=sys.executable,
+                                             latency=Latency[Tool],
+                                             nStars=nStars, FWHM=FWHM))
+        os.chmod(ToolFile, 0o755)
+    return directory
+
+
+##-----------------------------------------------------------------------------
+## Define Replay object to test throughput and latency on a night of images
+##-----------------------------------------------------------------------------
+class Replay(object):
+    '''
+    Replays a night of images through a Scheduler at the cadence at which
+    they were taken (from DATE-OBS), speeded up by a factor of speed, to find
+    out whether IQMon keeps up before it falls behind on sky.  Images without
+    DATE-OBS are submitted every cadence seconds.  If toolsDirectory is given
+    (see MakeStandInTools) it is put at the front of the PATH for the replay,
+    so the stand in tools are used instead of the real ones.
+
+    Each image is submitted with its shutter time set to the time it is
+    submitted.  After Run, self.report contains:
+      nImages:     Number of images replayed.
+      nFailed:     Number of images which failed on the first pass (raised
+                   an exception in the Scheduler, so they are not counted
+                   in throughput, latency, or stages).
+      failures:    List of (file, error) for those images.
+      elapsed:     Time from the first submission until all work (including
+                   back fill) was done.
+      throughput:  Images per second processed on the first pass (not
+                   counting back fill).
+      latency:     p50, p95, and p99 of the shutter to result latency.
+      stages:      For each stage, the p50, p95, and p99 of the time the
+                   stage took (duration) and of the time from shutter until
+                   the stage finished (latency).
+      degradation: Number of images processed at each degradation level.
+      queueDepth:  List of (time, queued, back fill, busy workers) samples
+                   taken every sampleInterval seconds.
+    '''
+    def __init__(self, files, tel, config, speed=1., cadence=30., stages=None,
+                 darks=None, nWorkers=2, latencyTarget=60., toolsDirectory=None,
+                 sampleInterval=1., logFile=None):
+        self.tel = tel
+        self.config = config
+        self.speed = speed
+        self.cadence = cadence
+        self.stages = stages
+        self.darks = darks
+        self.nWorkers = nWorkers
+        self.latencyTarget = latencyTarget
+        self.toolsDirectory = toolsDirectory
+        self.sampleInterval = sampleInterval
+        self.logFile = logFile
+        self.logger = logging.getLogger('IQMonLogger')
+        self.schedule = self.Schedule(files)
+        self.records = []
+        self.failures = []
+        self.queueDepth = []
+        self.report = None
+
+    def Schedule(self, files):
+        '''
+        Return a list of (offset in seconds, file) tuples giving when each
+        image should be submitted.
+        '''
+        Times = []
+        for i, file in enumerate(files):
+            try:
+                DateObs = fits.getheader(file)['DATE-OBS']
+                Time = datetime.datetime.strptime(DateObs[0:19], "%Y-%m-%dT%H:%M:%S")
+            except:
+                Time = None
+            Times.append((Time, i, file))
+        if all([Time for Time, i, file in Times]):
+            Times.sort()
+            Start = Times[0][0]
+            return [((Time - Start).total_seconds() / self.speed, file) for Time, i, file in Times]
+        else:
+            return [(i * self.cadence / self.speed, file) for Time, i, file in Times]
+
+    def Record(self, image):
+        '''
+        Scheduler callback: record the stage times and latencies of an
+        image.
+        '''
+        Record = {'file': image.rawFileName,
+                  'backFill': image.backFill,
+                  'degradation': image.degradation,
+                  'finished': time.time(),
+                  'latency': time.time() - image.shutterTime,
+                  'durations': dict(image.stageTimes),
+                  'latencies': dict([(name, finished - image.shutterTime)
+                                     for name, finished in image.stageFinished.items()])}
+        self.records.append(Record)
+
+    def Sample(self, scheduler, start, done):
+        while not done.is_set():
+            with scheduler.condition:
+                self.queueDepth.append((time.time() - start, len(scheduler.queue),
+                                        len(scheduler.backFill), scheduler.nBusy))
+            done.wait(self.sampleInterval)
+
+    def Run(self):
+        '''
+        Replay the images and return the report.
+        '''
+        OriginalPath = os.environ.get('PATH', '')
+        if self.toolsDirectory:
+            os.environ['PATH'] = self.toolsDirectory + os.pathsep + OriginalPath
+        scheduler = Scheduler(self.tel, self.config, stages=self.stages,
+                              darks=self.darks, nWorkers=self.nWorkers,
+                              latencyTarget=self.latencyTarget,
+                              logFile=self.logFile, callback=self.Record)
+        self.records = []
+        self.queueDepth = []
+        Done = threading.Event()
+        Start = time.time()
+        Sampler = threading.Thread(target=self.Sample, args=(scheduler, Start, Done), name="IQMonReplaySampler")
+        Sampler.daemon = True
+        try:
+            scheduler.Start()
+            Sampler.start()
+            self.logger.info("Replaying {0} images at {1:.1f}x speed.".format(len(self.schedule), self.speed))
+            for Offset, file in self.schedule:
+                Wait = Start + Offset - time.time()
+                if Wait > 0:
+                    time.sleep(Wait)
+                scheduler.Submit(file)
+            scheduler.Wait()
+        finally:
+            Elapsed = time.time() - Start
+            scheduler.Stop()
+            self.failures = [(file, error) for file, BackFill, error in scheduler.failures if not BackFill]
+            Done.set()
+            if Sampler.is_alive():
+                Sampler.join()
+            os.environ['PATH'] = OriginalPath
+        self.report = self.Report(Start, Elapsed)
+        self.LogReport()
+        return self.report
+
+    def Report(self, start, elapsed):
+        def Percentiles(values):
+            if len(values) == 0:
+                return None
+            return dict(zip(['p50', 'p95', 'p99'], [float(p) for p in np.percentile(values, [50, 95, 99])]))
+        FirstPass = [Record for Record in self.records if not Record['backFill']]
+        Report = {'nImages': len(self.schedule),
+                  'nFailed': len(self.failures),
+                  'failures': list(self.failures),
+                  'elapsed': elapsed,
+                  'throughput': None,
+                  'latency': Percentiles([Record['latency'] for Record in FirstPass]),
+                  'stages': {},
+                  'degradation': {},
+                  'queueDepth': list(self.queueDepth)}
+        if FirstPass:
+            Report['throughput'] = len(FirstPass) / (max([Record['finished'] for Record in FirstPass]) - start)
+        for Record in FirstPass:
+            Report['degradation'][Record['degradation']] = Report['degradation'].get(Record['degradation'], 0) + 1
+        Names = set()
+        for Record in FirstPass:
+            Names.update(Record['durations'].keys())
+        for name in Names:
+            Report['stages'][name] = {
+                'duration': Percentiles([Record['durations'][name] for Record in FirstPass if name in Record['durations']]),
+                'latency': Percentiles([Record['latencies'][name] for Record in FirstPass if name in Record['latencies']])}
+        return Report
+
+    def LogReport(self):
+        Report = self.report
+        self.logger.info("Replayed {0} images in {1:.1f} s ({2:.2f} images/s, {3}/{0} failed).".format(
+                         Report['nImages'], Report['elapsed'], Report['throughput'] or 0., Report['nFailed']))
+        for file, error in Report['failures']:
+            self.logger.error("  Failed to process {0}: {1}".format(file, error))
+        if Report['latency']:
+            self.logger.info("Shutter to result latency: p50 = {p50:.1f} s, p95 = {p95:.1f} s, p99 = {p99:.1f} s".format(**Report['latency']))
+        for name in [stage for stage in Stages if stage in Report['stages']]:
+            Duration = Report['stages'][name]['duration']
+            Latency = Report['stages'][name]['latency']
+            self.logger.info("  {0:24s} duration p50/p95/p99 = {1:.2f}/{2:.2f}/{3:.2f} s, latency p50/p95/p99 = {4:.1f}/{5:.1f}/{6:.1f} s".format(
+                             name, Duration['p50'], Duration['p95'], Duration['p99'],
+                             Latency['p50'], Latency['p95'], Latency['p99']))
+        for level in sorted(Report['degradation'].keys()):
+            self.logger.info("  {0} images processed at degradation level {1}".format(Report['degradation'][level], level))
+        if Report['queueDepth']:
+            self.logger.info("Maximum queue depth: {0}".format(max([Sample[1] for Sample in Report['queueDepth']])))
+
+
+##-----------------------------------------------------------------------------
+## Command Line Interface
+##-----------------------------------------------------------------------------
+def main():
+    '''
+    Maintain the result cache from the command line:
+      python IQMon.py cache verify
+      python IQMon.py cache invalidate [--file FILE] [--stage STAGE]
+    Derive FWHM, ellipticity, and PSF map tilt and curvature for every frame
+    in the catalog archive and write them to a CSV file:
+      python IQMon.py archive rederive [--output FILE] [--nBins N] [--IQRadiusFactor F]
+    The cache and archive directories are taken from the config file unless
+    --directory is given.
+    '''
+    Parser = argparse.ArgumentParser(description="IQMon utilities.")
+    Commands = Parser.add_subparsers(dest="command")
+    CacheParser = Commands.add_parser("cache", help="Maintain the result cache.")
+    CacheParser.add_argument("action", choices=["verify", "invalidate"])
+    CacheParser.add_argument("--directory", default=None,
+                             help="Cache directory (default from config file).")
+    CacheParser.add_argument("--file", default=None,
+                             help="Only invalidate entries for this raw file.")
+    CacheParser.add_argument("--stage", default=None, choices=CachedStages,
+                             help="Only invalidate entries for this stage.")
+    ArchiveParser = Commands.add_parser("archive", help="Use the catalog archive.")
+    ArchiveParser.add_argument("action", choices=["summary", "rederive"])
+    ArchiveParser.add_argument("--directory", default=None,
+                               help="Archive directory (default from config file).")
+    ArchiveParser.add_argument("--output", default=None,
+                               help="CSV file for rederived metrics (default standard output).")
+    ArchiveParser.add_argument("--nBins", type=int, default=3,
+                               help="Size of the PSF map grid.")
+    ArchiveParser.add_argument("--IQRadiusFactor", type=float, default=1.0,
+                               help="Radius (in half diagonals) of the region used for FWHM.")
+    Arguments = Parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)8s: %(message)s")
+
+    if Arguments.command == "cache":
+        if Arguments.directory:
+            cache = ResultCache(directory=Arguments.directory)
+        else:
+            cache = ResultCache(Config())
+        if Arguments.action == "verify":
+            nChecked, nRemoved = cache.Verify()
+            print("Checked {0} cache entries, removed {1}.".format(nChecked, nRemoved))
+        elif Arguments.action == "invalidate":
+            nRemoved = cache.Invalidate(file=Arguments.file, stage=Arguments.stage)
+            print("Removed {0} cache entries.".format(nRemoved))
+
+    if Arguments.command == "archive":
+        Directory = Arguments.directory or Config().pathArchive
+        if not Directory:
+            Parser.error("No archive directory given or set in the config file (IQMONARCHIVE).")
+        archive = CatalogArchive(Directory)
+        if Arguments.action == "summary":
+            Frames = archive.Frames()
+            print("{0} frames, {1} stars in {2}.".format(len(Frames), archive.nRows(), Directory))
+        elif Arguments.action == "rederive":
+            StartTime = time.time()
+            Derived = archive.Rederive(IQRadiusFactor=Arguments.IQRadiusFactor,
+                                       nBins=Arguments.nBins)
+            logging.info("Derived metrics for {0} frames in {1:.1f} s.".format(len(Derived['frames']), time.time() - StartTime))
+            if Arguments.output:
+                output = open(Arguments.output, 'w')
+            else:
+                output = sys.stdout
+            Writer = csv.writer(output, lineterminator='\n')
+            Writer.writerow(['frame', 'file', 'dateObs', 'telescope', 'nStars',
+                             'FWHM', 'ellipticity', 'tilt', 'tiltAngle', 'curvature'])
+            for i, Frame in enumerate(Derived['frames']):
+                Writer.writerow([Frame['frame'], Frame['file'], Frame['dateObs'], Frame['telescope'],
+                                 Derived['nStars'][i]] +
+                                ["{0:.3f}".format(Derived[name][i]) for name in ['FWHM', 'ellipticity', 'tilt', 'tiltAngle', 'curvature']])
+            if Arguments.output:
+                output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+'''
+Tests of CatalogArchive: appending catalogs and deriving the FWHM,
+ellipticity, PSF map, and tilt and curvature of the archived frames with
+Rederive.
+'''
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PackageDirectory)
+import IQMon
+
+try:
+    import numpy as np
+    from astropy import table
+except ImportError:
+    table = None
+
+
+class ArchivedImage(object):
+    '''
+    The attributes of an Image which CatalogArchive.Append uses.
+    '''
+    def __init__(self, name, results, nPix=300):
+        self.rawFileName = name
+        self.dateObs = '2026-10-19T01:00:00'
+        self.tel = IQMon.Telescope()
+        self.tel.name = 'Test'
+        self.nXPix = self.nYPix = nPix
+        self.SExtractorResults = results
+        self.logger = logging.getLogger('IQMonLogger')
+
+
+@unittest.skipIf(table is None, "numpy and astropy are required")
+class TestRederive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.archive = IQMon.CatalogArchive(os.path.join(self.directory, 'archive'))
+        self.random = np.random.RandomState(6)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def Catalog(self, nStars, FWHM, ellipticity=0.1, theta=0., curvature=0., nPix=300):
+        '''
+        A catalog of stars spread over an nPix square image whose FWHM is
+        FWHM + curvature*r**2 (r is the distance from the center in units of
+        the half diagonal).
+        '''
+        X = self.random.uniform(1, nPix, nStars)
+        Y = self.random.uniform(1, nPix, nStars)
+        R2 = ((X - nPix/2.)**2 + (Y - nPix/2.)**2) / (2*(nPix/2.)**2)
+        Results = table.Table()
+        for name, values in [('X_IMAGE', X), ('Y_IMAGE', Y),
+                             ('FWHM_IMAGE', FWHM + curvature*R2),
+                             ('ELLIPTICITY', np.full(nStars, ellipticity)),
+                             ('THETA_IMAGE', np.full(nStars, theta)),
+                             ('FLUX_MAX', np.full(nStars, 1000.)),
+                             ('MAG_APER', np.full(nStars, -10.)),
+                             ('MAGERR_APER', np.full(nStars, 0.01))]:
+            Results.add_column(table.Column(data=values, name=name))
+        return Results
+
+    def test_append_is_idempotent(self):
+        image = ArchivedImage('a.fits', self.Catalog(50, 3.))
+        self.assertEqual(self.archive.Append(image), 0)
+        self.assertEqual(self.archive.Append(image), 0)
+        self.assertEqual(self.archive.Append(ArchivedImage('b.fits', self.Catalog(20, 3.))), 1)
+        self.assertEqual(self.archive.nRows(), 70)
+        self.assertEqual(len(self.archive.Column('FWHM_IMAGE')), 70)
+
+    def test_per_frame_metrics(self):
+        for i, (FWHM, ellipticity) in enumerate([(2., 0.1), (3., 0.2), (4.5, 0.05)]):
+            self.archive.Append(ArchivedImage('{0}.fits'.format(i),
+                                              self.Catalog(200, FWHM, ellipticity=ellipticity, theta=45.)))
+        Derived = self.archive.Rederive()
+        self.assertEqual(len(Derived['frames']), 3)
+        self.assertEqual(list(Derived['nStars']), [200, 200, 200])
+        self.assertTrue(np.allclose(Derived['FWHM'], [2., 3., 4.5]))
+        self.assertTrue(np.allclose(Derived['ellipticity'], [0.1, 0.2, 0.05]))
+        self.assertEqual(Derived['PSFMapFWHM'].shape, (3, 3, 3))
+        self.assertTrue(np.allclose(Derived['PSFMapFWHM'][1], 3.))
+        self.assertTrue(np.allclose(Derived['PSFMapTheta'], 45.))
+        self.assertEqual(Derived['PSFMapNStars'].sum(), 600)
+        ## A flat FWHM has no tilt or curvature
+        self.assertTrue(np.allclose(Derived['tilt'], 0., atol=1e-6))
+        self.assertTrue(np.allclose(Derived['curvature'], 0., atol=1e-6))
+
+    def test_curvature(self):
+        self.archive.Append(ArchivedImage('a.fits', self.Catalog(300, 3., curvature=1.5)))
+        Derived = self.archive.Rederive()
+        self.assertAlmostEqual(Derived['curvature'][0], 1.5, places=6)
+        self.assertAlmostEqual(Derived['coefficients'][0,0], 3., places=6)
+
+    def test_selected_frames_match_all_frames(self):
+        for i in range(4):
+            self.archive.Append(ArchivedImage('{0}.fits'.format(i), self.Catalog(30 + 10*i, 2. + i, curvature=0.5*i)))
+        All = self.archive.Rederive()
+        Selected = self.archive.Rederive(frames=[3, 1])
+        self.assertEqual([Frame['file'] for Frame in Selected['frames']], ['3.fits', '1.fits'])
+        for key in ['FWHM', 'ellipticity', 'curvature', 'nStars']:
+            self.assertTrue(np.allclose(Selected[key], All[key][[3, 1]]))
+        self.assertTrue(np.allclose(Selected['PSFMapFWHM'], All['PSFMapFWHM'][[3, 1]], equal_nan=True))
+
+    def test_sparse_frames(self):
+        self.archive.Append(ArchivedImage('a.fits', self.Catalog(3, 3.)))
+        Derived = self.archive.Rederive(minStars=5)
+        self.assertTrue(np.isnan(Derived['FWHM'][0]))
+        self.assertTrue(np.isnan(Derived['PSFMapFWHM']).all())
+        self.assertTrue(np.isnan(Derived['curvature'][0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+'''
+Tests of DarkLibrary.Match: which darks (and biases) are picked for an
+image from the indexed frames.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PackageDirectory)
+import IQMon
+
+try:
+    import numpy as np
+    from astropy.io import fits
+except ImportError:
+    fits = None
+
+
+class HeaderImage(object):
+    '''
+    The attributes of an Image which DarkLibrary.Match uses.
+    '''
+    def __init__(self, **keywords):
+        self.header = {'TELESCOP': 'T', 'XBINNING': 1, 'DATE-OBS': '2026-10-19T01:00:00'}
+        self.header.update(keywords)
+        self.rawFile = None
+
+
+@unittest.skipIf(fits is None, "numpy and astropy are required")
+class TestDarkLibraryMatch(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.Write('bias1.fits', 'Bias', 0., -10.)
+        self.Write('bias2.fits', 'Bias', 0., -10.)
+        self.Write('dark10a.fits', 'Dark', 10., -10.)
+        self.Write('dark10b.fits', 'Dark', 10., -10.5)
+        self.Write('dark10warm.fits', 'Dark', 10., 0.)
+        self.Write('dark10old.fits', 'Dark', 10., -10., date='2026-08-01T01:00:00')
+        self.Write('dark60.fits', 'Dark', 60., -10.)
+        self.Write('MasterDark120.fits', 'Dark', 120., -10.)
+        self.Write('dark120.fits', 'Dark', 120., -10.)
+        self.Write('dark10other.fits', 'Dark', 10., -10., telescope='Other')
+        self.Write('light.fits', 'Light', 10., -10.)
+        self.library = IQMon.DarkLibrary([self.directory])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def Write(self, name, imageType, exptime, temperature, date='2026-10-19T01:00:00', telescope='T'):
+        Header = fits.Header()
+        Header['IMAGETYP'] = imageType
+        Header['EXPTIME'] = exptime
+        Header['CCD-TEMP'] = temperature
+        Header['DATE-OBS'] = date
+        Header['TELESCOP'] = telescope
+        fits.PrimaryHDU(np.zeros((8, 8), dtype=np.float32), header=Header).writeto(os.path.join(self.directory, name))
+
+    def Names(self, files):
+        return [os.path.basename(file) for file in files]
+
+    def test_index(self):
+        self.assertEqual(len(self.library.frames), 10)
+        Exptimes, Frames = self.library.groups[('T', 1, 'dark')]
+        self.assertEqual(Exptimes, sorted(Exptimes))
+        self.assertEqual(len(self.library.groups[('T', 1, 'bias')][1]), 2)
+
+    def test_matching_exposure_time(self):
+        Darks, Biases, Exptime = self.library.Match(HeaderImage(EXPTIME=10., **{'CCD-TEMP': -10.2}))
+        ## Warm and old darks are out of tolerance, the closest in temperature is first
+        self.assertEqual(self.Names(Darks), ['dark10a.fits', 'dark10b.fits'])
+        self.assertEqual(Biases, [])
+        self.assertEqual(Exptime, 10.)
+
+    def test_master_preferred(self):
+        Darks, Biases, Exptime = self.library.Match(HeaderImage(EXPTIME=120., **{'CCD-TEMP': -10.}))
+        self.assertEqual(self.Names(Darks), ['MasterDark120.fits'])
+        self.assertEqual(Exptime, 120.)
+
+    def test_scaled_from_longer_dark(self):
+        Darks, Biases, Exptime = self.library.Match(HeaderImage(EXPTIME=30., **{'CCD-TEMP': -10.}))
+        self.assertEqual(self.Names(Darks), ['dark60.fits'])
+        self.assertEqual(self.Names(Biases), ['bias1.fits', 'bias2.fits'])
+        self.assertEqual(Exptime, 60.)
+
+    def test_scaled_from_shorter_dark(self):
+        Darks, Biases, Exptime = self.library.Match(HeaderImage(EXPTIME=300., **{'CCD-TEMP': -10.}))
+        self.assertEqual(self.Names(Darks), ['MasterDark120.fits'])
+        self.assertEqual(Exptime, 120.)
+
+    def test_no_match(self):
+        self.library.scale = False
+        self.assertIsNone(self.library.Match(HeaderImage(EXPTIME=30., **{'CCD-TEMP': -10.})))
+        self.library.scale = True
+        ## Other binning, too warm, or no exposure time
+        self.assertIsNone(self.library.Match(HeaderImage(EXPTIME=10., XBINNING=2, **{'CCD-TEMP': -10.})))
+        self.assertIsNone(self.library.Match(HeaderImage(EXPTIME=10., **{'CCD-TEMP': 10.})))
+        self.assertIsNone(self.library.Match(HeaderImage(**{'CCD-TEMP': -10.})))
+
+    def test_other_telescope(self):
+        Darks, Biases, Exptime = self.library.Match(HeaderImage(EXPTIME=10., TELESCOP='Other'))
+        self.assertEqual(self.Names(Darks), ['dark10other.fits'])
+
+    def test_saved_index(self):
+        IndexFile = os.path.join(self.directory, 'index.json')
+        self.library.Save(IndexFile)
+        Loaded = IQMon.DarkLibrary()
+        Loaded.Load(IndexFile)
+        for Target in [HeaderImage(EXPTIME=10., **{'CCD-TEMP': -10.2}),
+                       HeaderImage(EXPTIME=30., **{'CCD-TEMP': -10.})]:
+            self.assertEqual(Loaded.Match(Target), self.library.Match(Target))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+'''
+Tests of the array helpers: Tiles, BackgroundGrid and InterpolateGrid,
+ForcedMeasure, PhaseCorrelate, and FitFocusCurve.
+'''
+import os
+import sys
+import math
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PackageDirectory)
+import IQMon
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def Gaussians(shape, X, Y, peaks, sigmaX, sigmaY=None, theta=0.):
+    '''
+    Return an image of gaussian stars at the given (FITS convention, 1
+    indexed) positions, with the major axis sigmaX at theta degrees.
+    '''
+    if sigmaY is None:
+        sigmaY = sigmaX
+    y, x = np.mgrid[1:shape[0]+1, 1:shape[1]+1]
+    Cos, Sin = math.cos(math.radians(theta)), math.sin(math.radians(theta))
+    data = np.zeros(shape)
+    for Xs, Ys, peak in zip(X, Y, peaks):
+        u = (x - Xs)*Cos + (y - Ys)*Sin
+        v = -(x - Xs)*Sin + (y - Ys)*Cos
+        data += peak * np.exp(-0.5*((u/sigmaX)**2 + (v/sigmaY)**2))
+    return data
+
+
+@unittest.skipIf(np is None, "numpy is required")
+class TestTiles(unittest.TestCase):
+    def test_cores_cover_image_once(self):
+        for nY, nX, tileSize, overlap in [(100, 100, 25, 5), (103, 77, 32, 8), (10, 10, 64, 4)]:
+            Coverage = np.zeros((nY, nX), dtype=int)
+            for (y1, y2, x1, x2), (cy1, cy2, cx1, cx2) in IQMon.Tiles(nY, nX, tileSize, overlap):
+                Coverage[cy1:cy2,cx1:cx2] += 1
+                ## The region is the core grown by overlap, clipped to the image
+                self.assertEqual((y1, y2, x1, x2), (max(cy1-overlap, 0), min(cy2+overlap, nY),
+                                                    max(cx1-overlap, 0), min(cx2+overlap, nX)))
+                self.assertLessEqual(cy2 - cy1, tileSize)
+                self.assertLessEqual(cx2 - cx1, tileSize)
+            self.assertTrue((Coverage == 1).all())
+
+    def test_number_of_tiles(self):
+        self.assertEqual(len(list(IQMon.Tiles(100, 60, 25, 5))), 4*3)
+
+
+@unittest.skipIf(np is None, "numpy is required")
+class TestBackgroundGrid(unittest.TestCase):
+    def setUp(self):
+        Random = np.random.RandomState(1)
+        self.shape = (130, 100)
+        y, x = np.mgrid[0:self.shape[0], 0:self.shape[1]]
+        self.plane = 1000. + 0.5*x + 0.25*y
+        self.data = (self.plane + Random.normal(0., 5., self.shape)).astype(np.float32)
+
+    def test_grid_of_plane(self):
+        Grid, RMS = IQMon.BackgroundGrid(self.data, 32)
+        ## The last row and column of meshes are partial
+        self.assertEqual(Grid.shape, (5, 4))
+        self.assertEqual(Grid.dtype, np.float32)
+        ## Mesh centers of the full meshes
+        for i in range(4):
+            for j in range(3):
+                Expected = 1000. + 0.5*(32*j + 15.5) + 0.25*(32*i + 15.5)
+                self.assertAlmostEqual(Grid[i,j], Expected, delta=2.)
+        ## The RMS is the noise plus the slope of the plane across a mesh
+        self.assertTrue((RMS[:4,:3] > 5.).all() and (RMS[:4,:3] < 12.).all())
+
+    def test_stars_and_bad_pixels_are_clipped(self):
+        data = self.data.copy()
+        data[40:44,40:44] = 60000.
+        data[10:20,10:20] = np.nan
+        Grid, RMS = IQMon.BackgroundGrid(data, 32)
+        Clean, CleanRMS = IQMon.BackgroundGrid(self.data, 32)
+        self.assertTrue(np.isfinite(Grid).all())
+        self.assertTrue(np.allclose(Grid, Clean, atol=3.))
+
+    def test_interpolate_plane(self):
+        Grid, RMS = IQMon.BackgroundGrid(self.data, 32)
+        Background = IQMon.InterpolateGrid(Grid, 32, self.shape)
+        self.assertEqual(Background.shape, self.shape)
+        ## Inside the mesh centers a plane is reproduced
+        Inside = (slice(16, 110), slice(16, 80))
+        self.assertLess(np.abs(Background[Inside] - self.plane[Inside]).max(), 3.)
+
+    def test_interpolate_constant_and_binned(self):
+        Grid = np.full((3, 4), 7., dtype=np.float32)
+        Background = IQMon.InterpolateGrid(Grid, 16, (40, 60), binning=2)
+        self.assertEqual(Background.shape, (20, 30))
+        self.assertTrue(np.allclose(Background, 7.))
+
+    def test_interpolate_between_mesh_centers(self):
+        Grid = np.array([[0., 32.]], dtype=np.float32)
+        Background = IQMon.InterpolateGrid(Grid, 32, (1, 64))
+        ## Nearest mesh value outside the centers, linear in between
+        self.assertEqual(Background[0,0], 0.)
+        self.assertEqual(Background[0,-1], 32.)
+        self.assertAlmostEqual(Background[0,32], 16.5, places=4)
+
+
+@unittest.skipIf(np is None, "numpy is required")
+class TestForcedMeasure(unittest.TestCase):
+    def setUp(self):
+        self.random = np.random.RandomState(2)
+        self.shape = (200, 200)
+        self.X = np.array([40.3, 100.0, 160.7, 60.2])
+        self.Y = np.array([50.6, 100.0, 140.2, 150.5])
+
+    def Measure(self, data, X=None, Y=None):
+        if X is None:
+            X, Y = self.X, self.Y
+        return IQMon.ForcedMeasure(data, X, Y, halfSize=12, apertureRadius=8.)
+
+    def test_round_stars(self):
+        Sigma = 1.5
+        data = 100. + Gaussians(self.shape, self.X, self.Y, [1000.]*4, Sigma)
+        data += self.random.normal(0., 3., self.shape)
+        Measured = self.Measure(data)
+        self.assertTrue(Measured['inBounds'].all())
+        for i in range(4):
+            self.assertAlmostEqual(Measured['X'][i], self.X[i], delta=0.05)
+            self.assertAlmostEqual(Measured['Y'][i], self.Y[i], delta=0.05)
+            self.assertAlmostEqual(Measured['FWHM'][i], 2.3548*Sigma, delta=0.05*2.3548*Sigma)
+            self.assertLess(Measured['ellipticity'][i], 0.05)
+            self.assertAlmostEqual(Measured['background'][i], 100., delta=1.)
+            self.assertAlmostEqual(Measured['noise'][i], 3., delta=0.6)
+            self.assertAlmostEqual(Measured['flux'][i], 1000.*2*math.pi*Sigma**2, delta=0.03*1000.*2*math.pi*Sigma**2)
+
+    def test_faint_stars_are_not_biased(self):
+        Sigma = 1.5
+        Bright = self.Measure(100. + Gaussians(self.shape, self.X, self.Y, [2000.]*4, Sigma)
+                              + self.random.normal(0., 5., self.shape))
+        Faint = self.Measure(100. + Gaussians(self.shape, self.X, self.Y, [30.]*4, Sigma)
+                             + self.random.normal(0., 5., self.shape))
+        self.assertLess(abs(np.median(Faint['FWHM']) / np.median(Bright['FWHM']) - 1.), 0.1)
+
+    def test_elongated_stars(self):
+        data = 100. + Gaussians(self.shape, self.X, self.Y, [1000.]*4, 2.0, 1.0, theta=30.)
+        Measured = self.Measure(data)
+        for i in range(4):
+            self.assertAlmostEqual(Measured['ellipticity'][i], 0.5, delta=0.03)
+            self.assertAlmostEqual(Measured['theta'][i], 30., delta=2.)
+
+    def test_offset_position_is_recentered(self):
+        data = 100. + Gaussians(self.shape, self.X, self.Y, [1000.]*4, 1.5)
+        Measured = self.Measure(data, self.X + 1.5, self.Y - 1.)
+        self.assertTrue(np.allclose(Measured['X'], self.X, atol=0.05))
+        self.assertTrue(np.allclose(Measured['Y'], self.Y, atol=0.05))
+
+    def test_edge_and_empty_cutouts(self):
+        data = 100. + self.random.normal(0., 3., self.shape)
+        Measured = self.Measure(data, [5., 100.], [100., 100.])
+        self.assertEqual(list(Measured['inBounds']), [False, True])
+        for key in ['X', 'Y', 'flux', 'background', 'noise', 'FWHM', 'ellipticity', 'theta']:
+            self.assertTrue(np.isnan(Measured[key][0]))
+        Measured = self.Measure(data, [1.], [1.])
+        self.assertFalse(Measured['inBounds'].any())
+        self.assertTrue(np.isnan(Measured['FWHM']).all())
+
+
+@unittest.skipIf(np is None, "numpy is required")
+class TestPhaseCorrelate(unittest.TestCase):
+    def setUp(self):
+        Random = np.random.RandomState(3)
+        self.shape = (128, 128)
+        self.X = Random.uniform(10, 118, 40)
+        self.Y = Random.uniform(10, 118, 40)
+        self.peaks = Random.uniform(100, 1000, 40)
+        self.reference = Gaussians(self.shape, self.X, self.Y, self.peaks, 1.5)
+        self.referenceFFT = np.fft.fft2(self.reference)
+
+    def test_identical(self):
+        dX, dY, Peak = IQMon.PhaseCorrelate(self.referenceFFT, self.reference)
+        self.assertAlmostEqual(dX, 0., delta=0.01)
+        self.assertAlmostEqual(dY, 0., delta=0.01)
+        self.assertGreater(Peak, 0.9)
+
+    def test_subpixel_shift(self):
+        for ShiftX, ShiftY in [(3.3, -2.6), (-10.75, 5.2), (0.4, 0.)]:
+            data = Gaussians(self.shape, self.X + ShiftX, self.Y + ShiftY, self.peaks, 1.5)
+            dX, dY, Peak = IQMon.PhaseCorrelate(self.referenceFFT, data)
+            self.assertAlmostEqual(dX, ShiftX, delta=0.1)
+            self.assertAlmostEqual(dY, ShiftY, delta=0.1)
+            self.assertGreater(Peak, 0.5)
+
+    def test_unrelated_images(self):
+        Random = np.random.RandomState(4)
+        data = Gaussians(self.shape, Random.uniform(10, 118, 40), Random.uniform(10, 118, 40), self.peaks, 1.5)
+        dX, dY, Peak = IQMon.PhaseCorrelate(self.referenceFFT, data)
+        self.assertLess(Peak, 0.3)
+
+
+@unittest.skipIf(np is None, "numpy is required")
+class TestFitFocusCurve(unittest.TestCase):
+    def Curve(self, positions, x0=5000., a=1e-4, b=4.):
+        return [math.sqrt(a*(x - x0)**2 + b) for x in positions]
+
+    def test_exact_hyperbola(self):
+        Positions = list(range(4000, 6001, 250))
+        BestFocus, Uncertainty, MinFWHM = IQMon.FitFocusCurve(Positions, self.Curve(Positions))
+        self.assertAlmostEqual(BestFocus, 5000., places=3)
+        self.assertAlmostEqual(MinFWHM, 2., places=6)
+        self.assertLess(Uncertainty, 1e-3)
+
+    def test_noisy_off_center(self):
+        Random = np.random.RandomState(5)
+        Positions = np.linspace(4500, 6500, 11)
+        FWHMs = np.array(self.Curve(Positions, x0=5300.)) * (1. + Random.normal(0., 0.01, 11))
+        BestFocus, Uncertainty, MinFWHM = IQMon.FitFocusCurve(Positions, FWHMs)
+        self.assertGreater(Uncertainty, 0.)
+        self.assertLess(abs(BestFocus - 5300.), 4*Uncertainty + 20.)
+        self.assertAlmostEqual(MinFWHM, 2., delta=0.2)
+
+    def test_too_few_points_or_wrong_shape(self):
+        self.assertIsNone(IQMon.FitFocusCurve([1., 2., 3.], [3., 2., 3.]))
+        Positions = [1., 2., 3., 4., 5.]
+        self.assertIsNone(IQMon.FitFocusCurve(Positions, [2., 3., 3.5, 3., 2.]))
+
+
+if __name__ == '__main__':
+    unittest.main()
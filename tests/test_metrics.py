@@ -0,0 +1,74 @@
+'''
+Tests of the Prometheus text format written by Metrics.Text.
+'''
+import os
+import sys
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PackageDirectory)
+import IQMon
+
+
+class TestMetricsText(unittest.TestCase):
+    def setUp(self):
+        self.metrics = IQMon.Metrics()
+
+    def Lines(self, name):
+        return [line for line in self.metrics.Text().split('\n') if line.split('{')[0].split(' ')[0].startswith(name)]
+
+    def test_descriptions(self):
+        Text = self.metrics.Text()
+        self.assertTrue(Text.endswith('\n'))
+        self.assertIn('# HELP iqmon_queue_depth Images waiting to be processed.', Text)
+        self.assertIn('# TYPE iqmon_queue_depth gauge', Text)
+        self.assertIn('# TYPE iqmon_stage_seconds histogram', Text)
+        ## No samples until something is counted
+        self.assertEqual([line for line in Text.split('\n') if line and not line.startswith('#')], [])
+
+    def test_counter_and_gauge(self):
+        self.metrics.Increment('iqmon_images_processed_total', status='ok')
+        self.metrics.Increment('iqmon_images_processed_total', status='ok')
+        self.metrics.Increment('iqmon_images_processed_total', 3, status='failed')
+        self.metrics.Set('iqmon_queue_depth', 7)
+        self.assertEqual(self.Lines('iqmon_images_processed_total'),
+                         ['iqmon_images_processed_total{status="failed"} 3.0',
+                          'iqmon_images_processed_total{status="ok"} 2.0'])
+        self.assertEqual(self.Lines('iqmon_queue_depth'), ['iqmon_queue_depth 7.0'])
+
+    def test_histogram(self):
+        for value in [0.3, 0.3, 4., 1000.]:
+            self.metrics.Observe('iqmon_stage_seconds', value, stage='Triage')
+        Lines = self.Lines('iqmon_stage_seconds')
+        Buckets = dict((line.split('le="')[1].split('"')[0], int(line.split(' ')[-1]))
+                       for line in Lines if '_bucket' in line)
+        self.assertEqual(len(Buckets), len(IQMon.Metrics.buckets) + 1)
+        self.assertEqual(Buckets['0.25'], 0)
+        self.assertEqual(Buckets['0.5'], 2)
+        self.assertEqual(Buckets['5.0'], 3)
+        self.assertEqual(Buckets['300.0'], 3)
+        self.assertEqual(Buckets['+Inf'], 4)
+        self.assertIn('iqmon_stage_seconds_bucket{stage="Triage",le="0.5"} 2', Lines)
+        self.assertIn('iqmon_stage_seconds_sum{stage="Triage"} 1004.6', Lines)
+        self.assertIn('iqmon_stage_seconds_count{stage="Triage"} 4', Lines)
+
+    def test_bucket_bounds_are_inclusive(self):
+        self.metrics.Observe('iqmon_image_seconds', 1.)
+        Lines = self.Lines('iqmon_image_seconds')
+        self.assertIn('iqmon_image_seconds_bucket{le="1.0"} 1', Lines)
+        self.assertIn('iqmon_image_seconds_bucket{le="0.5"} 0', Lines)
+
+    def test_label_escaping(self):
+        self.metrics.Increment('iqmon_stage_failures_total', stage='a "quoted" \\ stage')
+        self.assertEqual(self.Lines('iqmon_stage_failures_total'),
+                         ['iqmon_stage_failures_total{stage="a \\"quoted\\" \\\\ stage"} 1.0'])
+
+    def test_new_metric(self):
+        self.metrics.Describe('iqmon_test_total', 'counter', 'A test counter.')
+        self.metrics.Increment('iqmon_test_total', camera='b', telescope='a')
+        ## Labels are sorted by name
+        self.assertEqual(self.Lines('iqmon_test_total'), ['iqmon_test_total{camera="b",telescope="a"} 1.0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+'''
+ProcessImage on a synthetic frame with the stand in tools (see
+IQMon.MakeSyntheticFrames and IQMon.MakeStandInTools), ending with a jpeg
+with the stars marked.  The stand in convert records its arguments in the
+jpeg file so that the marks can be checked.
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PackageDirectory)
+import IQMon
+
+try:
+    import numpy
+    import astropy.units as u
+except ImportError:
+    u = None
+
+RecordingConvert = '''#!{python}
+## Stand in for ImageMagick convert which writes its arguments to the jpeg
+import sys
+with open(sys.argv[-1], 'w') as FileObject:
+    FileObject.write("\\n".join(sys.argv[1:]))
+'''
+
+@unittest.skipIf(u is None, "numpy and astropy are required")
+@unittest.skipIf(sys.version_info[0] > 2, "IQMon reads the output of the external tools as python 2 strings")
+class TestProcessImage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tel = IQMon.Telescope()
+        self.tel.SExtractorSeeing = 2.0*u.arcsec
+        self.tel.pixelScale = 1.0*u.arcsec/u.pix
+        self.tel.SExtractorPhotAperture = 6*u.pix
+        self.tel.gain = 1.0*u.electron/u.adu
+        self.config = IQMon.Config(os.path.join(self.directory, 'none.yaml'))
+        self.config.pathScratch = self.config.pathTemp = self.directory
+        self.config.pathPlots = self.config.pathLog = self.directory
+        self.config.pathIQMonExec = PackageDirectory
+        self.files = IQMon.MakeSyntheticFrames(self.directory, nFrames=1, shape=(256, 256), nStars=20, seed=1)
+        Tools = IQMon.MakeStandInTools(os.path.join(self.directory, 'tools'),
+                                       latency={'sex': 0., 'solve-field': 0., 'convert': 0.})
+        with open(os.path.join(Tools, 'convert'), 'w') as FileObject:
+            FileObject.write(RecordingConvert.format(python=sys.executable))
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = Tools + os.pathsep + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.directory)
+
+    def ProcessAndMark(self, columns=None, SExtractorColumns=None):
+        '''
+        Run SExtractor and make a jpeg with the stars marked, return the
+        image and the arguments convert was called with.
+        '''
+        JPEGFile = os.path.join(self.directory, 'marked.jpg')
+        image = IQMon.Image(self.files[0], self.tel, self.config)
+        image.MakeLogger(os.path.join(self.directory, 'IQMon.log'), False)
+        if SExtractorColumns:
+            image.SExtractorColumns = SExtractorColumns
+        with image:
+            IQMon.ProcessImage(image, ['ReadImage', 'GetHeader', 'RunSExtractor',
+                                       ('MakeJPEG', {'jpegFileName': JPEGFile, 'markStars': True})],
+                               columns=columns)
+        with open(JPEGFile) as FileObject:
+            return image, FileObject.read().split('\n')
+
+    def test_default_parameters(self):
+        image, Arguments = self.ProcessAndMark()
+        self.assertEqual(image.failedStages, [])
+        self.assertIn('MAG_AUTO', image.SExtractorResults.colnames)
+        self.assertIn('FLUX_RADIUS', image.SExtractorResults.colnames)
+        self.assertTrue(any(argument.startswith('circle') for argument in Arguments))
+
+    def test_stage_columns(self):
+        image, Arguments = self.ProcessAndMark(columns='stages')
+        self.assertEqual(image.failedStages, [])
+        self.assertNotIn('FLUX_RADIUS', image.SExtractorResults.colnames)
+        self.assertTrue(any(argument.startswith('circle') for argument in Arguments))
+
+    def test_marks_without_magnitudes(self):
+        image, Arguments = self.ProcessAndMark(SExtractorColumns=['X_IMAGE', 'Y_IMAGE', 'FWHM_IMAGE'])
+        self.assertEqual(image.failedStages, [])
+        self.assertNotIn('MAG_AUTO', image.SExtractorResults.colnames)
+        self.assertTrue(any(argument.startswith('circle') for argument in Arguments))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+'''
+Start up time budget for processes which analyze a single image: importing
+IQMon must be fast and must not import the astronomy specific modules,
+which are deferred until a stage uses them (see IQMon.LazyModule).
+
+The budget (seconds) can be changed with the IQMON_IMPORT_BUDGET environment
+variable for slow machines.
+'''
+import os
+import sys
+import json
+import subprocess
+import unittest
+
+PackageDirectory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ImportScript = '''
+import sys
+import time
+import json
+sys.path.insert(0, {directory!r})
+StartTime = time.time()
+import IQMon
+ImportTime = time.time() - StartTime
+print(json.dumps({{'importTime': ImportTime,
+                  'modules': sorted(sys.modules.keys())}}))
+'''
+
+class TestStartup(unittest.TestCase):
+    budget = float(os.environ.get('IQMON_IMPORT_BUDGET', 1.0))
+    deferred = ['astropy', 'ephem']
+
+    def ImportIQMon(self):
+        '''
+        Import IQMon in a fresh python process and return the import time
+        and the list of modules loaded.
+        '''
+        Output = subprocess.check_output([sys.executable, '-c', ImportScript.format(directory=PackageDirectory)])
+        Result = json.loads(Output.decode('utf-8').strip().split('\n')[-1])
+        return Result['importTime'], Result['modules']
+
+    def test_import_time(self):
+        ## Best of three, so that a busy machine does not fail the test
+        ImportTimes = [self.ImportIQMon()[0] for i in range(3)]
+        self.assertLess(min(ImportTimes), self.budget,
+                        "import IQMon took {0:.3f} s (budget {1:.3f} s)".format(min(ImportTimes), self.budget))
+
+    def test_deferred_imports(self):
+        ImportTime, Modules = self.ImportIQMon()
+        for name in self.deferred:
+            Loaded = [module for module in Modules if module.split('.')[0] == name]
+            self.assertEqual(Loaded, [], "{0} imported at module load: {1}".format(name, ", ".join(Loaded[0:5])))
+
+
+if __name__ == '__main__':
+    unittest.main()